@@ -21,11 +21,58 @@ Usage:  imap [options] command [arguments]
 	-f		force; upload mail to non-empty mailboxes
 	-P pfx		mailbox prefix; used with upload command
 	-t timeout	set timeout value in seconds
-	-w seconds	set time interval between queries
+	-w seconds	leave at least this long between queries
 	-x pat		exclude mailboxes matching pattern
 	-I file		file contains a list of mailbox patterns, 1 per line
 	-X file		file contains a list of patterns to exclude
+	-j n		download over n connections in parallel
 	--pw paswd	password on command line (not recommended)
+	--batch n	download at most n messages per fetch (default 100)
+	--batch-size n	download at most n bytes per fetch (default 10M)
+	--max-conn n	never open more than n connections (default 8)
+	--retries n	if the connection is lost, log in again and carry
+			on, up to n times per mailbox (default 5)
+	--full		check every message, not just those new since the
+			last download
+	--metadata fmt	keep message metadata as 'text' (the default) or
+			'sqlite'; existing metadata is converted
+	--cache dir	remember what list has shown in dir, so it only
+			fetches new messages (default ~/.imap_cache)
+	--since date	download or list only messages since date, given
+			as YYYY-MM-DD or as days ago, e.g. 7d
+	--before date	only messages from before date
+	--larger n	only messages larger than n bytes, e.g. 1M
+	--smaller n	only messages smaller than n bytes
+	--search keys	only messages matching these IMAP SEARCH keys,
+			e.g. 'FROM "boss" UNSEEN'
+	--max-part n	download messages without their attachments and
+			other MIME parts larger than n bytes, e.g. 1M;
+			the fill command gets them later
+	--durable	make downloads safe against crashes: messages and
+			their metadata are synced to disk together, every
+			--sync-messages n (default 500) messages or
+			--sync-seconds s (default 5) seconds
+	--no-compress	don't use COMPRESS=DEFLATE even if the server has it
+	--rate n	transfer at most n messages per second
+	--bandwidth n	transfer at most n bytes per second, e.g. 500k
+			Transfers slow down by themselves when the server
+			says it is busy or gets slow, and speed up again
+			when it recovers.
+	--stats	print command timings and byte counts at the end
+	--stats-json file
+			write them to file as JSON at the end
+	--stats-log file
+			append them to file as a line of JSON every
+			--stats-interval seconds (default 10)
+	--store fmt	store new mailboxes as 'dir', one file per message
+			(the default), 'pack', compressed segment files, or
+			'cas', one copy of each message shared by all
+			mailboxes
+
+	--dest user[@host[:port]]
+			destination account for the migrate command
+	--dest-pw paswd	destination password on command line
+	--dest-ssl	use ssl/tls for the destination
 
 	--help		this list
 
@@ -38,11 +85,18 @@ Usage:  imap [options] command [arguments]
 
     commands:
 
-	probe <user@host>	Guess imap server
+	probe <user@host>	Guess imap server; the result is remembered
+			in ~/.imap_probe and used when only user@domain is given
 	listboxes		List user mailboxes
 	list [mailboxes]	List messages in given mailbox(es); default is INBOX
 	download [mailboxes]	Download emails; -d option required; default is all mailboxes
 	upload mailboxes	Upload emails; -d option required
+	compact [mailboxes]	Compact local metadata and packs; -d option required
+	convert [mailboxes]	Convert local mailboxes to the --store format
+	migrate [mailboxes]	Copy mailboxes straight to the --dest account;
+			default is all mailboxes
+	fill [mailboxes]	Download the parts left out by --max-part;
+			-d option required
 
     examples:
       Figure out where your imap server is:
@@ -63,6 +117,9 @@ Usage:  imap [options] command [arguments]
       Upload mailbox
 	imap.py -u user@mail.example.com:993 -d ./LocalMail upload vacation
 
+      Copy all mailboxes from one server to another
+	imap.py -u user@mail.example.com:993 --dest user@mail.newhost.com:993 migrate
+
 Exit codes:
 
 	0 - successful return
@@ -88,6 +145,25 @@ import re
 import types
 import fnmatch
 import ast
+import threading
+import Queue
+import tempfile
+import random
+import zlib
+import hashlib
+import json
+import bisect
+try:
+  import sqlite3
+except ImportError:
+  sqlite3 = None
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
 
 # Numeric flag values. Most important flags have higher values
 MBOX_MARKED = 0x1
@@ -122,6 +198,91 @@ deleteFirst = False
 force = False
 includes = []
 excludes = []
+batchCount = 100
+batchBytes = 10*1024*1024
+jobs = 1
+maxConn = 8
+fullCheck = False
+chunkSize = 64*1024
+msgIdChunk = 5000
+statusChunk = 100
+snapshotMin = 100
+probeCacheFile = os.path.expanduser('~/.imap_probe')
+cacheDir = os.path.expanduser('~/.imap_cache')
+compress = True
+deflateStreams = []
+storeFormat = None
+segmentSize = 256*1024*1024
+casPools = {}
+destUser = None
+destPasswd = None
+destSsl = None
+maxRate = None
+maxBandwidth = None
+throttle = None
+throttleRetries = 5
+reconnectTries = 5
+maxBackoff = 60.0
+uploadsStarted = set()
+searchKeys = []
+maxPart = None
+syncMessages = 500
+syncSeconds = 5.0
+syncGroup = None
+stats = None
+statsSummary = False
+statsFile = None
+statsLog = None
+statsInterval = 10.0
+statsLogger = None
+metadataFormat = None
+
+# Held while writing metadata; MboxDownload takes it again to write state
+metadataLock = threading.RLock()
+
+umask = os.umask(0)
+os.umask(umask)
+
+# Tabs and line breaks, which can't go in an EnvelopeCache field
+whitespaceRe = re.compile(r'[\t\r\n]+')
+
+envelopeParser = email.parser.HeaderParser()
+
+# Untagged FETCH response, and a line that ends with a literal
+fetchRe = re.compile(r'\* (\d+) FETCH (.*)$')
+literalRe = re.compile(r'\{(\d+)\}$')
+
+# Tokens in a FETCH response: '(', ')', quoted string, literal, or an
+# atom, number or NIL. An atom may have a section and partial range
+# such as BODY[HEADER.FIELDS (MESSAGE-ID)]<0>.
+fetchTokenRe = re.compile(r'''[ ]*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\{(\d+)\}$|
+  ([^ ()"{\[\]]+(?:\[[^\]]*\](?:<[^>]*>)?)?))''', re.X)
+quotedCharRe = re.compile(r'\\(.)')
+
+# The Message-Id in a header block, and the <...> part of a Message-Id
+msgIdHeaderRe = re.compile(r'^Message-Id:\s*(<[^>]*>|\S+)', re.I | re.M)
+msgIdRe = re.compile(r'<[^>]*>')
+
+# The UIDs given to appended messages (RFC 4315)
+appendUidRe = re.compile(r'\[APPENDUID (\d+) ([\d:,]+)\]', re.I)
+
+# Response texts that mean we should slow down
+throttleRe = re.compile(r'\[(UNAVAILABLE|LIMIT|INUSE|THROTTLED|OVERQUOTA)\]|'
+  r'throttl|too many|rate limit|try again later', re.I)
+
+# For dates in SEARCH keys, whatever the locale
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+  'Oct', 'Nov', 'Dec')
+
+# Mailbox state recorded after each download
+STATE_KEYS = ('UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ')
+
+# Mailbox state as of the last batch downloaded, while a download is
+# under way
+CHECKPOINT = 'checkpoint'
+
+# RFC 4978; imaplib refuses commands it doesn't know
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
 
 class Mbox(object):
   """This object represents one mailbox. Its constructor accepts
@@ -139,6 +300,8 @@ class Mbox(object):
     self.separator = resp[1]
     self.name = resp[2]
     self.flags = self.mboxFlags()
+    # STATUS from the planning pass, if there was one
+    self.status = None
 
   def mboxFlags(self):
     flaglist = self.flaglist
@@ -206,6 +369,1632 @@ class Mbox(object):
     return not self == other
 
 
+class ProbeAttempt(threading.Thread):
+  '''One connection attempt made by the probe command. Any connection
+  made after cancel() is closed again straight away.'''
+  def __init__(self, host, port, ssl):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.host = host
+    self.port = port
+    self.ssl = ssl
+    self.srvr = None
+    self.cancelled = False
+    self.lock = threading.Lock()
+
+  def run(self):
+    try:
+      if self.ssl:
+	srvr = imaplib.IMAP4_SSL(self.host, self.port)
+      else:
+	srvr = imaplib.IMAP4(self.host, self.port)
+    except (socket.error, imaplib.IMAP4.error):
+      return
+    with self.lock:
+      if self.cancelled:
+	srvr.shutdown()
+      else:
+	self.srvr = srvr
+
+  def cancel(self):
+    with self.lock:
+      self.cancelled = True
+      if self.srvr:
+	self.srvr.shutdown()
+	self.srvr = None
+
+
+class MboxDownload(object):
+  '''A mailbox being downloaded in batches, in UID order. Its state is
+  recorded once the last of its batches is in, unless one failed. Until
+  then, a checkpoint records how far the batches have got without a
+  gap, so a download that is cut short can carry on from there. With
+  state None, as when only some messages are wanted, neither is
+  recorded. With --durable, both wait for the next sync.'''
+  def __init__(self, metadata, store, state, batches):
+    self.metadata = metadata
+    self.store = store
+    self.state = state
+    self.pending = len(batches)
+    self.failed = False
+    self.lastUids = [batch[-1]['UID'] for batch in batches]
+    self.doneUids = set()
+    self.next = 0
+    if not batches:
+      self.finish()
+
+  def batchDone(self, batch, ok):
+    with metadataLock:
+      self.pending -= 1
+      if ok:
+	self.doneUids.add(batch[-1]['UID'])
+      else:
+	self.failed = True
+      if self.pending == 0 and not self.failed:
+	self.finish()
+	return
+      done = self.next
+      while self.next < len(self.lastUids) and \
+	  self.lastUids[self.next] in self.doneUids:
+	self.next += 1
+      if self.next > done and self.state is not None:
+	state = dict(self.state, UIDNEXT=self.lastUids[self.next-1] + 1)
+	afterSync(self.store, self.metadata,
+		  lambda: writeCheckpoint(self.store.dir, state))
+
+  def finish(self):
+    if self.state is not None:
+      afterSync(self.store, self.metadata, self.writeState)
+
+  def writeState(self):
+    self.metadata.writeState(self.state)
+    removeCheckpoint(self.store.dir)
+
+
+class SyncGroup(object):
+  '''With --durable, the work that has to wait until the messages
+  stored since the last sync are on disk: recording them in the
+  metadata, and the checkpoints and states that follow from that. A
+  sync, every syncMessages messages or syncSeconds seconds, makes the
+  stores durable, then does that work and makes the metadata durable,
+  so a crash can't leave metadata for a message that isn't all there.
+  That is a few fsyncs per group instead of one per message.'''
+  def __init__(self, messages, seconds):
+    self.messages = messages
+    self.seconds = seconds
+    self.stores = []
+    self.metadata = []
+    self.actions = []
+    self.count = 0
+    self.started = None
+
+  def add(self, store, metadata, action, nmsgs=0):
+    '''Call action() after the next sync of store, then sync metadata.
+    nmsgs is how many messages it records.'''
+    with metadataLock:
+      if store not in self.stores:
+	self.stores.append(store)
+      if metadata not in self.metadata:
+	self.metadata.append(metadata)
+      self.actions.append(action)
+      self.count += nmsgs
+      if self.started is None:
+	self.started = time.time()
+      if self.count >= self.messages or \
+	  time.time() - self.started >= self.seconds:
+	self.sync()
+
+  def sync(self):
+    '''Sync the stores, do what was waiting, and sync the metadata.'''
+    with metadataLock:
+      if not self.actions:
+	return
+      with StatsTimer('sync'):
+	for store in self.stores:
+	  store.sync()
+	for action in self.actions:
+	  action()
+	for metadata in self.metadata:
+	  metadata.sync()
+      self.stores = []
+      self.metadata = []
+      self.actions = []
+      self.count = 0
+      self.started = None
+
+
+class TextMetadata(object):
+  '''Message metadata kept in a tab-separated text file, which is only
+  ever appended to. A later line for a UID replaces earlier ones, and
+  the last line may record the mailbox state. Messages downloaded
+  without some of their parts have a fifth column listing the holes.'''
+  NAME = 'metadata'
+
+  def __init__(self, mboxDir):
+    self.filename = os.path.join(mboxDir, self.NAME)
+    self.ofile = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def _write(self, lines):
+    with metadataLock:
+      if self.ofile is None:
+	needHeader = not os.path.exists(self.filename)
+	self.ofile = open(self.filename, "a")
+	if needHeader:
+	  print >>self.ofile, '# msgno  UID  msgid  FLAGS'
+      self.ofile.writelines(lines)
+      self.ofile.flush()
+
+  @staticmethod
+  def _line(msg):
+    line = '%d\t%d\t%s\t%s' % \
+      (msg['msgno'], msg['UID'], msg['msgid'], msg['FLAGS'])
+    if msg.get('holes'):
+      line += '\t' + formatHoles(msg['holes'])
+    return line + '\n'
+
+  def add(self, messages):
+    '''Record messages, each a dict with msgno, UID, msgid and FLAGS,
+    and holes if parts of it were left out.'''
+    self._write(map(self._line, messages))
+
+  def setFlags(self, messages):
+    '''Record new flags and message numbers for messages we already
+    have. The msgids and holes have to come from the file.'''
+    known = dict((msg['UID'], msg) for msg in self.messages())
+    self.add([dict(msg, msgid=known[msg['UID']]['msgid'],
+		   holes=known[msg['UID']].get('holes'))
+	      for msg in messages if msg['UID'] in known])
+
+  def holes(self):
+    '''Return a dict mapping the UIDs of the messages with holes to
+    their holes.'''
+    return dict((msg['UID'], msg['holes']) for msg in self.messages()
+		if msg.get('holes'))
+
+  def lookup(self, msgIds):
+    '''Return the set of UIDs of the messages whose normalized msgid is
+    in msgIds.'''
+    return set(msg['UID'] for msg in self.messages()
+	       if normalizeMsgId(msg['msgid']) in msgIds)
+
+  def recorded(self, uids):
+    '''Return the set of those UIDs that have been recorded.'''
+    return set(msg['UID'] for msg in self.messages()) & set(uids)
+
+  def messages(self):
+    '''Return all messages in UID order.'''
+    if not os.path.exists(self.filename):
+      return []
+    return readMetadata(self.filename)
+
+  def readState(self):
+    '''Return the state saved at the end of the last complete download
+    of this mailbox, or None. It's the last line of the file, so only
+    the end of the file is read.'''
+    try:
+      with open(self.filename, "r") as ifile:
+	ifile.seek(0, 2)
+	ifile.seek(max(0, ifile.tell() - 1024))
+	lines = ifile.read().splitlines()
+    except IOError:
+      return None
+    if not lines or not lines[-1].startswith('# state '):
+      return None
+    words = lines[-1].split()[2:]
+    try:
+      return dict((words[i], int(words[i+1]))
+		  for i in xrange(0, len(words)-1, 2))
+    except ValueError:
+      return None
+
+  def writeState(self, state):
+    '''Append the mailbox state. Only the last line counts; anything
+    written after it invalidates it.'''
+    if 'UIDVALIDITY' not in state or 'UIDNEXT' not in state:
+      return
+    self._write(['# state %s\n' % ' '.join('%s %d' % (key, state[key])
+		 for key in STATE_KEYS if key in state)])
+
+  def compact(self):
+    '''Rewrite the file with one line per message.'''
+    if not os.path.exists(self.filename):
+      return
+    with metadataLock:
+      messages = self.messages()
+      state = self.readState()
+      self.close()
+      tmpName = self.filename + '.tmp'
+      with open(tmpName, "w") as ofile:
+	print >>ofile, '# msgno  UID  msgid  FLAGS'
+	ofile.writelines(map(self._line, messages))
+      os.rename(tmpName, self.filename)
+      if state:
+	self.writeState(state)
+
+  def sync(self):
+    '''Make what has been written durable.'''
+    with metadataLock:
+      if self.ofile is not None:
+	syncFiles([self.filename])
+
+  def close(self):
+    with metadataLock:
+      if self.ofile is not None:
+	self.ofile.close()
+	self.ofile = None
+
+
+class SqlMetadata(object):
+  '''Message metadata kept in an SQLite database, indexed by UID and by
+  msgid. Flags are updated in place, so the file doesn't grow with
+  every download. Msgids are kept normalized, so the index finds them.'''
+  NAME = 'metadata.db'
+  SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS messages (
+      uid INTEGER PRIMARY KEY, msgno INTEGER, msgid TEXT, flags TEXT,
+      holes TEXT);
+    CREATE INDEX IF NOT EXISTS messages_msgid ON messages (msgid);
+    CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER);
+  '''
+  VERSION = 1
+  # Host parameters per statement; SQLite allows 999
+  CHUNK = 500
+
+  def __init__(self, mboxDir):
+    if sqlite3 is None:
+      raise IOError('sqlite3 module not available')
+    self.filename = os.path.join(mboxDir, self.NAME)
+    self.db = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def _connect(self, create=True):
+    '''Return the database connection, or None if the database doesn't
+    exist and create is False.'''
+    if self.db is None:
+      if not create and not os.path.exists(self.filename):
+	return None
+      # Connections are shared between download threads; metadataLock
+      # keeps them from using it at the same time.
+      self.db = sqlite3.connect(self.filename, check_same_thread=False)
+      self.db.text_factory = str
+      self.db.executescript(self.SCHEMA)
+      if self.db.execute('PRAGMA user_version').fetchone()[0] < self.VERSION:
+	self._upgrade()
+    return self.db
+
+  def _upgrade(self):
+    '''Bring a database from an earlier version up to date, once.'''
+    # Databases from before --max-part have no holes column
+    if 'holes' not in [row[1] for row in
+		       self.db.execute('PRAGMA table_info(messages)')]:
+      self.db.execute('ALTER TABLE messages ADD COLUMN holes TEXT')
+    self.db.executemany('UPDATE messages SET msgid = ? WHERE uid = ?',
+      [(normalizeMsgId(msgid), uid) for uid, msgid in
+       self.db.execute('SELECT uid, msgid FROM messages').fetchall()])
+    self.db.execute('PRAGMA user_version = %d' % self.VERSION)
+    self.db.commit()
+
+  def add(self, messages):
+    '''Record messages, each a dict with msgno, UID, msgid and FLAGS,
+    and holes if parts of it were left out.'''
+    with metadataLock:
+      db = self._connect()
+      db.execute('DELETE FROM state')
+      db.executemany('INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)',
+	[(msg['UID'], msg['msgno'], normalizeMsgId(str(msg['msgid'])),
+	  ' '.join(msg['FLAGS']),
+	  formatHoles(msg['holes']) if msg.get('holes') else None)
+	 for msg in messages])
+      db.commit()
+
+  def setFlags(self, messages):
+    '''Update the flags and message numbers of messages we already have.'''
+    with metadataLock:
+      db = self._connect()
+      db.execute('DELETE FROM state')
+      db.executemany('UPDATE messages SET msgno = ?, flags = ? WHERE uid = ?',
+	[(msg['msgno'], ' '.join(msg['FLAGS']), msg['UID'])
+	 for msg in messages])
+      db.commit()
+
+  def holes(self):
+    '''Return a dict mapping the UIDs of the messages with holes to
+    their holes.'''
+    with metadataLock:
+      db = self._connect(False)
+      if db is None:
+	return {}
+      return dict((uid, parseHoles(holes)) for uid, holes in
+	db.execute('SELECT uid, holes FROM messages WHERE holes IS NOT NULL'))
+
+  def lookup(self, msgIds):
+    '''Return the set of UIDs of the messages whose normalized msgid is
+    in msgIds.'''
+    return self._select('SELECT uid FROM messages WHERE msgid IN (%s)',
+			list(msgIds))
+
+  def recorded(self, uids):
+    '''Return the set of those UIDs that have been recorded.'''
+    return self._select('SELECT uid FROM messages WHERE uid IN (%s)',
+			list(uids))
+
+  def _select(self, query, values):
+    '''Run query for CHUNK values at a time, and return the set of the
+    first column of the rows.'''
+    found = set()
+    with metadataLock:
+      db = self._connect(False)
+      if db is None:
+	return found
+      for i in xrange(0, len(values), self.CHUNK):
+	chunk = values[i:i+self.CHUNK]
+	found.update(row[0] for row in
+	  db.execute(query % ','.join('?' * len(chunk)), chunk))
+    return found
+
+  def messages(self):
+    '''Yield all messages in UID order.'''
+    db = self._connect(False)
+    if db is None:
+      return
+    for uid, msgno, msgid, flags, holes in db.execute(
+	'SELECT uid, msgno, msgid, flags, holes FROM messages ORDER BY uid'):
+      msg = {'UID': uid, 'msgno': msgno, 'msgid': msgid,
+	     'FLAGS': flags.split()}
+      if holes:
+	msg['holes'] = parseHoles(holes)
+      yield msg
+
+  def readState(self):
+    '''Return the state saved at the end of the last complete download
+    of this mailbox, or None.'''
+    with metadataLock:
+      db = self._connect(False)
+      if db is None:
+	return None
+      state = dict(db.execute('SELECT key, value FROM state'))
+    if 'UIDVALIDITY' not in state or 'UIDNEXT' not in state:
+      return None
+    return state
+
+  def writeState(self, state):
+    '''Record the mailbox state. Adding messages or flags clears it.'''
+    if 'UIDVALIDITY' not in state or 'UIDNEXT' not in state:
+      return
+    with metadataLock:
+      db = self._connect()
+      db.execute('DELETE FROM state')
+      db.executemany('INSERT INTO state VALUES (?, ?)',
+	[(key, state[key]) for key in STATE_KEYS if key in state])
+      db.commit()
+
+  def compact(self):
+    '''Give the space of deleted rows back to the filesystem.'''
+    with metadataLock:
+      db = self._connect(False)
+      if db is not None:
+	db.execute('VACUUM')
+
+  def sync(self):
+    '''Nothing to do; SQLite makes each commit durable itself.'''
+    pass
+
+  def close(self):
+    with metadataLock:
+      if self.db is not None:
+	self.db.close()
+	self.db = None
+
+
+metadataFormats = {'text': TextMetadata, 'sqlite': SqlMetadata}
+
+
+class UploadJournal(object):
+  '''The messages of a local mailbox that have been uploaded to one
+  server mailbox, kept in an append-only text file in the mailbox
+  directory, one per destination. It only counts while the server
+  mailbox keeps the UIDVALIDITY it was started with. Each line is a
+  local UID and the server UID it was given, if the server said;
+  '# high' lines record the highest server UID after each batch.'''
+  PREFIX = 'upload.'
+
+  def __init__(self, mboxDir, dest):
+    self.dest = dest
+    self.filename = os.path.join(mboxDir,
+      self.PREFIX + hashlib.sha1(dest).hexdigest()[:16])
+    self.uidvalidity = None
+    self.uploaded = set()
+    self.high = 0
+    self.ofile = None
+    try:
+      with open(self.filename, "r") as ifile:
+	for line in ifile:
+	  words = line.split()
+	  if line.startswith('# upload ') and len(words) == 5:
+	    self.uidvalidity = int(words[4])
+	  elif line.startswith('# high ') and len(words) == 3:
+	    self.high = max(self.high, int(words[2]))
+	  elif len(words) == 2 and words[0].isdigit():
+	    self.uploaded.add(int(words[0]))
+	    if words[1].isdigit():
+	      self.high = max(self.high, int(words[1]))
+    except (IOError, ValueError):
+      self.uidvalidity = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def reset(self, uidvalidity):
+    '''Start again, for a server mailbox with this UIDVALIDITY.'''
+    self.close()
+    self.uidvalidity = uidvalidity
+    self.uploaded = set()
+    self.high = 0
+    self.ofile = open(self.filename, "w")
+    print >>self.ofile, '# upload %s UIDVALIDITY %d' % (self.dest, uidvalidity)
+    self.ofile.flush()
+
+  def add(self, uids, high=None):
+    '''Record uploaded messages, a list of (local UID, server UID or
+    None) pairs, and the highest server UID if known.'''
+    if self.ofile is None:
+      if self.uidvalidity is None:
+	return
+      self.ofile = open(self.filename, "a")
+    for uid, serverUid in uids:
+      self.uploaded.add(uid)
+      print >>self.ofile, '%d\t%s' % (uid, serverUid or '-')
+      self.high = max(self.high, serverUid)
+    if high:
+      print >>self.ofile, '# high %d' % high
+      self.high = max(self.high, high)
+    self.ofile.flush()
+
+  def close(self):
+    if self.ofile is not None:
+      self.ofile.close()
+      self.ofile = None
+
+
+class EnvelopeCache(object):
+  '''The UID, subject, sender and date of each message in a server
+  mailbox, as shown by the list command, so that listing it again only
+  fetches the messages that are new. Kept in a text file in cacheDir,
+  one per server mailbox, valid while the mailbox keeps the same
+  UIDVALIDITY. Each line is a UID and the three fields, separated by
+  tabs. If the file can't be written, that is reported once and the
+  cache only lasts as long as the listing.'''
+  def __init__(self, key):
+    global cacheDir
+    self.key = key
+    self.filename = os.path.join(cacheDir, hashlib.sha1(key).hexdigest()[:16])
+    self.uidvalidity = None
+    self.rows = {}
+    self.ofile = None
+    self.failed = False
+    try:
+      with open(self.filename, "r") as ifile:
+	for line in ifile:
+	  words = line.rstrip('\n').split('\t')
+	  if line.startswith('# envelopes '):
+	    self.uidvalidity = int(line.split()[-1])
+	  elif len(words) == 4 and words[0].isdigit():
+	    self.rows[int(words[0])] = tuple(words[1:])
+    except (IOError, ValueError):
+      self.uidvalidity = None
+      self.rows = {}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def reset(self, uidvalidity):
+    '''Start again, for a mailbox with this UIDVALIDITY.'''
+    self.close()
+    self.uidvalidity = uidvalidity
+    self.rows = {}
+    self.write()
+
+  def keep(self, uids):
+    '''Forget the messages whose UIDs are not in uids.'''
+    uids = set(uids)
+    gone = [uid for uid in self.rows if uid not in uids]
+    if gone:
+      for uid in gone:
+	del self.rows[uid]
+      self.close()
+      self.write()
+
+  def write(self):
+    '''Write the whole cache, by way of a temporary file.'''
+    if self.failed:
+      return
+    try:
+      if not os.path.isdir(cacheDir):
+	# It has subjects and senders in it
+	os.makedirs(cacheDir, 0700)
+      tmp = self.filename + '.tmp'
+      with open(tmp, "w") as ofile:
+	print >>ofile, '# envelopes %s UIDVALIDITY %d' % (self.key,
+							  self.uidvalidity)
+	for uid in sorted(self.rows):
+	  print >>ofile, '%d\t%s' % (uid, '\t'.join(self.rows[uid]))
+      os.rename(tmp, self.filename)
+    except EnvironmentError as e:
+      self.fail(e)
+
+  def add(self, uid, row):
+    '''Remember a message: row is its subject, sender and date, with no
+    tabs or line breaks.'''
+    self.rows[uid] = row
+    if self.failed:
+      return
+    try:
+      if self.ofile is None:
+	self.ofile = open(self.filename, "a")
+      print >>self.ofile, '%d\t%s' % (uid, '\t'.join(row))
+    except EnvironmentError as e:
+      self.fail(e)
+
+  def fail(self, e):
+    '''Give up on writing the cache file.'''
+    print >>sys.stderr, 'Unable to write %s: %s' % (self.filename, e)
+    self.failed = True
+    self.close()
+
+  def close(self):
+    if self.ofile is not None:
+      ofile, self.ofile = self.ofile, None
+      try:
+	ofile.close()
+      except EnvironmentError as e:
+	self.fail(e)
+
+
+class DirStore(object):
+  '''Messages stored one per file, named u<UID>, in the mailbox
+  directory.'''
+  def __init__(self, mboxDir):
+    self.dir = mboxDir
+    self.spoolDir = mboxDir
+    self.unsynced = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def path(self, uid):
+    return os.path.join(self.dir, 'u%d' % uid)
+
+  def sizes(self, uids):
+    '''Return a dict mapping UID to size for those of uids we have.'''
+    if len(uids) >= snapshotMin:
+      return snapshotMbox(self.dir)
+    # Not worth reading the whole directory for a few new messages
+    sizes = {}
+    for uid in uids:
+      try:
+	sizes[uid] = os.path.getsize(self.path(uid))
+      except OSError:
+	pass
+    return sizes
+
+  def size(self, uid):
+    return os.path.getsize(self.path(uid))
+
+  def uids(self):
+    return sorted(snapshotMbox(self.dir))
+
+  def open(self, uid):
+    '''Return a file object to read a message from.'''
+    return open(self.path(uid), "rb")
+
+  def put(self, uid, path, msgid=None):
+    '''Store a message from a temporary file, which is used up.'''
+    global syncGroup
+    os.rename(path, self.path(uid))
+    # Only --durable ever syncs; without it the list would just grow
+    if syncGroup:
+      self.unsynced.append(self.path(uid))
+
+  def sync(self):
+    '''Make the messages stored since the last sync durable.'''
+    paths, self.unsynced = self.unsynced, []
+    syncFiles(paths)
+
+  def write(self, uid, ifile):
+    '''Store a message read from a file object.'''
+    fd, path = tempfile.mkstemp(prefix='.download', dir=self.dir)
+    os.fchmod(fd, 0666 & ~umask)
+    try:
+      with os.fdopen(fd, "wb") as ofile:
+	copyFile(ifile, ofile)
+    except:
+      os.unlink(path)
+      raise
+    self.put(uid, path)
+
+  def remove(self):
+    '''Delete all the messages.'''
+    for uid in self.uids():
+      os.unlink(self.path(uid))
+
+  def close(self):
+    pass
+
+
+class PackStore(object):
+  '''Messages stored zlib-compressed, one after another, in segment
+  files of up to segmentSize bytes, in the mailbox directory. The index
+  file has a line per message: UID, segment, offset, compressed size
+  and size. A later line for a UID replaces earlier ones.'''
+  INDEX = 'pack.idx'
+
+  def __init__(self, mboxDir):
+    self.dir = mboxDir
+    self.spoolDir = mboxDir
+    self.index = {}
+    self.segno = 0
+    self.segment = None
+    self.indexFile = None
+    self.unsynced = set()
+    self.lock = threading.Lock()
+    try:
+      with open(os.path.join(mboxDir, self.INDEX), "r") as ifile:
+	for line in ifile:
+	  try:
+	    uid, segno, offset, clen, size = map(int, line.split())
+	  except ValueError:
+	    continue
+	  self.index[uid] = (segno, offset, clen, size)
+	  self.segno = max(self.segno, segno)
+    except IOError:
+      pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def segmentName(self, segno):
+    return os.path.join(self.dir, 'pack%04d.z' % segno)
+
+  def sizes(self, uids):
+    return dict((uid, entry[3]) for uid, entry in self.index.iteritems())
+
+  def size(self, uid):
+    return self.index[uid][3]
+
+  def uids(self):
+    return sorted(self.index)
+
+  def open(self, uid):
+    segno, offset, clen, size = self.index[uid]
+    return PackReader(self.segmentName(segno), offset, clen)
+
+  def put(self, uid, path, msgid=None):
+    with open(path, "rb") as ifile:
+      self.write(uid, ifile)
+    os.unlink(path)
+
+  def write(self, uid, ifile):
+    global chunkSize, segmentSize, syncGroup
+    with self.lock:
+      if self.segment is None:
+	self.segment = open(self.segmentName(self.segno), "ab")
+	self.segment.seek(0, 2)
+      if self.segment.tell() >= segmentSize:
+	self.segment.close()
+	self.segno += 1
+	self.segment = open(self.segmentName(self.segno), "ab")
+      if self.indexFile is None:
+	self.indexFile = open(os.path.join(self.dir, self.INDEX), "a")
+      offset = self.segment.tell()
+      deflate = zlib.compressobj()
+      size = 0
+      while True:
+	chunk = ifile.read(chunkSize)
+	if not chunk:
+	  break
+	size += len(chunk)
+	self.segment.write(deflate.compress(chunk))
+      self.segment.write(deflate.flush())
+      self.segment.flush()
+      clen = self.segment.tell() - offset
+      # The index only refers to data that is already written
+      print >>self.indexFile, uid, self.segno, offset, clen, size
+      self.indexFile.flush()
+      self.index[uid] = (self.segno, offset, clen, size)
+      if syncGroup:
+	self.unsynced.update((self.segment.name, self.indexFile.name))
+
+  def sync(self):
+    '''Make the messages stored since the last sync durable.'''
+    with self.lock:
+      paths, self.unsynced = self.unsynced, set()
+    syncFiles(sorted(paths))
+
+  def remove(self):
+    self.close()
+    for segno in sorted(set(entry[0] for entry in self.index.itervalues())):
+      os.unlink(self.segmentName(segno))
+    os.unlink(os.path.join(self.dir, self.INDEX))
+    self.index = {}
+
+  def compact(self):
+    '''Copy the messages in the index to new segments, leaving out the
+    copies that were replaced, and return the segment bytes before and
+    after. The old segments are only removed once the new index is on
+    disk.'''
+    global chunkSize, segmentSize
+    self.close()
+    with self.lock:
+      old = sorted(set(entry[0] for entry in self.index.itervalues()))
+      before = sum(os.path.getsize(self.segmentName(segno))
+		   for segno in old if os.path.exists(self.segmentName(segno)))
+      if sum(entry[2] for entry in self.index.itervalues()) == before:
+	return before, before
+      # New segments get new numbers, so the old index stays valid
+      segno = self.segno + 1
+      index = {}
+      paths = []
+      ofile = None
+      try:
+	for uid, entry in sorted(self.index.iteritems(),
+				 key=lambda item: item[1][:2]):
+	  if ofile is None or ofile.tell() >= segmentSize:
+	    if ofile is not None:
+	      ofile.close()
+	      segno += 1
+	    ofile = open(self.segmentName(segno), "wb")
+	    paths.append(ofile.name)
+	  offset = ofile.tell()
+	  with open(self.segmentName(entry[0]), "rb") as ifile:
+	    ifile.seek(entry[1])
+	    remaining = entry[2]
+	    while remaining > 0:
+	      data = ifile.read(min(remaining, chunkSize))
+	      if not data:
+		raise IOError('%s: segment is truncated' % ifile.name)
+	      ofile.write(data)
+	      remaining -= len(data)
+	  index[uid] = (segno, offset, entry[2], entry[3])
+      finally:
+	if ofile is not None:
+	  ofile.close()
+      tmpName = os.path.join(self.dir, self.INDEX + '.tmp')
+      with open(tmpName, "w") as ofile:
+	for uid in sorted(index):
+	  print >>ofile, uid, ' '.join(map(str, index[uid]))
+      syncFiles(paths + [tmpName])
+      os.rename(tmpName, os.path.join(self.dir, self.INDEX))
+      syncFiles([os.path.join(self.dir, self.INDEX)])
+      for n in old:
+	if os.path.exists(self.segmentName(n)):
+	  os.unlink(self.segmentName(n))
+      self.index = index
+      self.segno = segno
+      return before, sum(os.path.getsize(path) for path in paths)
+
+  def close(self):
+    with self.lock:
+      for f in (self.segment, self.indexFile):
+	if f is not None:
+	  f.close()
+      self.segment = None
+      self.indexFile = None
+
+
+class PackReader(object):
+  '''File object to read one message from a PackStore segment.'''
+  def __init__(self, path, offset, clen):
+    self.file = open(path, "rb")
+    self.file.seek(offset)
+    self.remaining = clen
+    self.inflate = zlib.decompressobj()
+    self.buf = ''
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def read(self, size=-1):
+    global chunkSize
+    parts = []
+    want = size
+    while want != 0:
+      if not self.buf:
+	if self.remaining <= 0:
+	  break
+	data = self.file.read(min(self.remaining, chunkSize))
+	if not data:
+	  raise IOError('%s: segment is truncated' % self.file.name)
+	self.remaining -= len(data)
+	self.buf = self.inflate.decompress(data)
+	if self.remaining <= 0:
+	  self.buf += self.inflate.flush()
+	continue
+      part = self.buf if want < 0 else self.buf[:want]
+      self.buf = self.buf[len(part):]
+      parts.append(part)
+      if want > 0:
+	want -= len(part)
+    return ''.join(parts)
+
+  def close(self):
+    self.file.close()
+
+
+class CasPool(object):
+  '''Message files shared by all the mailboxes in a CasStore, named by
+  the SHA-1 of their contents. The index file maps Message-Id and size
+  to SHA-1, so that a message can be found before it is downloaded.'''
+  DIR = '.objects'
+  INDEX = 'msgid.idx'
+
+  def __init__(self, poolDir):
+    self.dir = poolDir
+    self.byMsgId = {}
+    self.indexFile = None
+    self.unsynced = set()
+    self.lock = threading.Lock()
+    if not os.path.isdir(poolDir):
+      os.makedirs(poolDir)
+    # Left over from an interrupted download
+    snapshotMbox(poolDir)
+    try:
+      with open(os.path.join(poolDir, self.INDEX), "r") as ifile:
+	for line in ifile:
+	  words = line.split(None, 2)
+	  if len(words) == 3 and words[1].isdigit():
+	    self.byMsgId[(words[2].strip(), int(words[1]))] = words[0]
+    except IOError:
+      pass
+
+  def path(self, digest):
+    return os.path.join(self.dir, digest[:2], digest[2:])
+
+  def lookup(self, msgid, size):
+    '''Return the SHA-1 of the message with this Message-Id and size.'''
+    return self.byMsgId.get((msgid, size))
+
+  def add(self, path, msgid):
+    '''Add a message from a temporary file, which is used up, unless
+    it's already here. Return its SHA-1 and size.'''
+    global syncGroup
+    digest, size = fileDigest(path)
+    target = self.path(digest)
+    with self.lock:
+      if os.path.exists(target):
+	os.unlink(path)
+      else:
+	if not os.path.isdir(os.path.dirname(target)):
+	  os.mkdir(os.path.dirname(target))
+	  if syncGroup:
+	    self.unsynced.add(os.path.dirname(target))
+	os.rename(path, target)
+	if syncGroup:
+	  self.unsynced.add(target)
+      if msgid:
+	key = (normalizeMsgId(str(msgid)), size)
+	if key not in self.byMsgId:
+	  if self.indexFile is None:
+	    self.indexFile = open(os.path.join(self.dir, self.INDEX), "a")
+	  print >>self.indexFile, digest, size, key[0]
+	  self.indexFile.flush()
+	  if syncGroup:
+	    self.unsynced.add(self.indexFile.name)
+	  self.byMsgId[key] = digest
+    return digest, size
+
+  def sync(self):
+    '''Make the messages added since the last sync durable.'''
+    with self.lock:
+      paths, self.unsynced = self.unsynced, set()
+    syncFiles(sorted(paths))
+
+
+class CasStore(object):
+  '''Messages stored in a CasPool, shared with other mailboxes. The
+  index file in the mailbox directory maps UID to SHA-1 and size; a
+  later line for a UID replaces earlier ones.'''
+  INDEX = 'cas.idx'
+
+  def __init__(self, mboxDir):
+    self.dir = mboxDir
+    self.pool = casPool()
+    self.spoolDir = self.pool.dir
+    self.index = {}
+    self.indexFile = None
+    self.unsynced = False
+    self.lock = threading.Lock()
+    try:
+      with open(os.path.join(mboxDir, self.INDEX), "r") as ifile:
+	for line in ifile:
+	  words = line.split()
+	  if len(words) == 3 and words[0].isdigit() and words[2].isdigit():
+	    self.index[int(words[0])] = (words[1], int(words[2]))
+    except IOError:
+      pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def sizes(self, uids):
+    return dict((uid, entry[1]) for uid, entry in self.index.iteritems())
+
+  def size(self, uid):
+    return self.index[uid][1]
+
+  def uids(self):
+    return sorted(self.index)
+
+  def open(self, uid):
+    return open(self.pool.path(self.index[uid][0]), "rb")
+
+  def lookup(self, msgid, size):
+    return self.pool.lookup(msgid, size)
+
+  def link(self, uid, digest, size):
+    '''Record that message uid is the one stored as digest.'''
+    with self.lock:
+      if self.indexFile is None:
+	self.indexFile = open(os.path.join(self.dir, self.INDEX), "a")
+      print >>self.indexFile, uid, digest, size
+      self.indexFile.flush()
+      self.index[uid] = (digest, size)
+      self.unsynced = True
+
+  def sync(self):
+    '''Make the messages stored since the last sync durable, with the
+    pool files they refer to.'''
+    self.pool.sync()
+    with self.lock:
+      unsynced, self.unsynced = self.unsynced, False
+    if unsynced:
+      syncFiles([os.path.join(self.dir, self.INDEX)])
+
+  def put(self, uid, path, msgid=None):
+    digest, size = self.pool.add(path, msgid)
+    self.link(uid, digest, size)
+
+  def write(self, uid, ifile):
+    fd, path = tempfile.mkstemp(prefix='.download', dir=self.spoolDir)
+    os.fchmod(fd, 0666 & ~umask)
+    try:
+      with os.fdopen(fd, "wb") as ofile:
+	copyFile(ifile, ofile)
+    except:
+      os.unlink(path)
+      raise
+    self.put(uid, path)
+
+  def remove(self):
+    '''Forget the messages. Their files stay in the pool, since other
+    mailboxes may have them too.'''
+    self.close()
+    os.unlink(os.path.join(self.dir, self.INDEX))
+    self.index = {}
+
+  def close(self):
+    with self.lock:
+      if self.indexFile is not None:
+	self.indexFile.close()
+	self.indexFile = None
+
+
+storeFormats = {'dir': DirStore, 'pack': PackStore, 'cas': CasStore}
+
+
+class TokenBucket(object):
+  '''Allows rate units per second, in bursts of up to a second's worth.
+  A rate of None means no limit. After halve(), the rate grows back by
+  a tenth of the new rate per grow(), up to the configured limit, or
+  back to no limit at all if there was none.'''
+  def __init__(self, limit, floor):
+    self.limit = limit
+    self.floor = floor
+    self.rate = limit
+    self.tokens = limit or 0.0
+    self.stamp = time.time()
+    self.step = None
+    self.target = None
+
+  def take(self, n, now):
+    '''Take n units. Return how long to wait before using them.'''
+    if not self.rate:
+      return 0.0
+    self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+    self.stamp = now
+    self.tokens -= n
+    return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+  def halve(self, observed):
+    rate = self.rate or observed
+    if not rate:
+      return
+    if self.target is None:
+      self.target = self.limit or rate
+    self.rate = max(rate / 2.0, self.floor)
+    self.tokens = min(self.tokens, self.rate)
+    self.step = self.rate / 10.0
+
+  def grow(self):
+    if self.step is None:
+      return
+    self.rate += self.step
+    if self.rate >= self.target:
+      self.rate = self.limit
+      self.step = None
+      self.target = None
+
+
+class Throttle(object):
+  '''Rate control shared by all connections: token buckets for messages
+  and bytes per second, plus a minimum interval between queries (-w).
+  The rates are halved when the server complains or responses get much
+  slower than usual, and grow back each second that goes well.'''
+  SLOW = 4.0
+
+  def __init__(self, msgRate, byteRate, interval):
+    self.msgs = TokenBucket(msgRate, 0.1)
+    self.bytes = TokenBucket(byteRate, 1024.0)
+    self.interval = interval
+    self.next = 0.0
+    self.baseline = None
+    self.lastChange = 0.0
+    self.lastBackoff = 0.0
+    self.windowStart = time.time()
+    self.windowMsgs = 0
+    self.windowBytes = 0
+    self.msgRate = 0.0
+    self.byteRate = 0.0
+    self.lock = threading.Lock()
+
+  def wait(self, nmsgs, nbytes):
+    '''Wait until we may transfer nmsgs messages of nbytes bytes.'''
+    with self.lock:
+      now = time.time()
+      delay = max(self.msgs.take(nmsgs, now), self.bytes.take(nbytes, now),
+		  self.next - now)
+      self.next = now + max(delay, 0.0) + self.interval
+    if delay > 0:
+      with StatsTimer('throttle wait'):
+	time.sleep(delay)
+
+  def done(self, nmsgs, nbytes, elapsed):
+    '''A transfer has finished successfully after elapsed seconds.'''
+    with self.lock:
+      now = time.time()
+      self.windowMsgs += nmsgs
+      self.windowBytes += nbytes
+      if now - self.windowStart >= 1.0:
+	self.msgRate = self.windowMsgs / (now - self.windowStart)
+	self.byteRate = self.windowBytes / (now - self.windowStart)
+	self.windowStart = now
+	self.windowMsgs = 0
+	self.windowBytes = 0
+      # Seconds per unit of work, counting 64k as much work as a message
+      cost = elapsed / (nmsgs + nbytes / 65536.0 or 1)
+      if self.baseline is None or cost < self.baseline:
+	self.baseline = cost
+      if elapsed > 0.5 and cost > self.SLOW * self.baseline:
+	self._backoff('responses are slow')
+	# Let the baseline catch up if this is how fast the server is now
+	self.baseline *= 1.5
+      elif now - self.lastChange >= 1.0:
+	self.msgs.grow()
+	self.bytes.grow()
+	self.lastChange = now
+
+  def backoff(self, reason):
+    '''The server has told us to slow down.'''
+    with self.lock:
+      self._backoff(reason)
+
+  def _backoff(self, reason):
+    global verbose, stats
+    now = time.time()
+    if now - self.lastBackoff < 1.0:
+      # Already slowed down for this
+      return
+    if stats:
+      stats.count('backoffs')
+    # Go by the rate seen in the last second or so
+    seconds = now - self.windowStart
+    if self.windowMsgs and seconds > 0:
+      self.msgRate = self.windowMsgs / seconds
+      self.byteRate = self.windowBytes / seconds
+    self.msgs.halve(self.msgRate)
+    self.bytes.halve(self.byteRate)
+    # Give the server a moment before the next query, whatever the rate
+    self.next = max(self.next, now + 1.0)
+    self.lastChange = self.lastBackoff = now
+    if verbose:
+      print >>sys.stderr, 'Slowing down to %s messages/s, %s bytes/s: %s' % \
+	('%.1f' % self.msgs.rate if self.msgs.rate else 'any',
+	 '%.0f' % self.bytes.rate if self.bytes.rate else 'any', reason)
+
+
+class DirEntry(object):
+  '''Stand-in for the entries returned by scandir(), for when we don't
+  have it.'''
+  def __init__(self, dirname, name):
+    self.name = name
+    self.path = os.path.join(dirname, name)
+
+  def stat(self):
+    return os.stat(self.path)
+
+
+class DeflateStream(object):
+  '''The two halves of a connection's COMPRESS=DEFLATE stream. Its
+  read(), readline() and send() replace those of the IMAP4 object, and
+  it counts bytes before and after compression.'''
+  def __init__(self, sock):
+    self.sock = sock
+    self.deflate = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+      zlib.DEFLATED, -15)
+    self.inflate = zlib.decompressobj(-15)
+    self.buf = ''
+    self.bytesIn = 0
+    self.bytesOut = 0
+    self.wireIn = 0
+    self.wireOut = 0
+
+  def _fill(self):
+    '''Read and decompress more data. Return False at end of file.'''
+    global chunkSize
+    while not self.buf:
+      data = self.sock.recv(chunkSize)
+      if not data:
+	return False
+      self.wireIn += len(data)
+      self.buf = self.inflate.decompress(data)
+      self.bytesIn += len(self.buf)
+    return True
+
+  def read(self, size):
+    parts = []
+    while size > 0 and (self.buf or self._fill()):
+      part = self.buf[:size]
+      self.buf = self.buf[size:]
+      parts.append(part)
+      size -= len(part)
+    return ''.join(parts)
+
+  def readline(self):
+    parts = []
+    while self.buf or self._fill():
+      i = self.buf.find('\n')
+      if i >= 0:
+	parts.append(self.buf[:i+1])
+	self.buf = self.buf[i+1:]
+	break
+      parts.append(self.buf)
+      self.buf = ''
+    return ''.join(parts)
+
+  def send(self, data):
+    self.bytesOut += len(data)
+    data = self.deflate.compress(data) + self.deflate.flush(zlib.Z_SYNC_FLUSH)
+    self.wireOut += len(data)
+    self.sock.sendall(data)
+
+
+class SpooledLiteral(object):
+  '''A literal from a server response that was written to a temporary
+  file instead of being kept in memory. head is the start of it, which
+  is enough to parse message headers from.'''
+  HEAD_SIZE = 64*1024
+
+  def __init__(self, path, size, head):
+    self.path = path
+    self.size = size
+    self.head = head
+
+
+class NeedMore(Exception):
+  '''Raised by PartialMessage when it needs bytes it hasn't got, from
+  offset on.'''
+  def __init__(self, offset):
+    Exception.__init__(self, offset)
+    self.offset = offset
+
+
+class LayoutError(Exception):
+  '''A message isn't laid out the way its BODYSTRUCTURE says.'''
+
+
+class PartialMessage(object):
+  '''A message being downloaded without the bodies of its parts over
+  maxPart bytes, which are left as holes for the fill command to get.
+  Only the sizes of the parts are known from the BODYSTRUCTURE, not
+  where they are. With the sizes of the message header and of the
+  MIME headers of the parts, we know the least offset at which each
+  big body can start; only preambles and padding around the
+  boundaries are unknown. So the message is fetched a range at a time
+  up to there, or a probe past it, until the start of each big body
+  is found, and then the rest around the holes. segments holds the
+  bytes fetched so far, as (offset, data) pairs in order, merged where
+  they touch.'''
+  PROBE = 512
+
+  def __init__(self, msg):
+    self.msg = msg
+    self.size = msg['RFC822.SIZE']
+    self.segments = []
+    self.holes = None
+    # (least offset, size) of each big body, in order
+    self.deferred = []
+
+  def sections(self):
+    '''Return the sections to fetch before anything else: the header
+    of the message and the MIME headers of its parts.'''
+    return ['HEADER'] + ['%s.MIME' % part
+      for part in partNumbers(self.msg.get('BODYSTRUCTURE'))]
+
+  def expect(self, header, mimeSizes):
+    '''Take the message header, and the sizes of the MIME headers of the
+    parts, by part number, and work out where the big bodies can
+    start.'''
+    if header:
+      self.add(0, header)
+    self.deferred = []
+    self.least(self.msg.get('BODYSTRUCTURE'), '', len(header or ''),
+	       mimeSizes)
+
+  def least(self, structure, number, pos, mimeSizes):
+    '''Add the big bodies in the part whose body can start no earlier
+    than pos to deferred. Return the least offset of its end.'''
+    global maxPart
+    if not isinstance(structure, list) or not structure:
+      return pos
+    if not isinstance(structure[0], list):
+      size = structure[6] if len(structure) > 6 else None
+      if not isinstance(size, int):
+	return pos
+      if size > maxPart:
+	self.deferred.append((pos, size))
+      return pos + size
+    parts = bodyParts(structure)
+    params = structure[len(parts)+1] if len(structure) > len(parts)+1 else None
+    boundary = bodyParam(params, 'BOUNDARY') or ''
+    for i, part in enumerate(parts):
+      sub = number + str(i+1)
+      # [CRLF] --boundary CRLF, then the MIME header
+      pos += len(boundary) + (4 if i == 0 else 6) + mimeSizes.get(sub, 0)
+      pos = self.least(part, sub + '.', pos, mimeSizes)
+    # CRLF --boundary--
+    return pos + len(boundary) + 6
+
+  def add(self, offset, data):
+    '''Add bytes fetched from offset.'''
+    merged = []
+    for start, chunk in sorted(self.segments + [(offset, data)]):
+      if merged and start <= merged[-1][0] + len(merged[-1][1]):
+	prev, prevData = merged[-1]
+	merged[-1] = (prev, prevData + chunk[prev + len(prevData) - start:])
+      else:
+	merged.append((start, chunk))
+    self.segments = merged
+
+  def ranges(self):
+    '''Return the (offset, length) ranges to fetch next; none once we
+    have everything but the holes.'''
+    if self.holes is None:
+      holes = []
+      try:
+	self.layout(self.msg.get('BODYSTRUCTURE'), 0, True, holes)
+      except NeedMore as e:
+	if e.offset >= self.size:
+	  raise LayoutError('ran past the end of the message')
+	return self.guess(e.offset, holes)
+      self.holes = holes
+    return self.gaps(self.holes, 0)
+
+  def guess(self, offset, found):
+    '''Return the ranges to fetch when the layout needs the bytes at
+    offset, having found the holes in found. The big bodies not found
+    yet are taken to be as far past their least offsets as the last one
+    found was, so up to there is safe to fetch. One we are past already
+    is further on than that, so it gets a probe.'''
+    shift = found[-1][0] - self.deferred[len(found)-1][0] if found else 0
+    skip = list(found)
+    for least, size in self.deferred[len(found):]:
+      start = least + shift
+      if start <= offset:
+	start = offset + self.PROBE
+      skip.append((start, size))
+    return self.gaps(skip, offset)
+
+  def gaps(self, skip, pos):
+    '''Return the ranges from pos on that are neither in skip, a list of
+    (offset, size) pairs, nor fetched already.'''
+    ranges = []
+    for start, size in sorted(skip +
+	[(start, len(data)) for start, data in self.segments]):
+      if start > pos:
+	ranges.append((pos, start - pos))
+      pos = max(pos, start + size)
+    if pos < self.size:
+      ranges.append((pos, self.size - pos))
+    return ranges
+
+  def layout(self, structure, pos, top, holes):
+    '''Find the holes in the part at pos described by structure and
+    add them to holes. Return where to start looking for the boundary
+    after the part.'''
+    global maxPart
+    if not isinstance(structure, list) or not structure:
+      raise LayoutError('no BODYSTRUCTURE')
+    if self.startswith('\r\n', pos):
+      body = pos + 2
+    else:
+      body = self.find('\r\n\r\n', pos) + 4
+    if not isinstance(structure[0], list):
+      size = structure[6] if len(structure) > 6 else None
+      if not isinstance(size, int) or size <= maxPart:
+	return body
+      end = body + size
+      holes.append((body, size))
+      # The body has to end where the message or the next boundary does
+      if not (end == self.size if top else self.startswith('\r\n--', end)):
+	raise LayoutError('part at %d is not %d bytes' % (body, size))
+      return end
+    parts = bodyParts(structure)
+    params = structure[len(parts)+1] if len(structure) > len(parts)+1 else None
+    boundary = bodyParam(params, 'BOUNDARY')
+    if not boundary:
+      raise LayoutError('no boundary')
+    delimiter = '--' + boundary
+    at = body
+    for i, part in enumerate(parts):
+      if not (i == 0 and self.startswith(delimiter, at)):
+	at = self.find('\r\n' + delimiter, at) + 2
+      at = self.layout(part, self.find('\r\n', at) + 2, False, holes)
+    return at
+
+  def segment(self, offset):
+    '''Return the (start, data) segment holding the byte at offset.'''
+    for start, data in self.segments:
+      if start <= offset < start + len(data):
+	return start, data
+    raise NeedMore(offset)
+
+  def startswith(self, s, offset):
+    '''Return True if the message has s at offset.'''
+    start, data = self.segment(offset)
+    if offset + len(s) > start + len(data):
+      raise NeedMore(start + len(data))
+    return data.startswith(s, offset - start)
+
+  def find(self, s, offset):
+    '''Return where s next appears in the message from offset on.'''
+    start, data = self.segment(offset)
+    i = data.find(s, offset - start)
+    if i < 0:
+      raise NeedMore(start + len(data))
+    return start + i
+
+  def skeleton(self):
+    '''Yield the message without its holes, a segment at a time.'''
+    pos = 0
+    for start, size in sorted(self.holes) + [(self.size, 0)]:
+      if start > pos:
+	first, data = self.segment(pos)
+	yield data[pos - first:start - first]
+      pos = start + size
+
+  @property
+  def msgid(self):
+    return envelopeParser.parsestr(self.segments[0][1], True)['Message-Id']
+
+
+class Progress(object):
+  '''Progress line shown with -v. Safe to share between threads; other
+  output should go through message() so it doesn't garble the line.'''
+  def __init__(self, total, totalBytes=0):
+    self.total = total
+    self.done = 0
+    self.totalBytes = totalBytes
+    self.doneBytes = 0
+    self.pct0 = 0
+    self.start = self.t0 = time.time()
+    self.lock = threading.Lock()
+
+  def add(self, n, nbytes=0):
+    '''More work has been found.'''
+    with self.lock:
+      self.total += n
+      self.totalBytes += nbytes
+
+  def update(self, n, nbytes=0):
+    '''n more items, of nbytes bytes, are done. If we know how many
+    bytes there are in all, estimate the time left from them.'''
+    global verbose
+    with self.lock:
+      self.done += n
+      self.doneBytes += nbytes
+      if verbose == 1 and self.total:
+	pct = self.done * 100 // self.total
+	t = time.time()
+	if pct != self.pct0 or t > self.t0+1:
+	  eta = ''
+	  if self.doneBytes and self.totalBytes > self.doneBytes:
+	    left = (t - self.start) * (self.totalBytes - self.doneBytes) / \
+	      self.doneBytes
+	    eta = '%d:%02d left ' % divmod(int(left), 60)
+	  sys.stdout.write('\r%d/%d %d%% %s' % (self.done, self.total, pct,
+						 eta))
+	  sys.stdout.flush()
+	  self.pct0 = pct
+	  self.t0 = t
+
+  def message(self, text):
+    global verbose
+    with self.lock:
+      if verbose == 1 and self.done:
+	print
+      print text
+
+  def finish(self):
+    global verbose
+    if verbose == 1 and self.total:
+      print
+
+
+class Stats(object):
+  '''Counters and timings for --stats. Safe to share between threads.
+  Each timing has a count, the number that failed, the total and
+  longest time, and a histogram with buckets bounded by BUCKETS.'''
+  # Bucket upper bounds in milliseconds; the last bucket is unbounded
+  BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+  def __init__(self, command):
+    self.command = command
+    self.start = time.time()
+    self.counters = {}
+    self.timings = {}
+    self.lock = threading.Lock()
+
+  def count(self, name, n=1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + n
+
+  def record(self, name, seconds, ok=True):
+    '''Something called name took this many seconds.'''
+    bucket = bisect.bisect_left(self.BUCKETS, seconds * 1000)
+    with self.lock:
+      timing = self.timings.get(name)
+      if timing is None:
+	timing = self.timings[name] = {'count': 0, 'errors': 0,
+	  'total': 0.0, 'max': 0.0,
+	  'histogram': [0] * (len(self.BUCKETS) + 1)}
+      timing['count'] += 1
+      if not ok:
+	timing['errors'] += 1
+      timing['total'] += seconds
+      timing['max'] = max(timing['max'], seconds)
+      timing['histogram'][bucket] += 1
+
+  def snapshot(self):
+    '''Return everything so far as a dict that can be written as JSON.'''
+    global deflateStreams
+    now = time.time()
+    with self.lock:
+      counters = dict(self.counters)
+      timings = dict((name, dict(timing, histogram=list(timing['histogram'])))
+		     for name, timing in self.timings.iteritems())
+    if deflateStreams:
+      counters['wire_bytes_in'] = sum(stream.wireIn for stream in deflateStreams)
+      counters['wire_bytes_out'] = sum(stream.wireOut
+				       for stream in deflateStreams)
+    return {'command': self.command, 'pid': os.getpid(), 'time': now,
+	    'elapsed': now - self.start, 'buckets_ms': list(self.BUCKETS),
+	    'counters': counters, 'timings': timings}
+
+  def percentile(self, histogram, fraction):
+    '''Return the bucket bound below which this fraction of a timing's
+    observations fall, as text.'''
+    wanted = sum(histogram) * fraction
+    seen = 0
+    for bound, n in zip(self.BUCKETS, histogram):
+      seen += n
+      if seen >= wanted:
+	return '<%d' % bound
+    return '>%d' % self.BUCKETS[-1]
+
+  def report(self, out):
+    '''Print a summary.'''
+    snapshot = self.snapshot()
+    print >>out, 'Stats for %s, %.1f seconds:' % (self.command,
+						  snapshot['elapsed'])
+    timings = snapshot['timings']
+    if timings:
+      print >>out, '  %-16s %8s %6s %9s %8s %7s %7s %8s' % ('', 'count',
+	'errors', 'total s', 'mean ms', 'p50 ms', 'p99 ms', 'max ms')
+    for name in sorted(timings):
+      timing = timings[name]
+      print >>out, '  %-16s %8d %6d %9.3f %8.2f %7s %7s %8.1f' % (name,
+	timing['count'], timing['errors'], timing['total'],
+	timing['total'] * 1000 / max(timing['count'], 1),
+	self.percentile(timing['histogram'], 0.5),
+	self.percentile(timing['histogram'], 0.99), timing['max'] * 1000)
+    for name, value in sorted(snapshot['counters'].iteritems()):
+      print >>out, '  %-16s %8d' % (name.replace('_', ' '), value)
+
+
+class StatsTimer(object):
+  '''Records the time its with block takes in stats, if there are any.'''
+  def __init__(self, name):
+    self.name = name
+
+  def __enter__(self):
+    self.t0 = time.time()
+    return self
+
+  def __exit__(self, typ, value, tb):
+    global stats
+    if stats:
+      stats.record(self.name, time.time() - self.t0, typ is None)
+
+
+class StatsLog(threading.Thread):
+  '''Appends the stats so far to a file as a line of JSON every interval
+  seconds, for --stats-log.'''
+  def __init__(self, stats, path, interval):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.stats = stats
+    self.path = path
+    self.interval = interval
+    self.stopped = threading.Event()
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      if not self.write():
+	return
+
+  def write(self):
+    try:
+      with open(self.path, 'a') as ofile:
+	ofile.write(json.dumps(self.stats.snapshot(), sort_keys=True) + '\n')
+      return True
+    except IOError as e:
+      print >>sys.stderr, 'Unable to write %s: %s' % (self.path, e)
+      return False
+
+  def stop(self):
+    '''Stop, writing one last line.'''
+    self.stopped.set()
+    self.join()
+    self.write()
+
 
 
 def main():
@@ -213,10 +2002,21 @@ def main():
   global quiet, verbose, longform, waitTime, mailDir, prefix, deleteFirst
   global force
   global includes, excludes
+  global batchCount, batchBytes, jobs, maxConn, fullCheck, metadataFormat
+  global compress, storeFormat, destUser, destPasswd, destSsl
+  global maxRate, maxBandwidth, throttle, reconnectTries
+  global stats, statsSummary, statsFile, statsLog, statsInterval, statsLogger
+  global cacheDir, searchKeys, maxPart, syncMessages, syncSeconds, syncGroup
+  durable = False
 
   try:
     (optlist, args) = getopt.gnu_getopt(sys.argv[1:],
-	'vqlnfh:p:sa:u:t:w:d:DP:x:I:X:', ['help','pw='])
+	'vqlnfh:p:sa:u:t:w:d:DP:x:I:X:j:',
+	['help','pw=','batch=','batch-size=','max-conn=','full','metadata=',
+	 'no-compress','store=','dest=','dest-pw=','dest-ssl',
+	 'rate=','bandwidth=','retries=','stats','stats-json=','stats-log=',
+	 'stats-interval=','cache=','since=','before=','larger=','smaller=',
+	 'search=','max-part=','durable','sync-messages=','sync-seconds='])
     for flag, value in optlist:
       if flag == '-v': verbose += 1
       elif flag == '-q': quiet = True
@@ -236,10 +2036,47 @@ def main():
       elif flag == '-x': excludes.append(value)
       elif flag == '-I': includes.extend(readpats(value))
       elif flag == '-X': excludes.extend(readpats(value))
+      elif flag == '-j': jobs = max(1, int(value))
       elif flag == '--help':
 	print usage
 	return 0
       elif flag == '--pw': passwd = value
+      elif flag == '--batch': batchCount = max(1, int(value))
+      elif flag == '--batch-size': batchBytes = parseSize(value)
+      elif flag == '--max-conn': maxConn = max(1, int(value))
+      elif flag == '--full': fullCheck = True
+      elif flag == '--metadata':
+	if value not in metadataFormats:
+	  raise ValueError('Unknown metadata format %s' % value)
+	if value == 'sqlite' and sqlite3 is None:
+	  raise ValueError('The sqlite3 module is not available')
+	metadataFormat = value
+      elif flag == '--no-compress': compress = False
+      elif flag == '--store':
+	if value not in storeFormats:
+	  raise ValueError('Unknown store format %s' % value)
+	storeFormat = value
+      elif flag == '--dest': destUser = value
+      elif flag == '--dest-pw': destPasswd = value
+      elif flag == '--dest-ssl': destSsl = True
+      elif flag == '--rate': maxRate = float(value)
+      elif flag == '--bandwidth': maxBandwidth = parseSize(value)
+      elif flag == '--retries': reconnectTries = int(value)
+      elif flag == '--stats': statsSummary = True
+      elif flag == '--stats-json': statsFile = value
+      elif flag == '--stats-log': statsLog = value
+      elif flag == '--stats-interval': statsInterval = float(value)
+      elif flag == '--cache': cacheDir = value
+      elif flag == '--since': searchKeys.append('SINCE ' + imapDate(value))
+      elif flag == '--before': searchKeys.append('BEFORE ' + imapDate(value))
+      elif flag == '--larger': searchKeys.append('LARGER %d' % parseSize(value))
+      elif flag == '--smaller':
+	searchKeys.append('SMALLER %d' % parseSize(value))
+      elif flag == '--search': searchKeys.append(value)
+      elif flag == '--max-part': maxPart = parseSize(value)
+      elif flag == '--durable': durable = True
+      elif flag == '--sync-messages': syncMessages = max(1, int(value))
+      elif flag == '--sync-seconds': syncSeconds = float(value)
     if not args:
       print >>sys.stderr, 'Missing command'
       print >>sys.stderr, usage
@@ -253,24 +2090,48 @@ def main():
     print >>sys.stderr, "--help for more info"
     return 2
 
+  throttle = Throttle(maxRate, maxBandwidth, waitTime)
+  if durable:
+    syncGroup = SyncGroup(syncMessages, syncSeconds)
+  if statsSummary or statsFile or statsLog:
+    stats = Stats(args[0])
+  if statsLog:
+    statsLogger = StatsLog(stats, statsLog, statsInterval)
+    statsLogger.start()
+
   # If host was not specified, try to parse it from user
   if user and not host:
     user,host,port = parseEmail(user, user,host,port)
+    if host and args[0] != 'probe' and not port and ssltls == None:
+      useProbeCache()
 
-  if args[0] == 'probe':
-    return doProbe(args)
-  elif args[0] == 'listboxes':
-    return doListBoxes(args)
-  elif args[0] == 'list':
-    return doList(args)
-  elif args[0] == 'download':
-    return doDownload(args)
-  elif args[0] == 'upload':
-    return doUpload(args)
-  else:
-    print >>sys.stderr, "Command '%s' not recognized" % args[0]
-    print >>sys.stderr, usage
-    return 2
+  try:
+    if args[0] == 'probe':
+      rval = doProbe(args)
+    elif args[0] == 'listboxes':
+      rval = doListBoxes(args)
+    elif args[0] == 'list':
+      rval = doList(args)
+    elif args[0] == 'download':
+      rval = doDownload(args)
+    elif args[0] == 'upload':
+      rval = doUpload(args)
+    elif args[0] == 'compact':
+      rval = doCompact(args)
+    elif args[0] == 'convert':
+      rval = doConvert(args)
+    elif args[0] == 'migrate':
+      rval = doMigrate(args)
+    elif args[0] == 'fill':
+      rval = doFill(args)
+    else:
+      print >>sys.stderr, "Command '%s' not recognized" % args[0]
+      print >>sys.stderr, usage
+      return 2
+  finally:
+    reportStats()
+  reportCompression()
+  return rval
 
 
 def doProbe(args):
@@ -304,41 +2165,39 @@ def doProbe(args):
 
   ss = (True,) if ssltls else (True, False)
 
+  attempts = [ProbeAttempt(pfx + h, port or (993 if s else 143), s)
+	      for pfx in pfxs for s in ss]
+
   print 'Probing %d host/security connections, this can take up to %.0f seconds' \
-    % (len(pfxs)*len(ss), len(pfxs)*len(ss)*timeout)
-
-  for pfx in pfxs:
-    for s in ss:
-      testhost = pfx + h
-      p = port
-      if not p:
-	p = 993 if s else 143
-      if verbose:
-	print 'Trying %s:%d, %sssl ...' % (testhost, p, '' if s else 'no '),
-	sys.stdout.flush()
-      try:
-	if s:
-	  srvr = imaplib.IMAP4_SSL(testhost, p)
-	else:
-	  srvr = imaplib.IMAP4(testhost, p)
-      except socket.error:
-	if verbose: print 'failed to connect'
-	srvr = None
-      if srvr:
-	if verbose: print 'success'
-	if not foundHost:
-	  foundHost = testhost
-	  foundPort = p
-	  foundSsl = s
-	  foundSrvr = srvr
-	  if not verbose:
-	    break
+    % (len(attempts), timeout)
+
+  # Try them all at once, but report in order of preference
+  for attempt in attempts:
+    attempt.start()
+  for attempt in attempts:
+    while attempt.is_alive():
+      attempt.join(1)
+    srvr = attempt.srvr
+    if verbose:
+      print 'Trying %s:%d, %sssl ... %s' % (attempt.host, attempt.port,
+	'' if attempt.ssl else 'no ', 'success' if srvr else 'failed to connect')
+    if srvr and not foundHost:
+      foundHost = attempt.host
+      foundPort = attempt.port
+      foundSsl = attempt.ssl
+      foundSrvr = srvr
+      if not verbose:
+	break
+  for attempt in attempts:
+    if attempt.srvr is not foundSrvr:
+      attempt.cancel()
 
   if not foundHost:
     print 'Unable to find a connection for', emailAddr
     return 1
 
   print 'Success: host = %s, port = %d, ssl/tls = %s' % (foundHost, foundPort, foundSsl)
+  writeProbeCache(parseEmail(emailAddr)[1], foundHost, foundPort, foundSsl)
 
   if verbose:
     print 'Server capabilities:'
@@ -370,7 +2229,7 @@ def doListBoxes(args):
 
   if verbose:
     print 'Fetch mailbox list, this may take a while ...'
-  mailboxes = getMailboxes(srvr)
+  mailboxes = getMailboxes(srvr, longform)
   if mailboxes:
     if longform:
       print 'd - has children, C=no children'
@@ -379,11 +2238,20 @@ def doListBoxes(args):
       print '   A - A=All, a=archive, d=drafts, j=junk, s=sent, t=trash'
       print '    f - flagged'
       print '     n - not selectable'
+      print '%-6s %8s %12s' % ('', 'messages', 'bytes')
     for mbox in mailboxes:
       if longform:
-	print mbox.FlagLetters(), mbox.name
+	status = mbox.status or {}
+	print '%s %8s %12s %s' % (mbox.FlagLetters(),
+	  status.get('MESSAGES', '-'), status.get('SIZE', '-'), mbox.name)
       else:
 	print mbox.name
+    if longform:
+      known = [mbox.status for mbox in mailboxes if mbox.status]
+      nbytes = [status['SIZE'] for status in known if 'SIZE' in status]
+      print '%-6s %8d %12s total, %d mailboxes' % ('',
+	sum(status.get('MESSAGES', 0) for status in known),
+	sum(nbytes) if nbytes else '-', len(mailboxes))
   else:
     print >>sys.stderr, "Mailbox LIST request fails"
 
@@ -414,7 +2282,7 @@ def doList(args):
   if not srvLogin(srvr, user, passwd):
     return 4
 
-  mailboxes = getMailboxes(srvr)
+  mailboxes = getMailboxes(srvr, 'LIST-STATUS' in srvr.capabilities)
   if not mailboxes:
     print >>sys.stderr, "Unable to read mailbox list from server"
     return 5
@@ -422,41 +2290,134 @@ def doList(args):
   if not args: args = ['INBOX']
   for name in includes + args:
     for mbox in matchBoxes(name, mailboxes, excludes):
-      messages = getMailboxHeaders(srvr, mbox, True)
-      if messages:
-	for msg in messages:
-	  headers = email.message_from_string(msg['RFC822.HEADER'])
-	  if longform:
-	    print '\nMessage %s:' % msg['UID']
-	    print headers
-	  else:
-	    print '%8s  %-40.40s  %-40.40s  %-40.40s' % \
-	      (msg['UID'], headers['subject'],
-	       headers['from'], headers['date'])
+      if not longform:
+	listEnvelopes(srvr, mbox)
+	continue
+      for msg in getMailboxHeaders(srvr, mbox, True):
+	if 'RFC822.HEADER' not in msg:
+	  # Unsolicited flag update
+	  continue
+	headers = email.message_from_string(msg['RFC822.HEADER'])
+	print '\nMessage %s:' % msg['UID']
+	print headers
 
   return 0
 
 def getMailboxHeaders(srvr, mbox, listInfo):
-  '''Fetch all the RFC822 headers from the named mailbox.'''
-  global verbose, longform, waitTime
+  '''Fetch all the RFC822 headers from the named mailbox, yielding
+  each message as it arrives.'''
+  global verbose, longform, waitTime, searchKeys, msgIdChunk
   if verbose:
     print 'Fetch message list from %s, this may take a while ...' % mbox
-  resp = srvr.select(mbox, True)
-  if resp[0] == 'OK':
+  nmesg = selectForList(srvr, mbox, listInfo)
+  if nmesg:
+    try:
+      if searchKeys:
+	uids = searchUids(srvr)
+	chunks = [uids[i:i+msgIdChunk]
+		  for i in xrange(0, len(uids), msgIdChunk)]
+      else:
+	chunks = [None]
+      for chunk in chunks:
+	for msg in fetchStream(srvr, uidSet(chunk) if chunk else '1:*',
+			       '(UID RFC822.HEADER)', len(chunk or ()) or nmesg):
+	  yield msg
+    except imaplib.IMAP4.abort:
+      raise
+    except imaplib.IMAP4.error as e:
+      print >>sys.stderr, 'Failed to fetch messages from %s: %s' % \
+	(mbox, e)
+
+
+def selectForList(srvr, mbox, listInfo):
+  '''Select a mailbox read-only, and return the number of messages in
+  it. With listInfo, print that.'''
+  if mbox.status and mbox.status.get('MESSAGES') == 0:
+    nmesg = 0
+  else:
+    resp = srvr.select(str(mbox), True)
+    if resp[0] != 'OK':
+      print >>sys.stderr, 'Failed to select %s: %s' % (mbox, resp[1][-1])
+      return 0
     nmesg = int(resp[1][0])
-    if listInfo:
-      print
-      print '%s: %s messages' % (mbox, nmesg)
-    if nmesg == 0:
-      return None
-    else:
-      try:
-	resp = srvr.fetch('1:*', "(UID RFC822.HEADER)")
-	return parseFetch(resp)
-      except imaplib.IMAP4.error as e:
-	print >>sys.stderr, 'Failed to fetch messages from %s: %s' % \
-	  (mbox, e)
-	return None
+  if listInfo:
+    print
+    print '%s: %s messages' % (mbox, nmesg)
+  return nmesg
+
+
+def listEnvelopes(srvr, mbox):
+  '''Print the UID, subject, sender and date of each message in a
+  mailbox. Messages in the EnvelopeCache are printed from there; just
+  those three header fields of the others are fetched, and each is
+  printed as it arrives. Messages no longer on the server are dropped
+  from the cache.'''
+  global user, host, port, msgIdChunk, searchKeys
+  nmesg = selectForList(srvr, mbox, True)
+  if not nmesg:
+    return
+  uidvalidity = int(srvr.response('UIDVALIDITY')[1][0] or 0)
+  with EnvelopeCache('%s@%s:%s/%s' % (user, host, port, mbox)) as cache:
+    try:
+      if cache.uidvalidity != uidvalidity:
+	cache.reset(uidvalidity)
+      uids = searchUids(srvr)
+      if searchKeys:
+	for uid in uids:
+	  if uid in cache.rows:
+	    printEnvelope(uid, cache.rows[uid])
+      else:
+	cache.keep(uids)
+	for uid in sorted(cache.rows):
+	  printEnvelope(uid, cache.rows[uid])
+      missing = [uid for uid in uids if uid not in cache.rows]
+      # Usually the missing UIDs are a range or two, and one command
+      # will do; scattered ones are asked for a chunk at a time
+      step = msgIdChunk
+      if len(uidSet(missing)) <= 1000:
+	step = max(len(missing), 1)
+      for i in xrange(0, len(missing), step):
+	chunk = missing[i:i+step]
+	for msg in fetchStream(srvr, uidSet(chunk),
+	    '(UID BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)])', len(chunk)):
+	  row = envelopeRow(msg)
+	  if row:
+	    cache.add(msg['UID'], row)
+	    printEnvelope(msg['UID'], row)
+    except imaplib.IMAP4.abort:
+      raise
+    except imaplib.IMAP4.error as e:
+      print >>sys.stderr, 'Failed to fetch messages from %s: %s' % \
+	(mbox, e)
+
+
+def printEnvelope(uid, row):
+  subject, sender, date = row
+  print '%8s  %-40.40s  %-40.40s  %-40.40s' % (uid, subject, sender, date)
+
+
+def envelopeRow(msg):
+  '''Return the subject, sender and date from a fetched message's
+  BODY[HEADER.FIELDS (SUBJECT FROM DATE)], or None if it has none.'''
+  for key, value in msg.iteritems():
+    if key.startswith('BODY[') and isinstance(value, str):
+      headers = envelopeParser.parsestr(value, True)
+      return tuple(whitespaceRe.sub(' ', str(headers[name] or ''))
+		   for name in ('subject', 'from', 'date'))
+  return None
+
+
+def fetchStream(srvr, uids, items, nmesg):
+  '''UID FETCH the given items, yielding each message as it arrives.
+  The throttle allows for nmesg messages.'''
+  global throttle
+  if throttle:
+    throttle.wait(nmesg, 0)
+  t0 = time.time()
+  for msg in iterFetch(uidFetchStream(srvr, uids, items, None, ())):
+    yield msg
+  if throttle:
+    throttle.done(nmesg, 0, time.time() - t0)
 
 
 def doDownload(args):
@@ -492,80 +2453,736 @@ def doDownload(args):
   if not srvLogin(srvr, user, passwd):
     return 4
 
-  mailboxes = getMailboxes(srvr)
+  mailboxes = getMailboxes(srvr, True)
   if not mailboxes:
     print >>sys.stderr, "Unable to read mailbox list from server"
     return 5
 
   if not args: args = map(lambda m: m.name, mailboxes)
-  # For all names on command line:
-  for name in includes + args:
-    # For all matching mboxes:
-    for mbox in matchBoxes(name, mailboxes, excludes):
-      mboxDir = os.path.join(mailDir, mbox.name)
-      if not os.path.isdir(mboxDir):
-	os.makedirs(mboxDir)
-      resp = srvr.select(str(mbox), True)
-      if resp[0] == 'OK':
-	nmesg = int(resp[1][0])
-	print '%s: %s messages' % (mbox, nmesg)
-	if nmesg > 0:
-	  try:
-	    metadataName = os.path.join(mboxDir, 'metadata')
-	    needHeader = not os.path.exists(metadataName)
-	    if not notreally:
-	      with open(metadataName, "a") as metadata:
-		if needHeader:
-		  print >>metadata, '# msgno  UID  msgid  FLAGS'
-		pct0 = 0
-		t0 = time.time()
-		for idx in xrange(1,nmesg+1):
-		  downloadOne(srvr, mbox, idx, mboxDir, metadata)
-		  if verbose == 1:
-		    pct = idx * 100 // nmesg
-		    t = time.time()
-		    if pct != pct0 or t > t0+1:
-		      sys.stdout.write('\r%d/%d %d%% ' % (idx, nmesg, pct))
-		      sys.stdout.flush()
-		      pct0 = pct
-		      t0 = t
-		print
-	  except imaplib.IMAP4.error as e:
-	    print >>sys.stderr, 'Failed to fetch messages from %s: %s' % \
-	      (mbox, e)
+  # For all names on command line, all matching mboxes:
+  boxes = matchAll(includes + args, mailboxes, excludes)
+  if verbose:
+    reportPlan(boxes)
+  if jobs > 1:
+    return downloadParallel(srvr, boxes)
+
+  for mbox in boxes:
+    srvr = withReconnect(srvr, downloadOne, mbox)
+    if not srvr:
+      return 3
 
   return 0
 
 
-def downloadOne(srvr, mbox, msgno, mboxDir, metadata):
-  '''Download one message to this location.'''
-  global host, port, ssltls, authtype, user, passwd, timeout
-  global verbose, longform, waitTime
-  resp = srvr.fetch(msgno, "(UID RFC822.SIZE)")
-  messages = parseFetch(resp)
-  if messages:
-    msg = messages[0]
-    msgFilename = os.path.join(mboxDir, 'u%d' % msg['UID'])
-    if quickCheck(msgFilename, msg):
-      if waitTime > 0.0:
-	time.sleep(waitTime)
-      if verbose >= 2:
-	print 'Download message %d, %d bytes' % (msg['UID'], msg['RFC822.SIZE'])
-      resp = srvr.fetch(msgno, "(FLAGS RFC822)")
-      messages = parseFetch(resp)
-      msg2 = messages[0]
-      parser = email.parser.Parser()
-      headers = parser.parsestr(msg2['RFC822'], True)
-      print >>metadata, '%d	%d	%s	%s' % \
-	(msgno, msg['UID'], headers['Message-Id'], msg2['FLAGS'])
-      with open(msgFilename, "w") as ofile:
-	ofile.write(msg2['RFC822'])
+def downloadOne(srvr, mbox):
+  '''Download one mailbox, or what is left of it after an earlier try.'''
+  global mailDir, notreally, syncGroup
+  mboxDir = os.path.join(mailDir, mbox.name)
+  if not os.path.isdir(mboxDir):
+    os.makedirs(mboxDir)
+  with openMetadata(mboxDir) as metadata, openStore(mboxDir) as store:
+    oldState = metadata.readState() or readCheckpoint(mboxDir)
+    status = mboxUnchanged(srvr, mbox, oldState)
+    if status:
+      print '%s: %s messages, unchanged' % (mbox, status['MESSAGES'])
+      return
+    if mbox.status and mbox.status.get('MESSAGES') == 0:
+      print '%s: 0 messages' % mbox
+      return
+    resp = srvr.select(str(mbox), True)
+    if resp[0] == 'OK':
+      nmesg = int(resp[1][0])
+      print '%s: %s messages' % (mbox, nmesg)
+      state, oldState = selectState(srvr, mbox, oldState)
+      if nmesg > 0:
+	try:
+	  if not notreally:
+	    downloadMbox(srvr, mbox, store, metadata, state, oldState)
+	except imaplib.IMAP4.abort:
+	  raise
+	except imaplib.IMAP4.error as e:
+	  print >>sys.stderr, 'Failed to fetch messages from %s: %s' % \
+	    (mbox, e)
+	finally:
+	  if syncGroup:
+	    syncGroup.sync()
+
+
+def downloadParallel(srvr, boxes):
+  '''Download mailboxes over a pool of connections. Every batch of
+  messages is a separate job, so large mailboxes are spread over the
+  pool too. This connection plans the jobs while the other connections
+  start on them, then joins the pool once planning is done. The other
+  connections are only opened once there is a job for them.'''
+  global verbose, mailDir, notreally, jobs, maxConn, syncGroup
+  nconn = min(jobs, maxConn)
+  if verbose:
+    print 'Download with %d connections' % nconn
+  # Start on the biggest mailboxes first, so they don't hold up the end
+  boxes = sorted(boxes, key=mboxSize, reverse=True)
+  jobQueue = Queue.Queue()
+  progress = Progress(0)
+  workers = []
+  metadataFiles = []
+  stores = []
+  rval = 0
+  for mbox in boxes:
+    mboxDir = os.path.join(mailDir, mbox.name)
+    if not os.path.isdir(mboxDir):
+      os.makedirs(mboxDir)
+    metadata = openMetadata(mboxDir)
+    metadataFiles.append(metadata)
+    store = openStore(mboxDir)
+    stores.append(store)
+    srvr = withReconnect(srvr, queueMbox, mbox, metadata, store, jobQueue,
+      progress)
+    if not workers and not jobQueue.empty():
+      for i in xrange(nconn-1):
+	worker = threading.Thread(target=downloadWorker,
+	  args=(None, jobQueue, progress))
+	worker.daemon = True
+	worker.start()
+	workers.append(worker)
+    if not srvr:
+      rval = 3
+      break
+
+  # One end marker per connection, this one included
+  for i in xrange(len(workers)+1):
+    jobQueue.put(None)
+  if srvr:
+    downloadWorker(srvr, jobQueue, progress)
+  for worker in workers:
+    while worker.is_alive():
+      worker.join(1)
+  progress.finish()
+  if syncGroup:
+    syncGroup.sync()
+  for metadata in metadataFiles:
+    metadata.close()
+  for store in stores:
+    store.close()
+
+  lost = len(filter(None, drainQueue(jobQueue)))
+  if lost:
+    print >>sys.stderr, '%d batches were not downloaded' % lost
+    return 5
+  return rval
+
+
+def queueMbox(srvr, mbox, metadata, store, jobQueue, progress):
+  '''Plan the download of a mailbox and queue its batches for the
+  connection pool.'''
+  global notreally, searchKeys
+  oldState = metadata.readState() or readCheckpoint(store.dir)
+  status = mboxUnchanged(srvr, mbox, oldState)
+  if status:
+    progress.message('%s: %s messages, unchanged' %
+      (mbox, status['MESSAGES']))
+    return
+  if mbox.status and mbox.status.get('MESSAGES') == 0:
+    progress.message('%s: 0 messages' % mbox)
+    return
+  resp = srvr.select(str(mbox), True)
+  if resp[0] == 'OK':
+    nmesg = int(resp[1][0])
+    progress.message('%s: %s messages' % (mbox, nmesg))
+    state, oldState = selectState(srvr, mbox, oldState)
+    if nmesg > 0 and not notreally:
+      try:
+	todo = planMbox(srvr, store, metadata, oldState)
+	updateFlags(srvr, metadata, oldState)
+      except imaplib.IMAP4.abort:
+	raise
+      except imaplib.IMAP4.error as e:
+	print >>sys.stderr, 'Failed to fetch messages from %s: %s' % \
+	  (mbox, e)
+	return
+      batches = list(makeBatches(todo, fetchSize))
+      tracker = MboxDownload(metadata, store, None if searchKeys else state,
+			     batches)
+      progress.add(len(todo), sum(map(fetchSize, todo)))
+      for batch in batches:
+	jobQueue.put((mbox, batch, tracker))
+
+
+def downloadWorker(srvr, jobQueue, progress):
+  '''Take download jobs off the queue until the end marker. If srvr
+  is None, open a connection of our own. If the connection is lost,
+  log in again and retry the job; if that fails, the job is put back
+  for another connection to take. A batch that can't be stored, say
+  for lack of disk space, is marked as failed.'''
+  global host, port, ssltls, user, passwd, reconnectTries
+  if srvr is None:
+    try:
+      srvr = srvConnect(host, port, ssltls)
+      if srvr and not srvLogin(srvr, user, passwd):
+	srvr = None
+    except (imaplib.IMAP4.error, socket.error) as e:
+      print >>sys.stderr, 'Login failed:', e
+      srvr = None
+    if not srvr:
+      print >>sys.stderr, 'Unable to open another connection; ' \
+	'carrying on with the others'
+      return
+  current = None
+  job = None
+  tries = 0
+  while True:
+    if job is None:
+      job = jobQueue.get()
+      tries = 0
+      if job is None:
+	return
+    mbox, batch, tracker = job
+    try:
+      if mbox is not current:
+	current = None
+	resp = srvr.select(str(mbox), True)
+	if resp[0] != 'OK':
+	  print >>sys.stderr, 'Failed to select %s: %s' % (mbox, resp[1])
+	  tracker.batchDone(batch, False)
+	  job = None
+	  continue
+	current = mbox
+      downloadBatch(srvr, mbox, batch, tracker.store, tracker.metadata)
+      tracker.batchDone(batch, True)
+      progress.update(len(batch), sum(map(fetchSize, batch)))
+    except (imaplib.IMAP4.abort, socket.error) as e:
+      current = None
+      tries += 1
+      srvr = reconnect(srvr, e) if tries <= reconnectTries else None
+      if not srvr:
+	jobQueue.put(job)
+	return
+      continue
+    except imaplib.IMAP4.error as e:
+      print >>sys.stderr, 'Failed to fetch messages from %s: %s' % \
+	(mbox, e)
+      tracker.batchDone(batch, False)
+    except EnvironmentError as e:
+      # After socket.error, which is one too
+      print >>sys.stderr, 'Failed to store messages from %s: %s' % \
+	(mbox, e)
+      tracker.batchDone(batch, False)
+    job = None
+
+
+def drainQueue(q):
+  '''Remove and return everything left in a Queue.'''
+  items = []
+  while True:
+    try:
+      items.append(q.get_nowait())
+    except Queue.Empty:
+      return items
+
+
+def openMetadata(mboxDir):
+  '''Return the metadata of a mailbox directory, in whatever format it
+  is already in. If --metadata asks for another format, convert it.'''
+  global metadataFormat, notreally
+  current = None
+  for cls in (SqlMetadata, TextMetadata):
+    if os.path.exists(os.path.join(mboxDir, cls.NAME)):
+      current = cls
+      break
+  wanted = metadataFormats.get(metadataFormat)
+  if current is None:
+    return (wanted or TextMetadata)(mboxDir)
+  if wanted is None or wanted is current or notreally:
+    return current(mboxDir)
+  return convertMetadata(current(mboxDir), wanted(mboxDir))
+
+
+def convertMetadata(old, new):
+  '''Copy messages and state from one metadata store to another. The old
+  one is renamed out of the way, with '.old' appended.'''
+  global verbose
+  if verbose:
+    print 'Convert %s to %s' % (old.filename, new.filename)
+  with old:
+    new.add(old.messages())
+    state = old.readState()
+    if state:
+      new.writeState(state)
+  os.rename(old.filename, old.filename + '.old')
+  return new
+
+
+def openStore(mboxDir):
+  '''Return the message store of a mailbox directory. A mailbox that
+  has been downloaded before keeps its layout; new ones get the
+  --store layout.'''
+  global storeFormat
+  if os.path.exists(os.path.join(mboxDir, PackStore.INDEX)):
+    return PackStore(mboxDir)
+  if os.path.exists(os.path.join(mboxDir, CasStore.INDEX)):
+    return CasStore(mboxDir)
+  if storeFormat and not any(os.path.exists(os.path.join(mboxDir, cls.NAME))
+			     for cls in (TextMetadata, SqlMetadata)):
+    return storeFormats[storeFormat](mboxDir)
+  return DirStore(mboxDir)
+
+
+def readCheckpoint(mboxDir):
+  '''Return the state written by writeCheckpoint(), or None.'''
+  try:
+    with open(os.path.join(mboxDir, CHECKPOINT), "r") as ifile:
+      words = ifile.read().split()
+    return dict((words[i], int(words[i+1]))
+		for i in xrange(0, len(words)-1, 2))
+  except (IOError, ValueError):
+    return None
+
+
+def writeCheckpoint(mboxDir, state):
+  '''Record the state of a mailbox part way through a download: every
+  message below UIDNEXT is in. It is replaced in one go, so a crash
+  leaves either the old checkpoint or the new one.'''
+  if 'UIDVALIDITY' not in state or 'UIDNEXT' not in state:
+    return
+  filename = os.path.join(mboxDir, CHECKPOINT)
+  with open(filename + '.tmp', "w") as ofile:
+    print >>ofile, ' '.join('%s %d' % (key, state[key])
+			    for key in STATE_KEYS if key in state)
+  os.rename(filename + '.tmp', filename)
+
+
+def removeCheckpoint(mboxDir):
+  try:
+    os.remove(os.path.join(mboxDir, CHECKPOINT))
+  except OSError:
+    pass
+
+
+def casPool():
+  '''Return the CasPool of mailDir, shared by all its CasStores.'''
+  global mailDir
+  poolDir = os.path.join(mailDir, CasPool.DIR)
+  with metadataLock:
+    if poolDir not in casPools:
+      casPools[poolDir] = CasPool(poolDir)
+    return casPools[poolDir]
+
+
+def downloadMbox(srvr, mbox, store, metadata, state, oldState):
+  '''Download the currently-selected mailbox in batches, then record
+  its state for the next incremental download.'''
+  global searchKeys
+  todo = planMbox(srvr, store, metadata, oldState)
+  updateFlags(srvr, metadata, oldState)
+  progress = Progress(len(todo), sum(map(fetchSize, todo)))
+  batches = list(makeBatches(todo, fetchSize))
+  # The messages left out by a search still need downloading next time
+  tracker = MboxDownload(metadata, store, None if searchKeys else state,
+			 batches)
+  for batch in batches:
+    downloadBatch(srvr, mbox, batch, store, metadata)
+    tracker.batchDone(batch, True)
+    progress.update(len(batch), sum(map(fetchSize, batch)))
+  progress.finish()
+
+
+def planMbox(srvr, store, metadata, oldState=None):
+  '''Return the messages in the currently-selected mailbox that need
+  downloading. The size of every message is fetched in one request and
+  compared against the local copies. Given the state of the last
+  download, only messages that arrived since then are considered.
+  Messages the store already has under another UID are recorded
+  instead of being downloaded. With --since and the like, only the
+  messages the server finds are considered. With --max-part, the
+  BODYSTRUCTURE of each message is fetched as well, to see how much
+  of it will be left out.'''
+  global verbose, searchKeys, msgIdChunk, maxPart, syncGroup
+  first = oldState['UIDNEXT'] if oldState else 1
+  items = "(UID RFC822.SIZE FLAGS BODYSTRUCTURE)" if maxPart else \
+    "(UID RFC822.SIZE FLAGS)"
+  if searchKeys:
+    uids = [uid for uid in searchUids(srvr) if uid >= first]
+    messages = []
+    for i in xrange(0, len(uids), msgIdChunk):
+      resp = srvr.uid('FETCH', uidSet(uids[i:i+msgIdChunk]), items)
+      messages.extend(parseFetch(resp) or [])
+  else:
+    resp = srvr.uid('FETCH', '%d:*' % first, items)
+    messages = parseFetch(resp)
+  if not messages:
+    return []
+  # n:* always matches the last message, even when n is past its UID
+  messages = [msg for msg in messages if msg['UID'] >= first]
+  if oldState:
+    # None of these have been recorded, though some may have been
+    # stored by a download that was killed part way through a batch
+    todo = messages
+  else:
+    sizes = store.sizes([msg['UID'] for msg in messages])
+    if syncGroup:
+      # After a crash, the store may have messages that never made it
+      # to disk whole; only those in the metadata are known to be good
+      syncGroup.sync()
+      recorded = metadata.recorded(sizes)
+      sizes = dict((uid, size) for uid, size in sizes.iteritems()
+		   if uid in recorded)
+    # Messages with holes are smaller than the server says
+    for uid, holes in metadata.holes().iteritems():
+      if uid in sizes:
+	sizes[uid] += sum(size for offset, size in holes)
+    todo = [msg for msg in messages if quickCheck(sizes, msg)]
+  if todo and hasattr(store, 'lookup'):
+    todo = linkKnown(srvr, store, metadata, todo)
+  if maxPart:
+    for msg in todo:
+      msg['deferred'] = deferredBytes(msg.get('BODYSTRUCTURE'))
+  if verbose >= 2:
+    print '%d of %d messages need downloading' % (len(todo), len(messages))
+  return todo
+
+
+def linkKnown(srvr, store, metadata, todo):
+  '''Look up the Message-Ids of the messages in todo. Those the store
+  has under the same Message-Id and size, from this or another mailbox,
+  are recorded as they are. Return the others.'''
+  global verbose, msgIdChunk
+  rest = []
+  found = []
+  for i in xrange(0, len(todo), msgIdChunk):
+    chunk = todo[i:i+msgIdChunk]
+    resp = srvr.uid('FETCH', uidSet(msg['UID'] for msg in chunk),
+      '(UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
+    msgIds = dict((msg['UID'], fetchedMsgId(msg))
+		  for msg in parseFetch(resp) or [])
+    for msg in chunk:
+      msgId = msgIds.get(msg['UID'])
+      digest = msgId and store.lookup(normalizeMsgId(msgId), msg['RFC822.SIZE'])
+      if digest:
+	store.link(msg['UID'], digest, msg['RFC822.SIZE'])
+	found.append({'msgno': msg['msgno'], 'UID': msg['UID'],
+		      'msgid': msgId, 'FLAGS': msg['FLAGS']})
+      else:
+	rest.append(msg)
+  recordMessages(store, metadata, found)
+  if verbose >= 2:
+    print '%d messages already stored' % len(found)
+  return rest
+
+
+def updateFlags(srvr, metadata, oldState):
+  '''Using CONDSTORE, find the messages from the last download whose
+  flags have changed since, and record their new flags.'''
+  global verbose
+  if not oldState or not oldState.get('HIGHESTMODSEQ') or \
+      oldState['UIDNEXT'] <= 1 or not hasCondstore(srvr):
+    return
+  resp = srvr.uid('FETCH', '1:%d' % (oldState['UIDNEXT']-1), "(UID FLAGS)",
+    '(CHANGEDSINCE %d)' % oldState['HIGHESTMODSEQ'])
+  changed = parseFetch(resp)
+  if not changed:
+    return
+  if verbose >= 2:
+    print 'Flags changed on %d messages' % len(changed)
+  metadata.setFlags(changed)
+
+
+def mboxUnchanged(srvr, mbox, oldState):
+  '''Ask for the mailbox STATUS and compare it with the state of the
+  last download. Return the status if nothing has changed, else None.'''
+  global fullCheck
+  if not oldState or fullCheck:
+    return None
+  status = mbox.status
+  if status is None:
+    resp = srvr.status(str(mbox), '(%s)' % ' '.join(statusItems(srvr)))
+    if resp[0] != 'OK':
+      return None
+    status = parseStatus(resp[1][-1])
+  for key in STATE_KEYS:
+    if key == 'HIGHESTMODSEQ' and not hasCondstore(srvr):
+      continue
+    if status.get(key) != oldState.get(key):
+      return None
+  return status
+
+
+def statusItems(srvr):
+  '''Return the STATUS items we ask for when planning a download.'''
+  items = ['MESSAGES', 'UIDNEXT', 'UIDVALIDITY']
+  if hasCondstore(srvr):
+    items.append('HIGHESTMODSEQ')
+  if 'STATUS=SIZE' in srvr.capabilities:
+    items.append('SIZE')
+  return items
+
+
+def mboxSize(mbox):
+  '''Return the size of a mailbox as far as the planning pass knows:
+  its SIZE if the server reports one, otherwise its message count.'''
+  status = mbox.status or {}
+  return status.get('SIZE', status.get('MESSAGES', 0))
+
+
+def reportPlan(boxes):
+  '''Print the totals found by the planning pass.'''
+  known = [mbox.status for mbox in boxes if mbox.status]
+  if not known:
+    return
+  nbytes = [status['SIZE'] for status in known if 'SIZE' in status]
+  print 'Plan: %d mailboxes, %d messages%s on the server' % (len(boxes),
+    sum(status.get('MESSAGES', 0) for status in known),
+    ', %d bytes' % sum(nbytes) if nbytes else '')
+
+
+def selectState(srvr, mbox, oldState):
+  '''Return the UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ reported by the
+  SELECT just done, plus oldState if it can still be used.'''
+  global verbose, fullCheck
+  state = {}
+  for key in STATE_KEYS:
+    value = srvr.response(key)[1][0]
+    if value is not None:
+      state[key] = int(value)
+  if oldState and oldState.get('UIDVALIDITY') != state.get('UIDVALIDITY'):
+    # Our UIDs no longer mean anything; check every message
+    if verbose:
+      print '%s: UIDVALIDITY has changed' % mbox
+    oldState = None
+  if fullCheck or 'UIDNEXT' not in state:
+    oldState = None
+  return state, oldState
+
+
+def makeBatches(messages, size=None):
+  '''Split a list of messages into batches of at most batchCount
+  messages and batchBytes bytes. A message larger than batchBytes
+  gets a batch to itself. size(msg) gives the bytes a message counts
+  for; by default, its RFC822.SIZE.'''
+  global batchCount, batchBytes
+  batch = []
+  nbytes = 0
+  for msg in messages:
+    msgBytes = size(msg) if size else msg['RFC822.SIZE']
+    if batch and (len(batch) >= batchCount or
+		  nbytes + msgBytes > batchBytes):
+      yield batch
+      batch = []
+      nbytes = 0
+    batch.append(msg)
+    nbytes += msgBytes
+  if batch:
+    yield batch
+
+
+def downloadBatch(srvr, mbox, batch, store, metadata):
+  '''Download a batch of messages with a single UID FETCH.'''
+  global verbose
+  nbytes = sum(map(fetchSize, batch))
+  if verbose >= 2:
+    print 'Download %d messages, %d bytes' % (len(batch), nbytes)
+  throttled(len(batch), nbytes, fetchBatch, srvr, batch, store, metadata)
+
+
+def fetchBatch(srvr, batch, store, metadata):
+  '''Fetch the messages in batch and put them in the store. Those with
+  parts over --max-part are fetched without them.'''
+  # The message bodies go straight to temporary files as they arrive,
+  # and are renamed once we know their UIDs.
+  parser = email.parser.Parser()
+  records = []
+  try:
+    whole = [msg for msg in batch if not msg.get('deferred')]
+    partial = [msg for msg in batch if msg.get('deferred')]
+    if partial:
+      whole.extend(fetchPartial(srvr, partial, store, records))
+    if not whole:
+      return
+    for msg in iterFetch(uidFetchStream(srvr,
+			 uidSet(msg['UID'] for msg in whole),
+			 "(UID FLAGS RFC822)", store.spoolDir, ('RFC822',))):
+      body = msg.get('RFC822')
+      if not isinstance(body, SpooledLiteral):
+	# Unsolicited flag update
+	continue
+      try:
+	headers = parser.parsestr(body.head, True)
+	with StatsTimer('store'):
+	  store.put(msg['UID'], body.path, headers['Message-Id'])
+      except:
+	if os.path.exists(body.path):
+	  os.unlink(body.path)
+	raise
+      records.append({'msgno': msg['msgno'], 'UID': msg['UID'],
+		      'msgid': headers['Message-Id'], 'FLAGS': msg['FLAGS']})
+  finally:
+    # Even if the connection is lost part way, the messages already
+    # stored are recorded, or a retry would think they were complete
+    # but never list them.
+    with StatsTimer('metadata'):
+      recordMessages(store, metadata, records)
+
+
+def afterSync(store, metadata, action, nmsgs=0):
+  '''Call action() now, or with --durable once what has been put in
+  the store is on disk.'''
+  global syncGroup
+  if syncGroup is None:
+    action()
+  else:
+    syncGroup.add(store, metadata, action, nmsgs)
+
+
+def recordMessages(store, metadata, records):
+  '''Add records of messages just put in the store to the metadata.'''
+  if records:
+    afterSync(store, metadata, lambda: metadata.add(records), len(records))
 
 
-def quickCheck(msgFilename, msg):
-  '''Return True if we need to download this message.'''
-  return not os.path.exists(msgFilename) or \
-       os.path.getsize(msgFilename) != msg['RFC822.SIZE']
+def quickCheck(sizes, msg):
+  '''Return True if we need to download this message. sizes maps the
+  UIDs of the messages we have to their sizes.'''
+  return sizes.get(msg['UID']) != msg['RFC822.SIZE']
+
+
+def fetchSize(msg):
+  '''Return how many bytes of msg a download transfers.'''
+  return msg['RFC822.SIZE'] - msg.get('deferred', 0)
+
+
+def deferredBytes(structure):
+  '''Return how many bytes of a message are in the bodies of parts
+  larger than maxPart, given its BODYSTRUCTURE.'''
+  global maxPart
+  if not isinstance(structure, list) or not structure:
+    return 0
+  if isinstance(structure[0], list):
+    return sum(map(deferredBytes, bodyParts(structure)))
+  size = structure[6] if len(structure) > 6 else None
+  if isinstance(size, int) and size > maxPart:
+    return size
+  return 0
+
+
+def fetchPartial(srvr, messages, store, records):
+  '''Fetch messages without the bodies of their parts over maxPart
+  bytes, a few ranges of bytes at a time, put them in the store and
+  add their metadata to records. Return the messages that turn out
+  not to be laid out as their BODYSTRUCTURE says; they have to be
+  fetched whole.'''
+  global verbose
+  whole = []
+  pending = [PartialMessage(msg) for msg in messages]
+  fetched = fetchEach(srvr, [(partial.msg['UID'],
+    ['BODY.PEEK[%s]' % section for section in partial.sections()])
+    for partial in pending])
+  # A message that sent nothing back has been expunged
+  pending = [partial for partial in pending if partial.msg['UID'] in fetched]
+  for partial in pending:
+    items = fetched[partial.msg['UID']]
+    partial.expect(items.get('BODY[HEADER]'),
+      dict((number, len(items.get('BODY[%s.MIME]' % number) or ''))
+	   for number in partNumbers(partial.msg.get('BODYSTRUCTURE'))))
+  while pending:
+    requests = []
+    for partial in pending:
+      try:
+	ranges = partial.ranges()
+      except LayoutError as e:
+	if verbose >= 2:
+	  print 'Message %d: %s; fetching all of it' % (partial.msg['UID'], e)
+	whole.append(partial.msg)
+	continue
+      if ranges:
+	requests.append((partial.msg['UID'], ranges))
+	continue
+      with StatsTimer('store'):
+	storePartial(store, partial)
+      records.append({'msgno': partial.msg['msgno'],
+		      'UID': partial.msg['UID'], 'msgid': partial.msgid,
+		      'FLAGS': partial.msg['FLAGS'], 'holes': partial.holes})
+    fetched = fetchRanges(srvr, requests)
+    # A message that sent nothing back has been expunged
+    pending = [partial for partial in pending
+	       if partial.msg['UID'] in fetched]
+    for partial in pending:
+      for offset, data in fetched[partial.msg['UID']]:
+	partial.add(offset, data)
+  return whole
+
+
+def storePartial(store, partial):
+  '''Write what we have of a PartialMessage to the store.'''
+  fd, path = tempfile.mkstemp(prefix='.download', dir=store.spoolDir)
+  os.fchmod(fd, 0666 & ~umask)
+  try:
+    with os.fdopen(fd, "wb") as ofile:
+      ofile.writelines(partial.skeleton())
+    store.put(partial.msg['UID'], path, partial.msgid)
+  except:
+    if os.path.exists(path):
+      os.unlink(path)
+    raise
+
+
+def fetchRanges(srvr, requests):
+  '''Fetch ranges of bytes of messages with BODY.PEEK[]<offset.length>.
+  requests is a list of (uid, ranges), each range an (offset, length)
+  pair. Return a dict mapping UIDs to the (offset, data) pairs
+  received.'''
+  fetched = {}
+  for uid, items in fetchEach(srvr, [(uid,
+      ['BODY.PEEK[]<%d.%d>' % r for r in ranges])
+      for uid, ranges in requests]).iteritems():
+    for key, value in items.iteritems():
+      if key.startswith('BODY[]<') and value:
+	fetched.setdefault(uid, []).append((int(key[7:-1]), value))
+  return fetched
+
+
+def fetchEach(srvr, requests):
+  '''Send a UID FETCH for each (uid, items) in requests, statusChunk
+  commands at a time before reading the answers. Return a dict mapping
+  UIDs to what came back for them.'''
+  global statusChunk
+  fetched = {}
+  # Drop any FETCH responses left over from earlier commands
+  srvr.response('FETCH')
+  for i in xrange(0, len(requests), statusChunk):
+    tags = [srvr._command('UID', 'FETCH', str(uid),
+	      '(UID %s)' % ' '.join(items))
+	    for uid, items in requests[i:i+statusChunk]]
+    for tag in tags:
+      srvr._command_complete('FETCH', tag)
+    for msg in iterFetch(srvr.response('FETCH')[1]):
+      if 'UID' in msg:
+	fetched.setdefault(msg['UID'], {}).update(msg)
+  return fetched
+
+
+def snapshotMbox(mboxDir):
+  '''Return a dict mapping UID to size for the messages in a mailbox
+  directory, from a single pass over it. Temporary files left behind
+  by an interrupted download are removed.'''
+  global verbose
+  sizes = {}
+  for entry in scanDir(mboxDir):
+    name = entry.name
+    try:
+      if name.startswith('u') and name[1:].isdigit():
+	sizes[int(name[1:])] = entry.stat().st_size
+      elif name.startswith('.download'):
+	if verbose >= 2:
+	  print 'Remove', entry.path
+	os.unlink(entry.path)
+    except OSError:
+      # Gone since we read the directory
+      pass
+  return sizes
+
+
+def scanDir(path):
+  '''Return the entries of a directory, as scandir() does.'''
+  if scandir is not None:
+    return scandir(path)
+  return (DirEntry(path, name) for name in os.listdir(path))
 
 
 def doUpload(args):
@@ -602,8 +3219,26 @@ def doUpload(args):
   if not srvLogin(srvr, user, passwd):
     return 4
 
-  # List all the directories under mailDir that contain the
-  # file "metadata". These are mailboxes. Then strip the leading
+  dirList = localMailboxes(args)
+
+  mailboxes = getMailboxes(srvr)
+  if not mailboxes:
+    print >>sys.stderr, "Unable to read mailbox list from server"
+    return 5
+
+  for name in dirList:
+    srvr = withReconnect(srvr, uploadMbox, name)
+    if not srvr:
+      return 3
+
+  return 0
+
+
+def localMailboxes(args):
+  '''Return the names of the local mailboxes to work on.'''
+  global mailDir, includes, excludes
+  # List all the directories under mailDir that contain a metadata
+  # file. These are mailboxes. Then strip the leading
   # "maildir" part from the names. Remove any that are in the
   # exclude list, and then limit to those listed on the command
   # line.
@@ -611,7 +3246,9 @@ def doUpload(args):
   mdlen = len(mailDir)
   if not mailDir.endswith(os.sep): mdlen += 1
   for dirInfo in os.walk(mailDir):
-    if 'metadata' in dirInfo[2]:
+    if CasPool.DIR in dirInfo[1]:
+      dirInfo[1].remove(CasPool.DIR)
+    if TextMetadata.NAME in dirInfo[2] or SqlMetadata.NAME in dirInfo[2]:
       dirList.append(dirInfo[0][mdlen:])
   if excludes:
     dirList = filter(lambda x: not included(x, excludes), dirList)
@@ -619,25 +3256,375 @@ def doUpload(args):
   if l:
     dirList = filter(lambda x: included(os.path.basename(x), l), dirList)
   dirList.sort(mboxNameCompare)
+  return dirList
 
-  mailboxes = getMailboxes(srvr)
+
+def doCompact(args):
+  r'''The "compact" command.'''
+  global verbose, mailDir, notreally
+
+  if not mailDir:
+    print >>sys.stderr, 'The "compact" command requires the -d option'
+    print >>sys.stderr, 'Use --help for more information.'
+    return 2
+  if not os.path.isdir(mailDir):
+    print >>sys.stderr, '%s is not a directory' % mailDir
+    print >>sys.stderr, 'Use --help for more information.'
+    return 2
+
+  args.pop(0)
+  for name in localMailboxes(args):
+    with openMetadata(os.path.join(mailDir, name)) as metadata:
+      before = os.path.getsize(metadata.filename) \
+	if os.path.exists(metadata.filename) else 0
+      if not notreally:
+	metadata.compact()
+      if verbose:
+	print '%s: %d -> %d bytes' % \
+	  (name, before, os.path.getsize(metadata.filename))
+    with openStore(os.path.join(mailDir, name)) as store:
+      if notreally or not hasattr(store, 'compact'):
+	continue
+      before, after = store.compact()
+      if verbose:
+	print '%s: messages %d -> %d bytes' % (name, before, after)
+  return 0
+
+def doConvert(args):
+  r'''The "convert" command.'''
+  global verbose, mailDir, notreally, storeFormat
+
+  if not mailDir or not storeFormat:
+    print >>sys.stderr, 'The "convert" command requires the -d and --store options'
+    print >>sys.stderr, 'Use --help for more information.'
+    return 2
+  if not os.path.isdir(mailDir):
+    print >>sys.stderr, '%s is not a directory' % mailDir
+    print >>sys.stderr, 'Use --help for more information.'
+    return 2
+
+  args.pop(0)
+  for name in localMailboxes(args):
+    mboxDir = os.path.join(mailDir, name)
+    with openStore(mboxDir) as old:
+      if isinstance(old, storeFormats[storeFormat]):
+	continue
+      uids = old.uids()
+      if verbose:
+	print '%s: convert %d messages to %s' % (name, len(uids), storeFormat)
+      if notreally:
+	continue
+      with storeFormats[storeFormat](mboxDir) as new:
+	for uid in uids:
+	  with old.open(uid) as ifile:
+	    new.write(uid, ifile)
+      old.remove()
+  return 0
+
+
+def doMigrate(args):
+  r'''The "migrate" command.'''
+  global host, port, ssltls, user, passwd
+  global destUser, destPasswd, destSsl
+  global includes, excludes
+
+  args.pop(0)
+  if len(args) > 0 and '@' in args[0]:
+    parseEmailAndDefaults(args[0])
+    args.pop(0)
+
+  if not user or not destUser:
+    print >>sys.stderr, 'The "migrate" command requires the -u and --dest options'
+    print >>sys.stderr, 'Use --help for more information.'
+    return 2
+  if not passwd:
+    passwd = getpass.getpass()
+  duser, dhost, dport = parseEmail(destUser)
+  if not dhost:
+    dhost = host
+  if not destPasswd:
+    destPasswd = getpass.getpass('Destination password: ')
+
+  src = srvConnect(host, port, ssltls)
+  if not src: return 3
+  if not srvLogin(src, user, passwd):
+    return 4
+  dst = srvConnect(dhost, dport, destSsl)
+  if not dst: return 3
+  if not srvLogin(dst, duser, destPasswd):
+    return 4
+
+  mailboxes = getMailboxes(src)
   if not mailboxes:
     print >>sys.stderr, "Unable to read mailbox list from server"
     return 5
 
-  for name in dirList:
-    uploadMbox(srvr, name)
+  if not args: args = map(lambda m: m.name, mailboxes)
+  for mbox in matchAll(includes + args, mailboxes, excludes):
+    try:
+      migrateMbox(src, dst, mbox)
+    except (imaplib.IMAP4.abort, socket.error) as e:
+      # Messages already copied are skipped next time, so say how to finish
+      print >>sys.stderr, 'Connection lost while migrating %s: %s' % (mbox, e)
+      print >>sys.stderr, 'Run migrate again to copy the rest'
+      return 3
+    except imaplib.IMAP4.error as e:
+      print >>sys.stderr, 'Failed to migrate %s: %s' % (mbox, e)
 
   return 0
 
+
+def migrateMbox(src, dst, mbox):
+  '''Copy one mailbox from the source server to the destination. A
+  thread fetches batches of messages from the source while this one
+  appends them to the destination; the queue between them holds at
+  most two batches. Messages whose Message-Id is already in the
+  destination mailbox are skipped, so an interrupted migrate can be
+  run again.'''
+  global verbose, prefix, notreally
+  mboxname = prefix + mbox.name
+  resp = src.select(str(mbox), True)
+  if resp[0] != 'OK':
+    print >>sys.stderr, 'Failed to select %s: %s' % (mbox, resp[1])
+    return
+  nmesg = int(resp[1][0])
+  print '%s: %d messages' % (mbox, nmesg)
+  if nmesg == 0:
+    return
+  resp = src.uid('FETCH', '1:*',
+    '(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
+  messages = parseFetch(resp) or []
+
+  if not notreally:
+    dst.create(mboxname)
+  resp = dst.select(mboxname, notreally)
+  dnmesg = int(resp[1][0]) if resp[0] == 'OK' else 0
+  msgIds = getServerMsgIds(dst, dnmesg) if dnmesg else set()
+  todo = []
+  for msg in messages:
+    msgId = fetchedMsgId(msg)
+    if msgId and normalizeMsgId(msgId) in msgIds:
+      if verbose >= 2:
+	print 'Not copying message %d, %s, already on server.' % \
+	  (msg['UID'], msgId)
+    else:
+      todo.append(msg)
+  if verbose >= 2:
+    print '%d of %d messages need copying' % (len(todo), len(messages))
+  if notreally or not todo:
+    return
+
+  pipe = Queue.Queue(2)
+  fetcher = threading.Thread(target=migrateFetch,
+    args=(src, list(makeBatches(todo)), pipe))
+  fetcher.daemon = True
+  fetcher.start()
+  progress = Progress(len(todo))
+  while True:
+    batch = pipe.get()
+    if batch is None:
+      break
+    if isinstance(batch, Exception):
+      progress.finish()
+      raise batch
+    items = [(uploadFlags(msg),
+	      '"%s"' % msg['INTERNALDATE'] if msg.get('INTERNALDATE') else None,
+	      msg['RFC822']) for msg in batch]
+    if verbose >= 2:
+      progress.message('Copying %d messages, %d bytes to %s' %
+	(len(items), sum(len(item[2]) for item in items), mboxname))
+    results = appendThrottled(dst, mboxname, items)
+    for msg, result in zip(batch, results):
+      if result[0] != 'OK':
+	print >>sys.stderr, "Failed to write message %d," % msg['UID'], \
+	  result[1][-1]
+    progress.update(len(batch))
+  progress.finish()
+
+
+def migrateFetch(src, batches, pipe):
+  '''The fetch half of migrateMbox. Each batch of messages is fetched
+  and put on the pipe, followed by None, or by the exception that
+  stopped us.'''
+  try:
+    for batch in batches:
+      pipe.put(throttled(len(batch), sum(msg['RFC822.SIZE'] for msg in batch),
+	lambda: [msg for msg in iterFetch(uidFetchStream(src,
+		   uidSet(msg['UID'] for msg in batch),
+		   '(UID FLAGS INTERNALDATE RFC822)', None, ()))
+		 if 'RFC822' in msg]))
+    pipe.put(None)
+  except Exception as e:
+    # Whatever it was, the main thread is waiting on the pipe for it
+    pipe.put(e)
+
+
+def doFill(args):
+  r'''The "fill" command.'''
+  global host, port, ssltls, user, passwd, mailDir
+
+  if not mailDir:
+    print >>sys.stderr, 'The "fill" command requires the -d option'
+    print >>sys.stderr, 'Use --help for more information.'
+    return 2
+  if not os.path.isdir(mailDir):
+    print >>sys.stderr, '%s is not a directory' % mailDir
+    print >>sys.stderr, 'Use --help for more information.'
+    return 2
+
+  args.pop(0)
+  if len(args) > 0 and '@' in args[0]:
+    parseEmailAndDefaults(args[0])
+    args.pop(0)
+
+  if not user:
+    print >>sys.stderr, 'User (-u) required'
+    print >>sys.stderr, 'Use --help for more information.'
+    return 2
+  if not passwd:
+    passwd = getpass.getpass()
+
+  srvr = srvConnect(host, port, ssltls)
+  if not srvr: return 3
+
+  if not srvLogin(srvr, user, passwd):
+    return 4
+
+  for name in localMailboxes(args):
+    srvr = withReconnect(srvr, fillMbox, name)
+    if not srvr:
+      return 3
+  return 0
+
+
+def fillMbox(srvr, name):
+  '''Download the parts left out of the messages of one local mailbox,
+  and put the whole messages in the store. Messages whose size on the
+  server no longer matches are left alone.'''
+  global verbose, notreally, msgIdChunk, syncGroup
+  mboxDir = os.path.join(mailDir, name)
+  with openMetadata(mboxDir) as metadata, openStore(mboxDir) as store:
+    todo = [msg for msg in metadata.messages() if msg.get('holes')]
+    if not todo:
+      if verbose:
+	print '%s: nothing to fill' % name
+      return
+    print '%s: %d messages to fill' % (name, len(todo))
+    if notreally:
+      return
+    resp = srvr.select(name, True)
+    if resp[0] != 'OK':
+      print >>sys.stderr, 'Failed to select %s: %s' % (name, resp[1])
+      return
+    saved = metadata.readState()
+    state = saved or readCheckpoint(mboxDir)
+    uidvalidity = srvr.response('UIDVALIDITY')[1][0]
+    if state and uidvalidity and int(uidvalidity) != state['UIDVALIDITY']:
+      print >>sys.stderr, '%s: UIDVALIDITY has changed; download it again' % \
+	name
+      return
+    sizes = {}
+    uids = [msg['UID'] for msg in todo]
+    for i in xrange(0, len(uids), msgIdChunk):
+      resp = srvr.uid('FETCH', uidSet(uids[i:i+msgIdChunk]),
+	'(UID RFC822.SIZE)')
+      sizes.update((msg['UID'], msg['RFC822.SIZE'])
+		   for msg in parseFetch(resp) or [])
+    ready = []
+    for msg in todo:
+      msg['RFC822.SIZE'] = store.size(msg['UID']) + holeBytes(msg)
+      if sizes.get(msg['UID']) == msg['RFC822.SIZE']:
+	ready.append(msg)
+      elif verbose:
+	print 'Message %d is gone from the server, or has changed' % \
+	  msg['UID']
+    progress = Progress(len(ready), sum(map(holeBytes, ready)))
+    try:
+      for batch in makeBatches(ready, holeBytes):
+	nbytes = sum(map(holeBytes, batch))
+	if verbose >= 2:
+	  print 'Fill %d messages, %d bytes' % (len(batch), nbytes)
+	throttled(len(batch), nbytes, fillBatch, srvr, batch, store, metadata)
+	progress.update(len(batch), nbytes)
+    except imaplib.IMAP4.abort:
+      raise
+    except imaplib.IMAP4.error as e:
+      print >>sys.stderr, 'Failed to fetch messages from %s: %s' % (name, e)
+    finally:
+      # Recording the filled messages cleared the state; the download it
+      # describes is still complete, so the next one can be incremental
+      if saved:
+	afterSync(store, metadata, lambda: metadata.writeState(saved))
+      if syncGroup:
+	syncGroup.sync()
+    progress.finish()
+
+
+def holeBytes(msg):
+  '''Return the size of the holes in a message.'''
+  return sum(size for offset, size in msg['holes'])
+
+
+def fillBatch(srvr, batch, store, metadata):
+  '''Fetch the holes of the messages in batch, and put the messages
+  back together.'''
+  fetched = fetchRanges(srvr, [(msg['UID'], msg['holes']) for msg in batch])
+  records = []
+  try:
+    for msg in batch:
+      parts = dict(fetched.get(msg['UID'], []))
+      if any(len(parts.get(offset, '')) != size
+	     for offset, size in msg['holes']):
+	print >>sys.stderr, 'Message %d: the server sent too little' % \
+	  msg['UID']
+	continue
+      with StatsTimer('store'):
+	fillMessage(store, msg, parts)
+      records.append(dict((key, msg[key])
+			  for key in ('msgno', 'UID', 'msgid', 'FLAGS')))
+  finally:
+    with StatsTimer('metadata'):
+      recordMessages(store, metadata, records)
+
+
+def fillMessage(store, msg, parts):
+  '''Put the stored copy of msg and the parts that were left out of it
+  together, and store the result. parts maps the offset of each hole
+  to its contents.'''
+  fd, path = tempfile.mkstemp(prefix='.download', dir=store.spoolDir)
+  os.fchmod(fd, 0666 & ~umask)
+  try:
+    with os.fdopen(fd, "wb") as ofile:
+      ifile = store.open(msg['UID'])
+      try:
+	pos = 0
+	for offset, size in sorted(msg['holes']):
+	  ofile.write(ifile.read(offset - pos))
+	  ofile.write(parts[offset])
+	  pos = offset + size
+	copyFile(ifile, ofile)
+      finally:
+	ifile.close()
+      if ofile.tell() != msg['RFC822.SIZE']:
+	raise IOError('message %d came out %d bytes, not %d' %
+		      (msg['UID'], ofile.tell(), msg['RFC822.SIZE']))
+    store.put(msg['UID'], path, msg['msgid'])
+  except:
+    if os.path.exists(path):
+      os.unlink(path)
+    raise
+
+
 def uploadMbox(srvr, name):
-  '''Upload a single mailbox.'''
+  '''Upload a single mailbox. If it is being called again after the
+  connection was lost, carry on with the messages that didn't make it.'''
   global host, port, ssltls, authtype, user, passwd, timeout
   global verbose, longform, waitTime, mailDir, prefix, notreally
-  global deleteFirst, force
+  global deleteFirst, force, batchBytes
   global includes, excludes
   mboxname = prefix + name
-  if deleteFirst:
+  resuming = mboxname in uploadsStarted
+  if deleteFirst and not resuming:
     if verbose:
       print 'Delete mailbox', mboxname
     if not notreally:
@@ -651,70 +3638,205 @@ def uploadMbox(srvr, name):
     nmesg = int(resp[1][0])
     if verbose >= 2:
       print 'Mailbox %s opened, %d messages' % (mboxname, nmesg)
-    if nmesg > 0 and not force:
+    uidvalidity = srvr.response('UIDVALIDITY')[1][0]
+    uidvalidity = int(uidvalidity) if uidvalidity else None
+    mboxDir = os.path.join(mailDir, name)
+    journal = UploadJournal(mboxDir,
+      '%s@%s:%s/%s' % (user, host, port, mboxname))
+    journaled = uidvalidity is not None and \
+      journal.uidvalidity == uidvalidity
+    if nmesg > 0 and not force and not resuming and not journaled:
       print >>sys.stderr, \
 	"Mailbox %s is not empty, not uploading any messages" % \
 	mboxname
     else:
-      # Get list of messages in the mail directory from metadata.
-      messages = readMetadata(os.path.join(mailDir, name, 'metadata'))
-      nmesg = len(messages)
-      # Get list of messages already on the server
-      srvrMessages = getMailboxHeaders(srvr, mboxname, verbose > 0)
-      if srvrMessages:
-	headers = email.message_from_string(srvrMessages[0]['RFC822.HEADER'])
-	parser = email.parser.Parser()
-	msgIds = set(getMessageId(msg, parser) for msg in srvrMessages)
-	srvrMessages = None
+      uploadsStarted.add(mboxname)
+      if journaled:
+	# Only messages added since the last one we know of could be
+	# ours without being in the journal
+	if verbose >= 2:
+	  print '%d messages in the upload journal' % len(journal.uploaded)
+	msgIds = getServerMsgIds(srvr, nmesg, journal.high + 1)
       else:
-	msgIds = set()
-      pct0 = 0
-      t0 = time.time()
-      for idx,msg in enumerate(messages):
-	if msg['msgid'] in msgIds:
-	  if verbose >= 2:
-	    print 'Not uploading message %d, %s, already on server.' % \
-	      (msg['UID'], msg['msgid'])
+	if verbose and journal.uidvalidity is not None:
+	  print '%s: UIDVALIDITY has changed, checking every message' % \
+	    mboxname
+	# Get list of messages already on the server
+	msgIds = getServerMsgIds(srvr, nmesg)
+	if uidvalidity is not None and not notreally:
+	  journal.reset(uidvalidity)
+      todo = []
+      found = []
+      partial = 0
+      with openMetadata(mboxDir) as metadata:
+	onServer = metadata.lookup(msgIds)
+	for msg in metadata.messages():
+	  if msg['UID'] in journal.uploaded:
+	    continue
+	  if msg.get('holes'):
+	    # Not all there; it has to wait for fill
+	    partial += 1
+	    continue
+	  if msg['UID'] in onServer:
+	    if verbose >= 2:
+	      print 'Not uploading message %d, %s, already on server.' % \
+		(msg['UID'], msg['msgid'])
+	    found.append((msg['UID'], None))
+	  else:
+	    todo.append(msg)
+      if found and not notreally:
+	journal.add(found)
+      if partial:
+	print >>sys.stderr, '%s: %d messages are missing parts left out ' \
+	  'by --max-part, not uploading them; use the fill command ' \
+	  'first' % (name, partial)
+      progress = Progress(len(todo))
+      with openStore(mboxDir) as store, journal:
+	if not notreally and ('MULTIAPPEND' in srvr.capabilities or
+			      'LITERAL+' in srvr.capabilities):
+	  for msg in todo:
+	    msg['RFC822.SIZE'] = store.size(msg['UID'])
+	  for batch in makeBatches(todo):
+	    if len(batch) == 1 and batch[0]['RFC822.SIZE'] > batchBytes:
+	      # Too big to hold in memory
+	      uploadOne(srvr, store, mboxname, batch[0], journal)
+	    else:
+	      uploadBatch(srvr, store, mboxname, batch, journal)
+	    progress.update(len(batch))
 	else:
-	  uploadOne(srvr, name, mboxname, msg)
-	  if verbose == 1:
-	    pct = (idx+1) * 100 // nmesg
-	    t = time.time()
-	    if pct != pct0 or t > t0+1:
-	      sys.stdout.write('\r%d/%d %d%% ' % ((idx+1), nmesg, pct))
-	      sys.stdout.flush()
-	      pct0 = pct
-	      t0 = t
-      if verbose == 1:
-	print
-
-def getMessageId(msg, parser):
-  '''Return message id, or make one up.'''
-  headers = parser.parsestr(msg['RFC822.HEADER'])
-  if 'Message-Id' in headers: return headers['Message-Id']
-  return '<UID-%d>' % msg['UID']
+	  for msg in todo:
+	    uploadOne(srvr, store, mboxname, msg, journal)
+	    progress.update(1)
+      progress.finish()
+
+def getServerMsgIds(srvr, nmesg, firstUid=None):
+  '''Return the set of Message-Ids in the currently-selected mailbox,
+  or only in the messages from UID firstUid on. Only that one header
+  is fetched, msgIdChunk messages at a time.'''
+  global verbose
+  msgIds = set()
+  if firstUid is not None:
+    if nmesg == 0:
+      return msgIds
+    if verbose >= 2:
+      print 'Fetch Message-Ids of UIDs %d:*' % firstUid
+    resp = srvr.uid('FETCH', '%d:*' % firstUid,
+      '(UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
+    for msg in parseFetch(resp) or []:
+      msgId = fetchedMsgId(msg)
+      # n:* always matches the last message, even when n is past its UID
+      if msgId and msg.get('UID', firstUid) >= firstUid:
+	msgIds.add(normalizeMsgId(msgId))
+    return msgIds
+  for first in xrange(1, nmesg+1, msgIdChunk):
+    last = min(first + msgIdChunk - 1, nmesg)
+    if verbose >= 2:
+      print 'Fetch Message-Ids %d:%d' % (first, last)
+    resp = srvr.fetch('%d:%d' % (first, last),
+      '(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
+    for msg in parseFetch(resp) or []:
+      msgId = fetchedMsgId(msg)
+      if msgId:
+	msgIds.add(normalizeMsgId(msgId))
+  return msgIds
+
+
+def fetchedMsgId(msg):
+  '''Return the Message-Id from a fetched message's
+  BODY[HEADER.FIELDS (MESSAGE-ID)], or None.'''
+  for key, value in msg.iteritems():
+    if key.startswith('BODY[') and isinstance(value, str):
+      m = msgIdHeaderRe.search(value)
+      if m:
+	return m.group(1)
+  return None
 
-def uploadOne(srvr, name, mboxname, msg):
-  '''Upload one message to the server.'''
+def uploadOne(srvr, store, mboxname, msg, journal):
+  '''Upload one message to the server. It is streamed from the store,
+  so memory use doesn't depend on its size.'''
   global verbose, longform, waitTime, mailDir, prefix, notreally
   global deleteFirst, force
   global includes, excludes
-  msgFileName = os.path.join(mailDir, name, 'u%d' % msg['UID'])
-  with open(msgFileName, "r") as msgFile:
-    msgData = msgFile.read()
-  flags = msg["FLAGS"]
-  # \Recent is not allowed in flags, apparently.
-  flags = filter(lambda x:x != '\\Recent', flags)
-  flags = ' '.join(flags)
+  with store.open(msg['UID']) as msgFile:
+    size = sum(len(chunk) for chunk in crlfChunks(msgFile))
+  flags = uploadFlags(msg)
   if verbose >= 2:
     print 'Uploading message %d, %d bytes to %s' % \
-      (msg['UID'], len(msgData), mboxname)
+      (msg['UID'], size, mboxname)
   if not notreally:
     try:
-      srvr.append(mboxname, flags, None, msgData)
+      resp = throttled(1, size, streamAppend, srvr, mboxname, flags, None,
+	store, msg['UID'], size)
+      if resp[0] != 'OK':
+	print >>sys.stderr, "Failed to write message %d," % msg['UID'], \
+	  resp[1][-1]
+      else:
+	journalBatch(srvr, journal, [msg], [resp])
+    except imaplib.IMAP4.abort:
+      raise
     except imaplib.IMAP4.error as e:
       print >>sys.stderr, "Failed to write message %d," % msg['UID'], e
 
+def uploadBatch(srvr, store, mboxname, batch, journal):
+  '''Upload several messages to the server without waiting for each
+  one to be acknowledged.'''
+  global verbose, mailDir
+  items = []
+  for msg in batch:
+    with store.open(msg['UID']) as msgFile:
+      items.append((uploadFlags(msg), None, msgFile.read()))
+  if verbose >= 2:
+    print 'Uploading %d messages, %d bytes to %s' % \
+      (len(batch), sum(len(item[2]) for item in items), mboxname)
+  results = appendThrottled(srvr, mboxname, items)
+  for msg, result in zip(batch, results):
+    if result[0] != 'OK':
+      print >>sys.stderr, "Failed to write message %d," % msg['UID'], \
+	result[1][-1]
+  journalBatch(srvr, journal, batch, results)
+
+
+def journalBatch(srvr, journal, batch, results):
+  '''Record the messages of batch that were appended in the journal,
+  with the UIDs the server gave them. If it didn't say, ask for the
+  highest UID in the mailbox instead, so a resumed upload knows which
+  messages to check.'''
+  serverUids = appendedUids(results, journal.uidvalidity)
+  done = [(msg['UID'], serverUid)
+	  for msg, result, serverUid in zip(batch, results, serverUids)
+	  if result[0] == 'OK']
+  if not done:
+    return
+  high = None
+  if None in serverUids:
+    resp = srvr.uid('FETCH', '*', '(UID)')
+    high = max([msg['UID'] for msg in parseFetch(resp) or []] or [None])
+  journal.add(done, high)
+
+
+def appendedUids(results, uidvalidity):
+  '''Return the UIDs the server gave each message, according to the
+  APPENDUID responses in the results of appendMessages(), or None
+  where it didn't say. MULTIAPPEND gives one result, and a UID set,
+  for the lot.'''
+  uids = []
+  last = None
+  pending = []
+  for result in results:
+    if result is not last:
+      last = result
+      m = result[0] == 'OK' and appendUidRe.search(str(result[1][-1]))
+      pending = parseUidSet(m.group(2)) \
+	if m and int(m.group(1)) == uidvalidity else []
+    uids.append(pending.pop(0) if pending else None)
+  return uids
+
+def uploadFlags(msg):
+  '''Return the flags of a message as they should be uploaded.'''
+  # \Recent is not allowed in flags, apparently.
+  flags = filter(lambda x:x != '\\Recent', msg["FLAGS"])
+  return ' '.join(flags)
+
 
 
 def mboxNameCompare(a,b):
@@ -725,8 +3847,8 @@ def mboxNameCompare(a,b):
 
 
 def readMetadata(filename):
-  '''Read a metadata file for message numbers, uids, msgids, and flags. Return
-  a list of Mbox objects.'''
+  '''Read a metadata file for message numbers, uids, msgids, flags and
+  holes. Return a list of Mbox objects.'''
   # Return list of messages. Remove dupes.
   with open(filename, "r") as ifile:
     messages = {}
@@ -734,13 +3856,16 @@ def readMetadata(filename):
       if line.startswith('#'): continue
       line = line.strip()
       try:
-	msgno, uid, msgid, flags = line.split('\t')
+	fields = line.split('\t')
+	msgno, uid, msgid, flags = fields[:4]
 	uid = int(uid)
 	msg = {}
 	msg['msgno'] = int(msgno)
 	msg['UID'] = uid
 	msg['msgid'] = msgid
 	msg['FLAGS'] = ast.literal_eval(flags)
+	if len(fields) > 4:
+	  msg['holes'] = parseHoles(fields[4])
 	messages[uid] = msg
       except ValueError as e:
 	print >>sys.stderr, 'Failed to unpack %s, line:' % filename, line
@@ -755,7 +3880,7 @@ def readMetadata(filename):
 
 def srvConnect(host, port, ssltls):
   '''Connect to server, return server object or None.'''
-  global verbose, timeout
+  global verbose, timeout, stats
   if timeout:
     socket.setdefaulttimeout(timeout)
   if port == None and ssltls == None:
@@ -772,6 +3897,8 @@ def srvConnect(host, port, ssltls):
       srvr = imaplib.IMAP4_SSL(host, port)
     else:
       srvr = imaplib.IMAP4(host, port)
+    if stats:
+      instrument(srvr)
     return srvr
   except socket.error as e:
     print 'failed to connect to', host
@@ -793,29 +3920,523 @@ def srvLogin(srvr, user, passwd):
   try:
     if not authtype or authtype == 'plain':
       srvr.login(user, passwd)
-      return True
     elif authtype == 'md5':
       srvr.login_cram_md5(user, passwd)
-      return True
     else:
       print >>sys.stderr, "Authtype %s not known" % authtype
       return False
   except imaplib.IMAP4.error as e:
     print >>sys.stderr, "Login failed:", e
     return False
+  # Many servers only list their extensions once logged in
+  resp = srvr.capability()
+  if resp[0] == 'OK' and resp[1][-1]:
+    srvr.capabilities = tuple(resp[1][-1].upper().split())
+  if compress and 'COMPRESS=DEFLATE' in srvr.capabilities:
+    startCompression(srvr)
+  return True
+
+
+def instrument(srvr):
+  '''Have stats time each command on this connection, from sending it
+  to its completion, under the command's name, and count the bytes
+  read and sent.'''
+  started = {}
+  names = {}
+  newTag = srvr._new_tag
+  command = srvr._command
+  complete = srvr._command_complete
+
+  def _new_tag():
+    tag = newTag()
+    started[tag] = time.time()
+    return tag
+
+  def _command(name, *args):
+    tag = command(name, *args)
+    if name == 'UID' and args:
+      name = 'UID ' + args[0].upper()
+    names[tag] = name
+    return tag
+
+  def _command_complete(name, tag):
+    ok = False
+    try:
+      result = complete(name, tag)
+      ok = result[0] == 'OK'
+      return result
+    finally:
+      commandDone(srvr, tag, name, ok)
+
+  srvr.started = started
+  srvr.names = names
+  srvr._new_tag = _new_tag
+  srvr._command = _command
+  srvr._command_complete = _command_complete
+  countBytes(srvr)
+
+
+def commandDone(srvr, tag, name, ok):
+  '''The command with this tag has completed; record how long it took,
+  if the connection is instrumented.'''
+  global stats
+  started = getattr(srvr, 'started', None)
+  if started and tag in started:
+    stats.record(srvr.names.pop(tag, name), time.time() - started.pop(tag),
+		 ok)
+
+
+def countBytes(srvr):
+  '''Count the bytes going through the connection's read(), readline()
+  and send() in stats.'''
+  global stats
+  read = srvr.read
+  readline = srvr.readline
+  send = srvr.send
+
+  def countedRead(size):
+    data = read(size)
+    stats.count('bytes_in', len(data))
+    return data
+
+  def countedReadline():
+    line = readline()
+    stats.count('bytes_in', len(line))
+    return line
+
+  def countedSend(data):
+    stats.count('bytes_out', len(data))
+    return send(data)
+
+  srvr.read = countedRead
+  srvr.readline = countedReadline
+  srvr.send = countedSend
+
+
+def reconnect(srvr, reason):
+  '''The connection to the server has been lost. Connect and log in
+  again, waiting twice as long after each failure, up to maxBackoff
+  seconds. Return the new connection, or None after reconnectTries
+  failures.'''
+  global host, port, ssltls, user, passwd, reconnectTries, maxBackoff
+  global stats
+  try:
+    srvr.shutdown()
+  except Exception:
+    pass
+  delay = 1.0
+  for attempt in xrange(reconnectTries):
+    # Connections that were lost together shouldn't all come back at once
+    wait = random.uniform(delay / 2, delay)
+    print >>sys.stderr, 'Connection lost: %s; reconnecting in %.1f seconds' \
+      % (reason, wait)
+    if stats:
+      stats.count('reconnects')
+    time.sleep(wait)
+    try:
+      srvr = srvConnect(host, port, ssltls)
+      if srvr and srvLogin(srvr, user, passwd):
+	return srvr
+      reason = 'unable to log in'
+    except (imaplib.IMAP4.error, socket.error) as e:
+      reason = e
+    delay = min(delay * 2, maxBackoff)
+  print >>sys.stderr, 'Giving up: %s' % reason
+  return None
 
 
-def getMailboxes(srvr):
-  '''Return list of Mbox objects for this server.'''
+def withReconnect(srvr, call, mbox, *args):
+  '''Call call(srvr, mbox, *args). If the connection is lost, reconnect
+  and call it again, up to reconnectTries times; call has to pick up
+  where it left off. Return the connection, which may be a new one, or
+  None if it can't be restored.'''
+  global reconnectTries
+  for attempt in xrange(reconnectTries + 1):
+    try:
+      call(srvr, mbox, *args)
+      return srvr
+    except (imaplib.IMAP4.abort, socket.error) as e:
+      srvr = reconnect(srvr, e)
+      if not srvr:
+	return None
+  print >>sys.stderr, '%s: connection lost %d times, giving up' % \
+    (mbox, reconnectTries + 1)
+  return srvr
+
+
+def startCompression(srvr):
+  '''Turn on COMPRESS=DEFLATE (RFC 4978) for this connection.'''
+  global verbose, stats
+  try:
+    resp = srvr._simple_command('COMPRESS', 'DEFLATE')
+  except imaplib.IMAP4.error as e:
+    resp = ('NO', [str(e)])
+  if resp[0] != 'OK':
+    if verbose:
+      print 'COMPRESS failed: %s' % resp[1][-1]
+    return
+  stream = DeflateStream(getattr(srvr, 'sslobj', None) or srvr.sock)
+  srvr.read = stream.read
+  srvr.readline = stream.readline
+  srvr.send = stream.send
+  deflateStreams.append(stream)
+  if stats:
+    countBytes(srvr)
+  if verbose >= 2:
+    print 'Compression enabled'
+
+
+def reportCompression():
+  '''Report how well COMPRESS=DEFLATE did, over all connections.'''
+  global verbose, quiet
+  if not deflateStreams or not verbose or quiet:
+    return
+  bytesIn = sum(stream.bytesIn for stream in deflateStreams)
+  wireIn = sum(stream.wireIn for stream in deflateStreams)
+  bytesOut = sum(stream.bytesOut for stream in deflateStreams)
+  wireOut = sum(stream.wireOut for stream in deflateStreams)
+  print 'Compression: received %d bytes as %d (%.1fx), sent %d bytes as %d (%.1fx)' % \
+    (bytesIn, wireIn, float(bytesIn) / max(wireIn, 1),
+     bytesOut, wireOut, float(bytesOut) / max(wireOut, 1))
+
+
+def reportStats():
+  '''Print the --stats summary and write the --stats-json and
+  --stats-log files.'''
+  global stats, statsSummary, statsFile, statsLogger
+  if not stats:
+    return
+  if statsLogger:
+    statsLogger.stop()
+  if statsSummary:
+    stats.report(sys.stderr)
+  if statsFile:
+    try:
+      with open(statsFile, 'w') as ofile:
+	json.dump(stats.snapshot(), ofile, indent=2, sort_keys=True,
+		  separators=(',', ': '))
+	ofile.write('\n')
+    except IOError as e:
+      print >>sys.stderr, 'Unable to write %s: %s' % (statsFile, e)
+
+
+def throttled(nmsgs, nbytes, call, *args):
+  '''Call call(*args) once the throttle allows nmsgs messages of nbytes
+  bytes, and tell the throttle how long it took. If the server says it
+  is overloaded, slow down and try again, up to throttleRetries times.'''
+  global throttle, throttleRetries, stats
+  if throttle is None:
+    return call(*args)
+  for retries in xrange(throttleRetries, -1, -1):
+    if stats and retries < throttleRetries:
+      stats.count('throttle_retries')
+    throttle.wait(nmsgs, nbytes)
+    t0 = time.time()
+    try:
+      result = call(*args)
+    except imaplib.IMAP4.abort as e:
+      if throttleRe.search(str(e)):
+	throttle.backoff(str(e))
+      raise
+    except imaplib.IMAP4.error as e:
+      if not retries or not throttleRe.search(str(e)):
+	raise
+      throttle.backoff(str(e))
+      continue
+    if retries and isinstance(result, tuple) and result[0] == 'NO' and \
+	throttleRe.search(str(result[1][-1])):
+      throttle.backoff(str(result[1][-1]))
+      continue
+    throttle.done(nmsgs, nbytes, time.time() - t0)
+    return result
+
+
+def appendThrottled(srvr, mboxname, items):
+  '''appendMessages() under the throttle. Messages the server refuses
+  because it is overloaded are tried again after slowing down.'''
+  global throttle, throttleRetries, stats
+  results = [None] * len(items)
+  todo = range(len(items))
+  for retries in xrange(throttleRetries, -1, -1):
+    batch = [items[i] for i in todo]
+    batchResults = throttled(len(batch), sum(len(item[2]) for item in batch),
+      appendMessages, srvr, mboxname, batch)
+    again = []
+    for i, result in zip(todo, batchResults):
+      results[i] = result
+      if result[0] != 'OK' and throttleRe.search(str(result[1][-1])):
+	again.append(i)
+    if not again or not retries or throttle is None:
+      break
+    throttle.backoff(str(results[again[0]][1][-1]))
+    if stats:
+      stats.count('throttle_retries', len(again))
+    todo = again
+  return results
+
+
+def appendMessages(srvr, mboxname, items):
+  '''Append several messages to a mailbox. items is a list of (flags,
+  date, message) tuples; date is a quoted INTERNALDATE or None.
+  MULTIAPPEND (RFC 3502) sends them all in one command;
+  LITERAL+ (RFC 7888) lets us send one APPEND per message without
+  waiting for the server in between. Return a (typ, data) result for
+  each message.'''
+  global verbose
+  items = [(flags, date, imaplib.MapCRLF.sub(imaplib.CRLF, message))
+	   for flags, date, message in items]
+  literalPlus = 'LITERAL+' in srvr.capabilities
+  if 'MULTIAPPEND' in srvr.capabilities and len(items) > 1:
+    result = multiAppend(srvr, mboxname, items, literalPlus)
+    if result[0] == 'OK':
+      return [result] * len(items)
+    # Nothing was appended; go one at a time to see which ones fail
+    if verbose >= 2:
+      print 'MULTIAPPEND failed: %s' % result[1][-1]
+  if literalPlus:
+    return pipelineAppend(srvr, mboxname, items)
+  results = []
+  for flags, date, message in items:
+    try:
+      results.append(srvr.append(mboxname, flags, date, message))
+    except imaplib.IMAP4.abort:
+      raise
+    except imaplib.IMAP4.error as e:
+      results.append(('BAD', [str(e)]))
+  return results
+
+
+def appendPrefix(flags, date, size, literalPlus):
+  '''Return the "(flags) date {size}" part of an APPEND command.'''
+  return '%s%s{%d%s}' % ('(%s) ' % flags if flags else '',
+    date + ' ' if date else '', size, '+' if literalPlus else '')
+
+
+def multiAppend(srvr, mboxname, items, literalPlus):
+  '''Append all the messages with a single MULTIAPPEND command. Without
+  LITERAL+ we have to wait for the server to ask for each message.'''
+  tag = srvr._new_tag()
+  cmd = '%s APPEND %s ' % (tag, srvr._checkquote(mboxname))
+  try:
+    for flags, date, message in items:
+      srvr.send(cmd + appendPrefix(flags, date, len(message), literalPlus) +
+	imaplib.CRLF)
+      if not literalPlus:
+	while srvr._get_response():
+	  if srvr.tagged_commands[tag]:
+	    # Rejected before we got to send everything
+	    return srvr._command_complete('APPEND', tag)
+      srvr.send(message)
+      cmd = ' '
+    srvr.send(imaplib.CRLF)
+    return srvr._command_complete('APPEND', tag)
+  except imaplib.IMAP4.abort:
+    raise
+  except imaplib.IMAP4.error as e:
+    return ('BAD', [str(e)])
+
+
+def streamAppend(srvr, mboxname, flags, date, store, uid, size):
+  '''APPEND message uid from the store, sending it chunkSize bytes at a
+  time as it is read. size is its length once its line endings are
+  made CRLF, which has to be sent first.'''
+  literalPlus = 'LITERAL+' in srvr.capabilities
+  tag = srvr._new_tag()
+  srvr.send('%s APPEND %s %s%s' % (tag, srvr._checkquote(mboxname),
+    appendPrefix(flags, date, size, literalPlus), imaplib.CRLF))
+  if not literalPlus:
+    while srvr._get_response():
+      if srvr.tagged_commands[tag]:
+	# Rejected before we sent the message
+	return srvr._command_complete('APPEND', tag)
+  with store.open(uid) as msgFile:
+    for chunk in crlfChunks(msgFile):
+      srvr.send(chunk)
+  srvr.send(imaplib.CRLF)
+  return srvr._command_complete('APPEND', tag)
+
+
+def pipelineAppend(srvr, mboxname, items):
+  '''Send one APPEND per message using non-synchronizing literals,
+  then collect the results.'''
+  mboxname = srvr._checkquote(mboxname)
+  tags = []
+  for flags, date, message in items:
+    tag = srvr._new_tag()
+    srvr.send('%s APPEND %s %s%s%s%s' % (tag, mboxname,
+      appendPrefix(flags, date, len(message), True), imaplib.CRLF, message,
+      imaplib.CRLF))
+    tags.append(tag)
+  results = []
+  for tag in tags:
+    try:
+      results.append(srvr._command_complete('APPEND', tag))
+    except imaplib.IMAP4.abort:
+      raise
+    except imaplib.IMAP4.error as e:
+      results.append(('BAD', [str(e)]))
+  return results
+
+
+def searchUids(srvr):
+  '''Return the UIDs of the messages in the selected mailbox that match
+  searchKeys, or of all of them if there are none, in ascending order.
+  ESEARCH (RFC 4731) gets them as ranges rather than one by one.'''
+  global searchKeys
+  criteria = '(%s)' % ' '.join(searchKeys) if searchKeys else 'ALL'
+  if 'ESEARCH' in srvr.capabilities:
+    typ, data = srvr.uid('SEARCH', 'RETURN', '(ALL)', criteria)
+    if typ != 'OK':
+      raise srvr.error('SEARCH failed: %s' % data[-1])
+    uids = []
+    for resp in srvr.response('ESEARCH')[1]:
+      words = (resp or '').split()
+      if 'ALL' in words[:-1]:
+	uids.extend(parseUidSet(words[words.index('ALL') + 1]))
+    return sorted(uids)
+  typ, data = srvr.uid('SEARCH', criteria)
+  if typ != 'OK':
+    raise srvr.error('SEARCH failed: %s' % data[-1])
+  return sorted(map(int, ' '.join(filter(None, data)).split()))
+
+
+def hasCondstore(srvr):
+  '''Return True if the server supports CONDSTORE (RFC 7162).'''
+  return 'CONDSTORE' in srvr.capabilities or 'QRESYNC' in srvr.capabilities
+
+
+def uidFetchStream(srvr, uids, items, spoolDir, spoolKeys):
+  '''Run a UID FETCH, reading the responses as they arrive instead of
+  letting imaplib collect them all. Yields the response data piece by
+  piece, in the same form as imaplib's fetch(), for iterFetch(). Literals belonging to
+  the items in spoolKeys are copied to temporary files in spoolDir and
+  replaced by SpooledLiteral objects, so memory use stays bounded by
+  chunkSize however big the messages are.'''
+  tag = srvr._command('UID', 'FETCH', uids, items)
+  while True:
+    line = srvr._get_line()
+    if line.startswith(tag + ' '):
+      del srvr.tagged_commands[tag]
+      typ, text = (line[len(tag)+1:].split(' ', 1) + [''])[:2]
+      commandDone(srvr, tag, 'UID FETCH', typ == 'OK')
+      if typ != 'OK':
+	raise srvr.error('UID FETCH command error: %s %s' % (typ, text))
+      return
+    if line.startswith('* BYE'):
+      raise srvr.abort(line[2:])
+    fetch = fetchRe.match(line)
+    text = '%s %s' % fetch.groups() if fetch else line
+    # Keep reading while the text ends with a literal
+    while True:
+      literal = literalRe.search(text)
+      if not literal:
+	break
+      size = int(literal.group(1))
+      key = text[:literal.start()].split()[-1]
+      if fetch and key in spoolKeys:
+	value = spoolLiteral(srvr, size, spoolDir)
+      else:
+	value = srvr.read(size)
+      if fetch:
+	yield (text, value)
+      text = srvr._get_line()
+    if fetch:
+      yield text
+
+
+def spoolLiteral(srvr, size, spoolDir):
+  '''Copy a literal from the server to a temporary file, chunkSize
+  bytes at a time. Return a SpooledLiteral.'''
+  global chunkSize, stats
+  fd, path = tempfile.mkstemp(prefix='.download', dir=spoolDir)
+  # mkstemp makes the file private; give it the usual permissions
+  os.fchmod(fd, 0666 & ~umask)
+  head = ''
+  writeTime = 0.0
+  try:
+    with os.fdopen(fd, "wb") as ofile:
+      remaining = size
+      while remaining > 0:
+	chunk = srvr.read(min(remaining, chunkSize))
+	if not chunk:
+	  raise srvr.abort('connection closed during literal')
+	t0 = time.time()
+	ofile.write(chunk)
+	writeTime += time.time() - t0
+	if len(head) < SpooledLiteral.HEAD_SIZE:
+	  head += chunk[:SpooledLiteral.HEAD_SIZE - len(head)]
+	remaining -= len(chunk)
+  except:
+    os.unlink(path)
+    raise
+  if stats:
+    stats.record('write', writeTime)
+  return SpooledLiteral(path, size, head)
+
+
+def getMailboxes(srvr, status=False):
+  '''Return list of Mbox objects for this server. With status, also
+  set each mailbox's status from a planning pass: the LIST itself
+  returns it where the server has LIST-STATUS (RFC 5819), otherwise
+  we send STATUS commands without waiting for each answer.'''
+  if status and 'LIST-STATUS' in srvr.capabilities:
+    try:
+      typ, data = srvr._simple_command('LIST', '""', '*', 'RETURN',
+	'(STATUS (%s))' % ' '.join(statusItems(srvr)))
+      resp = srvr._untagged_response(typ, data, 'LIST')
+    except imaplib.IMAP4.abort:
+      raise
+    except imaplib.IMAP4.error:
+      resp = ('NO', None)
+    if resp[0] == 'OK':
+      mailboxes = map(Mbox, resp[1])
+      setStatuses(srvr, mailboxes)
+      mailboxes.sort()
+      return mailboxes
   mailboxes = srvr.list()
   if mailboxes[0] == 'OK':
     mailboxes = map(Mbox, mailboxes[1])
     mailboxes.sort()
+    if status:
+      pipelineStatus(srvr, mailboxes)
     return mailboxes
   else:
     return None
 
 
+def pipelineStatus(srvr, mailboxes):
+  '''Ask for the STATUS of every selectable mailbox, sending
+  statusChunk commands at a time before reading the answers.'''
+  global statusChunk
+  items = '(%s)' % ' '.join(statusItems(srvr))
+  boxes = [mbox for mbox in mailboxes if not mbox.flags & MBOX_NO_SELECT]
+  for i in xrange(0, len(boxes), statusChunk):
+    tags = [srvr._command('STATUS', str(mbox), items)
+	    for mbox in boxes[i:i+statusChunk]]
+    for tag in tags:
+      try:
+	srvr._command_complete('STATUS', tag)
+      except imaplib.IMAP4.abort:
+	raise
+      except imaplib.IMAP4.error:
+	# Leave that one to be asked about again when it's needed
+	pass
+    setStatuses(srvr, mailboxes)
+
+
+def setStatuses(srvr, mailboxes):
+  '''Set the status of each mailbox from the untagged STATUS responses
+  received so far. Responses are matched to mailboxes by name.'''
+  byName = dict((mbox.name, mbox) for mbox in mailboxes)
+  for resp in srvr.response('STATUS')[1]:
+    if not isinstance(resp, str):
+      # A name sent as a literal; that mailbox gets no status
+      continue
+    mbox = byName.get(parseList(resp)[0])
+    if mbox:
+      mbox.status = parseStatus(resp)
+
+
 # ---- UTILITIES ----
 
 def parseEmail(email, u=None, h=None, p=None):
@@ -842,8 +4463,11 @@ def parseEmailAndDefaults(emailAddr):
 
   if emailAddr:
     user,h,p = parseEmail(emailAddr, user, host, port)
-    if not host: host = h
     if not port: port = p
+    if not host:
+      host = h
+      if host and not port and ssltls == None:
+	useProbeCache()
 
   if not host: host = 'localhost'
 
@@ -856,6 +4480,50 @@ def parseEmailAndDefaults(emailAddr):
     port = 993 if ssltls else 143
 
 
+def readProbeCache():
+  '''Return the servers found by the probe command, as a dict mapping
+  domain to (host, port, ssltls).'''
+  global probeCacheFile
+  cache = {}
+  try:
+    with open(probeCacheFile, "r") as ifile:
+      for line in ifile:
+	words = line.split()
+	if len(words) == 4 and words[2].isdigit():
+	  cache[words[0].lower()] = (words[1], int(words[2]), words[3] == 'ssl')
+  except IOError:
+    pass
+  return cache
+
+
+def writeProbeCache(domain, h, p, s):
+  '''Remember the server found for a domain.'''
+  global probeCacheFile
+  cache = readProbeCache()
+  cache[domain.lower()] = (h, p, s)
+  try:
+    with open(probeCacheFile + '.tmp', "w") as ofile:
+      for d in sorted(cache):
+	h, p, s = cache[d]
+	print >>ofile, d, h, p, 'ssl' if s else 'nossl'
+    os.rename(probeCacheFile + '.tmp', probeCacheFile)
+  except (IOError, OSError) as e:
+    print >>sys.stderr, 'Failed to write %s: %s' % (probeCacheFile, e)
+
+
+def useProbeCache():
+  '''If the probe command found the server for the domain in host, use
+  the host, port and security it found.'''
+  global host, port, ssltls, verbose
+  if not host:
+    return
+  cached = readProbeCache().get(host.lower())
+  if cached:
+    host, port, ssltls = cached
+    if verbose:
+      print 'Using %s:%d, ssl %s, found by probe' % cached
+
+
 def matchBoxes(pat, mailboxes, excludes):
   '''Given a pattern, a list of mailboxes, and a list of "exclude"
   patterns, return a list of mailboxes that match the pattern and
@@ -865,11 +4533,179 @@ def matchBoxes(pat, mailboxes, excludes):
     boxes = [x for x in boxes if not included(str(x), excludes)]
   return boxes
 
+def matchAll(patterns, mailboxes, excludes):
+  '''matchBoxes() for each of several patterns. A mailbox that matches
+  more than one of them is only returned once.'''
+  boxes = []
+  seen = set()
+  for pat in patterns:
+    for mbox in matchBoxes(pat, mailboxes, excludes):
+      if mbox.name not in seen:
+	seen.add(mbox.name)
+	boxes.append(mbox)
+  return boxes
+
 def included(name, patterns):
   '''Return True if "name" is in any of the patterns'''
   return any(fnmatch.fnmatch(name, pat) for pat in patterns)
 
 
+def fileDigest(path):
+  '''Return the SHA-1 of a file's contents, and its size.'''
+  global chunkSize
+  digest = hashlib.sha1()
+  size = 0
+  with open(path, "rb") as ifile:
+    while True:
+      chunk = ifile.read(chunkSize)
+      if not chunk:
+	break
+      digest.update(chunk)
+      size += len(chunk)
+  return digest.hexdigest(), size
+
+
+def syncFiles(paths):
+  '''Make files, and the directory entries for them, durable. Each file
+  is fdatasynced, then each directory they are in is fsynced once.'''
+  datasync = getattr(os, 'fdatasync', os.fsync)
+  dirs = sorted(set(os.path.dirname(path) or '.' for path in paths))
+  for path, sync in [(path, datasync) for path in paths] + \
+		    [(path, os.fsync) for path in dirs]:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+      sync(fd)
+    finally:
+      os.close(fd)
+
+
+def copyFile(ifile, ofile):
+  '''Copy one file object to another, chunkSize bytes at a time.'''
+  global chunkSize
+  while True:
+    chunk = ifile.read(chunkSize)
+    if not chunk:
+      break
+    ofile.write(chunk)
+
+
+def crlfChunks(ifile):
+  '''Yield the contents of a file chunkSize bytes at a time, with its
+  line endings made CRLF the way imaplib does for APPEND.'''
+  global chunkSize
+  carry = ''
+  while True:
+    chunk = ifile.read(chunkSize)
+    if not chunk:
+      break
+    chunk = carry + chunk
+    # A CR at the end may be the first half of a CRLF
+    carry = '\r' if chunk.endswith('\r') else ''
+    chunk = chunk[:len(chunk)-len(carry)]
+    crlf = chunk.count('\r\n')
+    if chunk.count('\r') != crlf or chunk.count('\n') != crlf:
+      chunk = imaplib.MapCRLF.sub(imaplib.CRLF, chunk)
+    yield chunk
+  if carry:
+    yield imaplib.CRLF
+
+
+def uidSet(uids):
+  '''Convert a list of UIDs to an IMAP sequence set, e.g. "1:4,7,9:10".'''
+  uids = sorted(uids)
+  ranges = []
+  i = 0
+  while i < len(uids):
+    j = i
+    while j+1 < len(uids) and uids[j+1] == uids[j]+1:
+      j += 1
+    if i == j:
+      ranges.append('%d' % uids[i])
+    else:
+      ranges.append('%d:%d' % (uids[i], uids[j]))
+    i = j+1
+  return ','.join(ranges)
+
+
+def parseUidSet(value):
+  '''Convert an IMAP UID set such as "1:4,7" to a list of UIDs, in the
+  order given.'''
+  uids = []
+  for part in value.split(','):
+    if ':' in part:
+      first, last = map(int, part.split(':'))
+      step = 1 if last >= first else -1
+      uids.extend(xrange(first, last + step, step))
+    else:
+      uids.append(int(part))
+  return uids
+
+
+def bodyParts(structure):
+  '''Return the parts of a multipart BODYSTRUCTURE.'''
+  parts = []
+  for item in structure:
+    if not isinstance(item, list):
+      break
+    parts.append(item)
+  return parts
+
+
+def partNumbers(structure, prefix=''):
+  '''Yield the section numbers of the parts of a multipart BODYSTRUCTURE,
+  such as '1', '2' and '2.1'.'''
+  if isinstance(structure, list) and structure and \
+      isinstance(structure[0], list):
+    for i, part in enumerate(bodyParts(structure)):
+      number = prefix + str(i+1)
+      yield number
+      for sub in partNumbers(part, number + '.'):
+	yield sub
+
+
+def bodyParam(params, name):
+  '''Return a parameter from a BODYSTRUCTURE parameter list, or None.'''
+  if not isinstance(params, list):
+    return None
+  for i in xrange(0, len(params)-1, 2):
+    if str(params[i]).upper() == name:
+      return params[i+1]
+  return None
+
+
+def formatHoles(holes):
+  '''Return a list of (offset, size) holes as text, e.g. "410+2048".'''
+  return ','.join('%d+%d' % hole for hole in holes)
+
+
+def parseHoles(text):
+  '''Parse the text made by formatHoles().'''
+  return [tuple(map(int, hole.split('+'))) for hole in text.split(',')]
+
+
+def parseSize(value):
+  '''Convert a size such as "500", "64k" or "10M" to a byte count.'''
+  mult = {'k': 1024, 'm': 1024*1024, 'g': 1024*1024*1024}
+  value = value.strip()
+  if value and value[-1].lower() in mult:
+    return int(float(value[:-1]) * mult[value[-1].lower()])
+  return int(value)
+
+
+def imapDate(value):
+  '''Convert a date given as YYYY-MM-DD, or as a number of days ago
+  such as "7d", to the form SEARCH wants, e.g. "9-Oct-2026".'''
+  value = value.strip()
+  if value[-1:].lower() == 'd' and value[:-1].isdigit():
+    when = time.localtime(time.time() - int(value[:-1]) * 86400)
+  else:
+    try:
+      when = time.strptime(value, '%Y-%m-%d')
+    except ValueError:
+      raise ValueError('Bad date %r: use YYYY-MM-DD or e.g. 7d' % value)
+  return '%d-%s-%d' % (when.tm_mday, MONTHS[when.tm_mon - 1], when.tm_year)
+
+
 def parseList(srvresp):
   '''Scan string s for (lists) and strings. Return list of results'''
   rval = []
@@ -898,85 +4734,112 @@ def parseList(srvresp):
   return rval
 
 
+def normalizeMsgId(msgId):
+  '''Reduce a Message-Id to its <...> part, so that ids which differ
+  only in whitespace or comments compare equal.'''
+  m = msgIdRe.search(msgId)
+  return m.group(0) if m else msgId.strip()
+
+
+def parseStatus(resp):
+  '''Parse a STATUS response such as '"INBOX" (MESSAGES 3 UIDNEXT 4)'
+  into a dict of integers.'''
+  if isinstance(resp, tuple):
+    resp = resp[-1]
+  items = resp[resp.rfind('(')+1:resp.rfind(')')].split()
+  status = {}
+  for i in xrange(0, len(items)-1, 2):
+    try:
+      status[items[i].upper()] = int(items[i+1])
+    except ValueError:
+      pass
+  return status
+
+
 def parseFetch(resp):
   '''Parse a fetch() response; return a list of messages. Each
   message is a dict contining 'msgno' plus any other fields
   requested in the fetch() request.'''
-  # Each message consists of a sequence of tuples and
-  # strings. The message is terminated by a string that
-  # ends with ')'
-  # resp ::= ['OK', [message…]]
-  # message ::= rstring|tuple… rstring')'
-  # tuple ::= (rstring, bodyString)
-  # rstring ::= rpart…
-  # rpart ::= key intvalue | key (listvalue) | key {size}
   if not isinstance(resp, tuple):
     print >>sys.stderr, resp, 'is not a tuple'
     return None
   if len(resp) < 1 or resp[0] != 'OK':
     print >>sys.stderr, resp, 'is not a valid response'
     return None
-  resp = resp[1]
-  messages = []
-  while resp:
-    idx = messageEnd(resp)
-    msg = parseMessage(resp[:idx+1])
-    if msg:
-      messages.append(msg)
-    resp = resp[idx+1:]
-  return messages
-
-def messageEnd(l):
-  '''Search list for a string that ends with ')'; return the
-  index of that entry.'''
-  for i,x in enumerate(l):
-    if isinstance(x, (str,unicode)) and x.endswith(')'):
-      return i
-  return len(l)-1
-
-def parseMessage(resp):
-  '''A message is a sequence of 2-tuples and strings. In
-  the case of a 2-tuple, the second half is the text content
-  of something, such as the message headers or body.'''
-  # The first element will start with the message number and '('
-  msg = {}
-  first = True
-  for item in resp:
-    if isinstance(item, (str, unicode)):
-      parseMessageStr(msg, item, first)
+  return list(iterFetch(resp[1]))
+
+
+def iterFetch(data):
+  '''Parse FETCH response data, as found in imaplib's fetch() result
+  or produced by uidFetchStream(), in a single pass. The data is a
+  sequence of strings and (string, literal) tuples; each message is
+  yielded as soon as its closing parenthesis has been seen, as a dict
+  containing 'msgno' plus the fetched items. Numbers become ints, NIL
+  becomes None, parenthesized lists become lists, and literals are
+  passed through as they are. With --stats, the time spent parsing
+  each message is recorded.'''
+  global stats
+  # resp ::= msgno '(' key value [key value…] ')'
+  # value ::= number | atom | NIL | "string" | {size} literal | list
+  # list ::= '(' [value…] ')'
+  stack = []
+  msgno = None
+  parseTime = 0.0
+  for item in data:
+    t0 = time.time()
+    if isinstance(item, tuple):
+      text, literal = item
     else:
-      key = parseMessageStr(msg, item[0], first)
-      msg[key] = item[1]
-    first = False
-  return msg
-
-def parseMessageStr(msg, item, firstItem):
-  if firstItem:
-    item = item.split(' ', 1)
-    msg['msgno'] = int(item[0])
-    item = item[1]
-  item = item.strip('()')
-  key = None
-  while item:
-    item = item.lstrip()
-    item = item.split(' ',1)
-    if len(item) < 2:
-      return None
-    key,item = item
-    if item[0].isdigit():
-      item = item.split(' ',1)
-      msg[key] = int(item[0])
-      if len(item) < 2:
-	return None
-      item = item[1]
-    elif item.startswith('('):
-      idx = item.find(')')
-      flags = item[1:idx]
-      msg[key] = flags.split()
-      item = item[idx+1:]
-    elif item.startswith('{'):
-      return key
-  return None
+      text, literal = item, None
+    if text is None:
+      continue
+    pos = 0
+    end = len(text)
+    while pos < end:
+      m = fetchTokenRe.match(text, pos)
+      if m is None:
+	if text[pos:].strip():
+	  print >>sys.stderr, "Malformed server response:", text
+	break
+      pos = m.end()
+      kind = m.lastindex
+      if kind == 1:
+	stack.append([])
+	continue
+      elif kind == 2:
+	if not stack:
+	  continue
+	value = stack.pop()
+	if not stack:
+	  msg = {'msgno': msgno}
+	  for i in xrange(0, len(value)-1, 2):
+	    msg[value[i]] = value[i+1]
+	  if 'FLAGS' in msg:
+	    msg['FLAGS'] = map(str, msg['FLAGS'])
+	  msgno = None
+	  if stats:
+	    stats.record('parse', parseTime + time.time() - t0)
+	  parseTime = 0.0
+	  yield msg
+	  t0 = time.time()
+	  continue
+      elif kind == 3:
+	value = m.group(3)
+	if '\\' in value:
+	  value = quotedCharRe.sub(r'\1', value)
+      elif kind == 4:
+	value = literal
+      elif kind == 5:
+	value = m.group(5)
+	if value.isdigit():
+	  value = int(value)
+	elif value == 'NIL':
+	  value = None
+      if stack:
+	stack[-1].append(value)
+      else:
+	msgno = value
+    parseTime += time.time() - t0
 
 
 def specialName(name):
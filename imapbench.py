@@ -0,0 +1,1023 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+usage = """Benchmarks for imap.py
+
+Usage:  imapbench [options] benchmark...
+
+    options:
+
+	-n count	number of messages per mailbox (default 20000)
+	-r repeat	run each benchmark this many times, report the
+			best (default 3)
+	-b n		number of mailboxes (default 1)
+	-s size		size of each message, e.g. 10k (default 4k)
+	-A size		also give each message an attachment this big
+	-F n		number of extra folders (default 10000 for listboxes,
+			none otherwise)
+	-L ms		latency added to each round trip, in milliseconds
+	-o options	more options for imap.py, e.g. '-j 4 --store pack'
+	-p port		port for the serve command (default 1143)
+	--bandwidth n	limit the fake server to n bytes per second
+	--caps list	capabilities the fake server announces, separated
+			by commas (default all it has)
+
+	--help		this list
+
+    benchmarks:
+
+	parser		parse FETCH responses with parseFetch(), and with
+			the parser it replaced
+	download	download every mailbox into an empty directory
+	upload		upload every mailbox to an empty server
+	list		list the messages in INBOX
+	listboxes	list the mailboxes, and the extra folders
+
+    The server benchmarks run imap.py against a fake IMAP server on
+    127.0.0.1, and report messages per second, MB of messages per
+    second, round trips per message and imap.py's peak memory use.
+
+	serve		just run the fake server, until interrupted
+
+"""
+
+import sys
+import os
+import getopt
+import time
+import re
+import socket
+import zlib
+import shutil
+import tempfile
+import threading
+import subprocess
+import SocketServer
+import email.utils
+
+import imap
+
+nmesg = 20000
+repeat = 3
+nboxes = 1
+msgSize = 4*1024
+attachSize = 0
+nfolders = None
+latency = 0.0
+bandwidth = 0
+caps = None
+imapOptions = []
+servePort = 1143
+
+
+def main():
+  global nmesg, repeat, nboxes, msgSize, attachSize, nfolders, latency
+  global bandwidth, caps, imapOptions, servePort
+
+  try:
+    (optlist, args) = getopt.gnu_getopt(sys.argv[1:], 'n:r:b:s:A:F:L:o:p:',
+      ['help','bandwidth=','caps='])
+    for flag, value in optlist:
+      if flag == '-n': nmesg = int(value)
+      elif flag == '-r': repeat = max(1, int(value))
+      elif flag == '-b': nboxes = max(1, int(value))
+      elif flag == '-s': msgSize = imap.parseSize(value)
+      elif flag == '-A': attachSize = imap.parseSize(value)
+      elif flag == '-F': nfolders = int(value)
+      elif flag == '-L': latency = float(value) / 1000
+      elif flag == '-o': imapOptions = value.split()
+      elif flag == '-p': servePort = int(value)
+      elif flag == '--bandwidth': bandwidth = imap.parseSize(value)
+      elif flag == '--caps': caps = value.upper().split(',')
+      elif flag == '--help':
+	print usage
+	return 0
+  except getopt.GetoptError as e:
+    print >>sys.stderr, e
+    print >>sys.stderr, "--help for more info"
+    return 2
+  except ValueError as e:
+    print >>sys.stderr, e
+    print >>sys.stderr, "--help for more info"
+    return 2
+
+  benchmarks = {'parser': benchParser, 'download': benchDownload,
+		'upload': benchUpload, 'list': benchList,
+		'listboxes': benchListBoxes, 'serve': serve}
+  if not args:
+    args = ['parser']
+  for name in args:
+    if name not in benchmarks:
+      print >>sys.stderr, "Benchmark '%s' not recognized" % name
+      print >>sys.stderr, usage
+      return 2
+  for name in args:
+    benchmarks[name]()
+  return 0
+
+
+def best(func, *args):
+  '''Run func repeat times, return the shortest time taken.'''
+  times = []
+  for i in xrange(repeat):
+    t0 = time.time()
+    func(*args)
+    times.append(time.time() - t0)
+  return min(times)
+
+
+def benchParser():
+  '''Time both parsers on the responses to the fetches imap.py makes.'''
+  header = 'From: someone@example.com\r\nSubject: test\r\n' \
+    'Message-ID: <%d@example.com>\r\n\r\n'
+  sizes = []
+  headers = []
+  for i in xrange(1, nmesg+1):
+    sizes.append('%d (UID %d RFC822.SIZE %d FLAGS (\\Seen))' % (i, i+100, 1000+i))
+    headers.append(('%d (UID %d RFC822.HEADER {%d}' % (i, i+100, len(header % i)),
+		    header % i))
+    headers.append(')')
+  responses = (('(UID RFC822.SIZE FLAGS)', sizes),
+	       ('(UID RFC822.HEADER)', headers))
+  for items, data in responses:
+    resp = ('OK', data)
+    new = best(imap.parseFetch, resp)
+    old = best(legacyParseFetch, resp)
+    print 'parser %-24s %6d messages: parseFetch %.3fs, legacy %.3fs (%.1fx)' % \
+      (items, nmesg, new, old, old / max(new, 1e-6))
+
+
+# ---- Benchmarks against the fake server ----
+
+def benchDownload():
+  '''Download all the mailboxes into a new directory.'''
+  fake = newServer()
+  fake.populate(nboxes, nmesg, msgSize)
+  runs = []
+  for i in xrange(repeat):
+    mailDir = tempfile.mkdtemp(prefix='imapbench')
+    try:
+      runs.append(runImap(fake, '-d', mailDir, 'download'))
+    finally:
+      shutil.rmtree(mailDir)
+  report('download', nboxes * nmesg, fake.messageBytes(), runs)
+  fake.close()
+
+
+def benchUpload():
+  '''Upload all the mailboxes to a server that has none. The local copy
+  comes from a download, which isn't timed.'''
+  fake = newServer()
+  fake.populate(nboxes, nmesg, msgSize)
+  total = fake.messageBytes()
+  mailDir = tempfile.mkdtemp(prefix='imapbench')
+  try:
+    runImap(fake, '-d', mailDir, 'download')
+    runs = []
+    for i in xrange(repeat):
+      fake.clear()
+      for dirpath, dirnames, filenames in os.walk(mailDir):
+	for name in filenames:
+	  if name.startswith(imap.UploadJournal.PREFIX):
+	    os.remove(os.path.join(dirpath, name))
+      runs.append(runImap(fake, '-d', mailDir, 'upload'))
+  finally:
+    shutil.rmtree(mailDir)
+  report('upload', nboxes * nmesg, total, runs)
+  fake.close()
+
+
+def benchList():
+  '''List the messages in INBOX, first with an empty list cache each
+  time, then again with the cache those runs left.'''
+  fake = newServer()
+  fake.populate(1, nmesg, msgSize)
+  cacheDir = tempfile.mkdtemp(prefix='imapbench')
+  try:
+    runs = []
+    for i in xrange(repeat):
+      shutil.rmtree(cacheDir)
+      runs.append(runImap(fake, '--cache', cacheDir, 'list', 'INBOX'))
+    report('list', nmesg, fake.messageBytes(), runs)
+    runs = [runImap(fake, '--cache', cacheDir, 'list', 'INBOX')
+	    for i in xrange(repeat)]
+    report('list-warm', nmesg, fake.messageBytes(), runs)
+  finally:
+    shutil.rmtree(cacheDir, True)
+  fake.close()
+
+
+def benchListBoxes():
+  '''List the mailboxes of an account with a great many folders.'''
+  folders = 10000 if nfolders is None else nfolders
+  fake = newServer()
+  fake.populate(nboxes, 0, msgSize, folders)
+  runs = [runImap(fake, 'listboxes') for i in xrange(repeat)]
+  report('listboxes', nboxes + folders, 0, runs, 'folders')
+  fake.close()
+
+
+def serve():
+  '''Run the fake server on servePort until interrupted, for trying
+  imap.py by hand.'''
+  fake = FakeServer(servePort, caps, latency, bandwidth)
+  fake.populate(nboxes, nmesg, msgSize, nfolders or 0)
+  print 'Fake server on 127.0.0.1:%d, any user and password will do' % \
+    fake.port
+  try:
+    fake.tcpServer.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+def newServer():
+  '''Start a fake server on a free port, as the options say.'''
+  fake = FakeServer(0, caps, latency, bandwidth)
+  fake.start()
+  return fake
+
+
+# Runs a command and writes its peak RSS to the file named first. Linux
+# keeps a process's peak RSS across exec, so imap.py started straight
+# from here would be charged for the fake server's messages too.
+measureScript = '''import os, sys, subprocess
+proc = subprocess.Popen(sys.argv[2:])
+pid, status, usage = os.wait4(proc.pid, 0)
+open(sys.argv[1], "w").write(str(usage.ru_maxrss))
+sys.exit(1 if status else 0)'''
+
+
+def runImap(fake, *args):
+  '''Run imap.py against the fake server with the given arguments.
+  Return the time taken, imap.py's peak memory use in bytes, and the
+  number of round trips it made.'''
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'imap.py')
+  cmd = [sys.executable, script, '-u', 'bench@127.0.0.1:%d' % fake.port,
+	 '--pw', 'bench'] + imapOptions + list(args)
+  fake.roundTrips = 0
+  fd, rssFile = tempfile.mkstemp(prefix='imapbench')
+  os.close(fd)
+  try:
+    with open(os.devnull, 'w') as devnull, tempfile.TemporaryFile() as errors:
+      t0 = time.time()
+      status = subprocess.call([sys.executable, '-c', measureScript, rssFile] +
+			       cmd, stdout=devnull, stderr=errors)
+      seconds = time.time() - t0
+      if status:
+	errors.seek(0)
+	raise SystemExit('%s failed:\n%s' % (' '.join(cmd), errors.read()))
+    with open(rssFile) as ifile:
+      rss = int(ifile.read())
+  finally:
+    os.unlink(rssFile)
+  # Linux counts kilobytes, macOS bytes
+  rss *= 1 if sys.platform == 'darwin' else 1024
+  return seconds, rss, fake.roundTrips
+
+
+def report(name, count, nbytes, runs, unit='messages'):
+  '''Print the fastest of the runs of a benchmark.'''
+  seconds, rss, roundTrips = min(runs)
+  seconds = max(seconds, 1e-6)
+  print '%-9s %6d %s: %.2fs, %.0f %s/s, %.2f MB/s, %.3f round trips each, ' \
+    'peak RSS %.1f MB' % (name, count, unit, seconds, count / seconds, unit,
+			  nbytes / seconds / 1e6, roundTrips / float(max(count, 1)),
+			  rss / 1e6)
+
+
+# ---- A fake IMAP server ----
+
+def makeMessage(uid, size, mbox, attach=0):
+  '''Return a message of about size bytes, plus a base64 attachment of
+  about attach bytes if attach is not 0.'''
+  header = ('From: Sender %d <sender%d@example.com>\r\n'
+    'To: user@example.com\r\n'
+    'Subject: Test message %d in %s\r\n'
+    'Date: %s\r\n'
+    'Message-ID: <%s.%d@example.com>\r\n\r\n' %
+    (uid % 7, uid % 7, uid, mbox, email.utils.formatdate(1500000000 + uid*60),
+     mbox.replace(' ', '_'), uid))
+  line = 'The quick brown fox jumps over the lazy dog %08d.\r\n'
+  nlines = max(1, (size - len(header)) / len(line % 0))
+  text = ''.join(line % i for i in xrange(nlines))
+  if not attach:
+    return header + text
+  boundary = 'part-%d' % uid
+  data = ('%076d\r\n' % uid) * max(1, attach / 78)
+  return (header[:-2] + 'MIME-Version: 1.0\r\n'
+    'Content-Type: multipart/mixed; boundary="%s"\r\n\r\n'
+    '--%s\r\nContent-Type: text/plain\r\n\r\n%s\r\n'
+    '--%s\r\nContent-Type: application/octet-stream; name="data%d.bin"\r\n'
+    'Content-Transfer-Encoding: base64\r\n\r\n%s\r\n--%s--\r\n' %
+    (boundary, boundary, text, boundary, uid, data, boundary))
+
+
+class FakeMessage(object):
+  def __init__(self, uid, flags, date, data, modseq):
+    self.uid = uid
+    self.flags = list(flags)
+    self.date = date
+    self.data = data
+    self.modseq = modseq
+
+
+class FakeMailbox(object):
+  def __init__(self, name, uidvalidity):
+    self.name = name
+    self.uidvalidity = uidvalidity
+    self.uidnext = 1
+    self.modseq = 1
+    self.messages = []
+
+  def add(self, data, flags=(), date=None):
+    '''Add a message, return its UID.'''
+    self.modseq += 1
+    self.messages.append(FakeMessage(self.uidnext, flags, date or time.time(),
+				     data, self.modseq))
+    self.uidnext += 1
+    return self.uidnext - 1
+
+
+class MimePart(object):
+  '''Just enough MIME parsing for BODYSTRUCTURE and BODY[n] sections.'''
+  def __init__(self, raw):
+    i = raw.find('\r\n\r\n')
+    if i < 0:
+      self.header, self.body = raw, ''
+    else:
+      self.header, self.body = raw[:i+4], raw[i+4:]
+    self.ctype = 'text/plain'
+    self.params = {}
+    self.encoding = '7bit'
+    self.parts = []
+    for line in headerLines(self.header):
+      name, _, value = line.partition(':')
+      if name.lower() == 'content-type':
+	value = value.split(';')
+	self.ctype = value[0].strip().lower()
+	for param in value[1:]:
+	  key, _, pvalue = param.partition('=')
+	  self.params[key.strip().lower()] = pvalue.strip().strip('"')
+      elif name.lower() == 'content-transfer-encoding':
+	self.encoding = value.strip().lower()
+    if self.ctype.startswith('multipart/') and 'boundary' in self.params:
+      for chunk in self.body.split('--' + self.params['boundary'])[1:]:
+	if chunk.startswith('--'):
+	  break
+	self.parts.append(MimePart(chunk[2:-2]))
+
+  def part(self, numbers):
+    '''Return the part with these section numbers, or None.'''
+    part = self
+    for n in numbers:
+      if not part.parts:
+	if n == 1:
+	  continue
+	return None
+      if n > len(part.parts):
+	return None
+      part = part.parts[n-1]
+    return part
+
+  def structure(self):
+    '''Return the BODYSTRUCTURE of this part.'''
+    if self.parts:
+      return '(%s %s ("BOUNDARY" %s))' % (
+	''.join(part.structure() for part in self.parts),
+	quote(self.ctype.split('/')[1].upper()), quote(self.params['boundary']))
+    major, minor = self.ctype.split('/')
+    params = ' '.join('%s %s' % (quote(key.upper()), quote(value))
+		      for key, value in self.params.items())
+    result = '(%s %s %s NIL NIL %s %d' % (quote(major.upper()),
+      quote(minor.upper()), '(%s)' % params if params else 'NIL',
+      quote(self.encoding.upper()), len(self.body))
+    if major == 'text':
+      result += ' %d' % self.body.count('\r\n')
+    return result + ')'
+
+
+def headerLines(header):
+  '''Split a header block into unfolded lines.'''
+  return [line for line in re.split(r'\r\n(?![ \t])', header) if line]
+
+
+def quote(s):
+  if s is None:
+    return 'NIL'
+  return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def literal(s):
+  return '{%d}\r\n%s' % (len(s), s)
+
+
+# A command line: '(', ')', quoted string, literal (already read, and
+# replaced by \0) or an atom, which may have a section such as
+# BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)] and a partial range
+commandTokenRe = re.compile(r'''\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|(\x00)|
+  ([^\s()"\[]+(?:\[[^\]]*\])?(?:<[^>]*>)?))''', re.X)
+commandLiteralRe = re.compile(r'\{(\d+)(\+?)\}$')
+internalDateRe = re.compile(r'\s?\d{1,2}-\w{3}-\d{4} ')
+sectionRe = re.compile(r'(BODY(?:\.PEEK)?)\[([^\]]*)\](?:<(\d+)\.(\d+)>)?$', re.I)
+sectionPartRe = re.compile(r'^([\d.]*?)\.?(HEADER\.FIELDS(?:\.NOT)? \(([^)]*)\)|'
+  r'HEADER|TEXT|MIME)?$', re.I)
+
+
+def parseCommand(line, literals):
+  '''Parse the arguments of a command into nested lists.'''
+  stack = [[]]
+  pos = 0
+  while pos < len(line):
+    m = commandTokenRe.match(line, pos)
+    if not m:
+      if not line[pos:].strip():
+	break
+      raise ValueError('bad syntax at %r' % line[pos:])
+    pos = m.end()
+    if m.group(1):
+      stack.append([])
+    elif m.group(2):
+      if len(stack) < 2:
+	raise ValueError('unbalanced )')
+      item = stack.pop()
+      stack[-1].append(item)
+    elif m.group(3) is not None:
+      stack[-1].append(imap.quotedCharRe.sub(r'\1', m.group(3)))
+    elif m.group(4):
+      stack[-1].append(literals.pop(0))
+    else:
+      stack[-1].append(m.group(5))
+  return stack[0]
+
+
+def inSet(n, spec, largest):
+  '''Return True if n is in the sequence set spec. * is largest.'''
+  for part in spec.split(','):
+    first, _, last = part.partition(':')
+    first = largest if first == '*' else int(first)
+    last = first if not last else largest if last == '*' else int(last)
+    if min(first, last) <= n <= max(first, last):
+      return True
+  return False
+
+
+class FakeHandler(SocketServer.StreamRequestHandler):
+  '''One client connection.'''
+  def setup(self):
+    SocketServer.StreamRequestHandler.setup(self)
+    # Responses go out in several writes; don't let Nagle hold them up
+    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.fake = self.server.fake
+    self.inflate = None
+    self.deflate = None
+    self.buffer = ''
+    self.mbox = None
+
+  def fill(self):
+    '''Read more from the client; return False at end of file.'''
+    data = self.connection.recv(65536)
+    if self.inflate and data:
+      data = self.inflate.decompress(data)
+    self.buffer += data
+    return bool(data)
+
+  def readline(self):
+    '''Return the next line, without CRLF, or None. If we have to wait
+    for it, the client must have been waiting for us: a round trip.'''
+    if '\r\n' not in self.buffer:
+      while '\r\n' not in self.buffer:
+	if not self.fill():
+	  return None
+      self.roundTrip()
+    line, self.buffer = self.buffer.split('\r\n', 1)
+    return line
+
+  def read(self, n):
+    while len(self.buffer) < n:
+      if not self.fill():
+	return None
+    data, self.buffer = self.buffer[:n], self.buffer[n:]
+    return data
+
+  def roundTrip(self):
+    with self.fake.lock:
+      self.fake.roundTrips += 1
+    if self.fake.latency:
+      time.sleep(self.fake.latency)
+
+  def send(self, data):
+    if self.deflate:
+      data = self.deflate.compress(data) + self.deflate.flush(zlib.Z_SYNC_FLUSH)
+    if not self.fake.bandwidth:
+      self.connection.sendall(data)
+      return
+    for i in xrange(0, len(data), 16384):
+      time.sleep(len(data[i:i+16384]) / float(self.fake.bandwidth))
+      self.connection.sendall(data[i:i+16384])
+
+  def handle(self):
+    self.send('* OK [CAPABILITY %s] imapbench ready\r\n' %
+      ' '.join(self.fake.caps))
+    while True:
+      line = self.readline()
+      if line is None:
+	return
+      literals = []
+      m = commandLiteralRe.search(line)
+      while m:
+	if not m.group(2):
+	  self.send('+ go ahead\r\n')
+	  self.roundTrip()
+	literals.append(self.read(int(m.group(1))))
+	rest = self.readline()
+	if rest is None or literals[-1] is None:
+	  return
+	line = line[:m.start()] + '\x00' + rest
+	m = commandLiteralRe.search(line)
+      tag, _, line = line.partition(' ')
+      try:
+	args = parseCommand(line, literals)
+	command = args.pop(0).upper()
+	if command == 'UID':
+	  command = 'UID_' + args.pop(0).upper()
+      except (ValueError, IndexError) as e:
+	self.send('%s BAD %s\r\n' % (tag, e))
+	continue
+      func = getattr(self, 'do_' + command, None)
+      if func is None:
+	self.send('%s BAD unknown command\r\n' % tag)
+	continue
+      with self.fake.lock:
+	try:
+	  result = func(tag, args)
+	except (ValueError, IndexError, TypeError) as e:
+	  result = 'BAD %s' % e
+      self.send('%s %s\r\n' % (tag, result))
+      if command == 'LOGOUT':
+	return
+      if command == 'COMPRESS' and result.startswith('OK'):
+	self.deflate = zlib.compressobj(6, zlib.DEFLATED, -15)
+	self.inflate = zlib.decompressobj(-15)
+	self.buffer = self.inflate.decompress(self.buffer)
+
+  # ---- Commands. Each returns the text of the tagged response ----
+
+  def do_CAPABILITY(self, tag, args):
+    self.send('* CAPABILITY %s\r\n' % ' '.join(self.fake.caps))
+    return 'OK CAPABILITY completed'
+
+  def do_LOGIN(self, tag, args):
+    return 'OK LOGIN completed'
+
+  def do_LOGOUT(self, tag, args):
+    self.send('* BYE logging out\r\n')
+    return 'OK LOGOUT completed'
+
+  def do_NOOP(self, tag, args):
+    return 'OK NOOP completed'
+
+  def do_ENABLE(self, tag, args):
+    enabled = [arg.upper() for arg in args
+	       if arg.upper() in ('CONDSTORE', 'QRESYNC')]
+    self.send('* ENABLED %s\r\n' % ' '.join(enabled))
+    return 'OK ENABLE completed'
+
+  def do_ID(self, tag, args):
+    self.send('* ID NIL\r\n')
+    return 'OK ID completed'
+
+  def do_COMPRESS(self, tag, args):
+    if 'COMPRESS=DEFLATE' not in self.fake.caps:
+      return 'BAD COMPRESS not supported'
+    if self.deflate:
+      return 'NO [COMPRESSIONACTIVE] already compressing'
+    return 'OK begin compression'
+
+  def do_LIST(self, tag, args):
+    items = None
+    if len(args) > 3 and str(args[2]).upper() == 'RETURN' and \
+	'LIST-STATUS' in self.fake.caps:
+      for i, arg in enumerate(args[3][:-1]):
+	if str(arg).upper() == 'STATUS':
+	  items = args[3][i+1]
+    pattern = re.escape(args[1]).replace(r'\*', '.*').replace(r'\%', '[^.]*')
+    for name in sorted(self.fake.boxes):
+      if re.match(pattern + '$', name):
+	self.send('* LIST (\\HasNoChildren) "." %s\r\n' % quote(name))
+	if items:
+	  self.send(self.status(self.fake.boxes[name], items))
+    return 'OK LIST completed'
+
+  def do_STATUS(self, tag, args):
+    mbox = self.fake.boxes.get(args[0])
+    if not mbox:
+      return 'NO no such mailbox'
+    self.send(self.status(mbox, args[1]))
+    return 'OK STATUS completed'
+
+  def status(self, mbox, items):
+    values = {'MESSAGES': len(mbox.messages), 'UIDNEXT': mbox.uidnext,
+	      'UIDVALIDITY': mbox.uidvalidity, 'RECENT': 0,
+	      'UNSEEN': len([msg for msg in mbox.messages
+			     if '\\Seen' not in msg.flags]),
+	      'HIGHESTMODSEQ': mbox.modseq,
+	      'SIZE': sum(len(msg.data) for msg in mbox.messages)}
+    return '* STATUS %s (%s)\r\n' % (quote(mbox.name),
+      ' '.join('%s %d' % (item.upper(), values[item.upper()])
+	       for item in items if item.upper() in values))
+
+  def do_CREATE(self, tag, args):
+    if args[0] in self.fake.boxes:
+      return 'NO [ALREADYEXISTS] mailbox exists'
+    self.fake.create(args[0])
+    return 'OK CREATE completed'
+
+  def do_DELETE(self, tag, args):
+    if args[0] not in self.fake.boxes:
+      return 'NO [NONEXISTENT] no such mailbox'
+    del self.fake.boxes[args[0]]
+    return 'OK DELETE completed'
+
+  def do_SELECT(self, tag, args, command='SELECT'):
+    self.mbox = self.fake.boxes.get(args[0])
+    if not self.mbox:
+      return 'NO [NONEXISTENT] no such mailbox'
+    self.send('* %d EXISTS\r\n* 0 RECENT\r\n'
+      '* FLAGS (\\Seen \\Answered \\Flagged \\Deleted \\Draft)\r\n'
+      '* OK [UIDVALIDITY %d] UIDs valid\r\n* OK [UIDNEXT %d] next UID\r\n' %
+      (len(self.mbox.messages), self.mbox.uidvalidity, self.mbox.uidnext))
+    if 'CONDSTORE' in self.fake.caps:
+      self.send('* OK [HIGHESTMODSEQ %d] modseq\r\n' % self.mbox.modseq)
+    return 'OK [%s] %s completed' % \
+      ('READ-ONLY' if command == 'EXAMINE' else 'READ-WRITE', command)
+
+  def do_EXAMINE(self, tag, args):
+    return self.do_SELECT(tag, args, 'EXAMINE')
+
+  def do_CLOSE(self, tag, args):
+    self.mbox = None
+    return 'OK CLOSE completed'
+
+  def do_APPEND(self, tag, args):
+    mbox = self.fake.boxes.get(args.pop(0))
+    if not mbox:
+      return 'NO [TRYCREATE] no such mailbox'
+    messages = []
+    while args:
+      flags = args.pop(0) if isinstance(args[0], list) else []
+      date = None
+      if len(args) > 1 and internalDateRe.match(args[0]):
+	date = email.utils.parsedate_tz(args.pop(0).strip().replace('-', ' '))
+	date = date and email.utils.mktime_tz(date)
+      messages.append((args.pop(0), flags, date))
+      if 'MULTIAPPEND' not in self.fake.caps:
+	break
+    uids = [mbox.add(data, flags, date) for data, flags, date in messages]
+    if 'UIDPLUS' in self.fake.caps:
+      return 'OK [APPENDUID %d %s] APPEND completed' % \
+	(mbox.uidvalidity, imap.uidSet(uids))
+    return 'OK APPEND completed'
+
+  def selected(self, spec, uid):
+    '''Return (msgno, message) for the messages in a sequence or UID set.'''
+    messages = self.mbox.messages
+    if uid:
+      largest = messages[-1].uid if messages else 0
+      return [(i+1, msg) for i, msg in enumerate(messages)
+	      if inSet(msg.uid, spec, largest)]
+    return [(i+1, msg) for i, msg in enumerate(messages)
+	    if inSet(i+1, spec, len(messages))]
+
+  def do_FETCH(self, tag, args, uid=False):
+    if not self.mbox:
+      return 'BAD no mailbox selected'
+    items = args[1] if isinstance(args[1], list) else [args[1]]
+    macros = {'ALL': ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE', 'ENVELOPE'],
+	      'FAST': ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE']}
+    if len(items) == 1 and items[0].upper() in macros:
+      items = macros[items[0].upper()]
+    if uid and 'UID' not in [item.upper() for item in items]:
+      items = ['UID'] + items
+    changedSince = None
+    if len(args) > 2 and str(args[2][0]).upper() == 'CHANGEDSINCE':
+      changedSince = int(args[2][1])
+    for msgno, msg in self.selected(args[0], uid):
+      if changedSince is not None and msg.modseq <= changedSince:
+	continue
+      values = [self.fetchItem(msg, item) for item in items]
+      if changedSince is not None:
+	values.append('MODSEQ (%d)' % msg.modseq)
+      self.send('* %d FETCH (%s)\r\n' % (msgno, ' '.join(values)))
+    return 'OK FETCH completed'
+
+  def do_UID_FETCH(self, tag, args):
+    return self.do_FETCH(tag, args, True)
+
+  def fetchItem(self, msg, item):
+    name = item.upper()
+    if name == 'UID':
+      return 'UID %d' % msg.uid
+    if name == 'FLAGS':
+      return 'FLAGS (%s)' % ' '.join(msg.flags)
+    if name == 'RFC822.SIZE':
+      return 'RFC822.SIZE %d' % len(msg.data)
+    if name == 'MODSEQ':
+      return 'MODSEQ (%d)' % msg.modseq
+    if name == 'INTERNALDATE':
+      return 'INTERNALDATE "%s"' % \
+	time.strftime('%d-%b-%Y %H:%M:%S +0000', time.gmtime(msg.date))
+    if name == 'RFC822':
+      return 'RFC822 ' + literal(msg.data)
+    mime = MimePart(msg.data)
+    if name == 'RFC822.HEADER':
+      return 'RFC822.HEADER ' + literal(mime.header)
+    if name == 'RFC822.TEXT':
+      return 'RFC822.TEXT ' + literal(mime.body)
+    if name in ('BODY', 'BODYSTRUCTURE'):
+      return '%s %s' % (name, mime.structure())
+    if name == 'ENVELOPE':
+      return 'ENVELOPE ' + envelope(mime)
+    m = sectionRe.match(item)
+    if not m:
+      raise ValueError('unknown FETCH item %s' % item)
+    key = 'BODY[%s]' % m.group(2)
+    text = self.section(mime, msg.data, m.group(2))
+    if m.group(3):
+      start = int(m.group(3))
+      text = text[start:start+int(m.group(4))]
+      key += '<%d>' % start
+    return key + ' ' + literal(text)
+
+  def section(self, mime, data, section):
+    '''Return a BODY[section] of a message.'''
+    if not section:
+      return data
+    m = sectionPartRe.match(section)
+    if not m:
+      raise ValueError('bad section %s' % section)
+    part = mime.part([int(n) for n in m.group(1).split('.') if n])
+    what = (m.group(2) or 'TEXT').upper()
+    if part is None:
+      return ''
+    if what == 'TEXT':
+      return part.body
+    if what in ('HEADER', 'MIME'):
+      return part.header
+    fields = m.group(3).lower().split()
+    keep = not what.endswith('.NOT')
+    return ''.join(line + '\r\n' for line in headerLines(part.header)
+		   if (line.split(':', 1)[0].lower() in fields) == keep) + '\r\n'
+
+  def do_SEARCH(self, tag, args, uid=False):
+    if not self.mbox:
+      return 'BAD no mailbox selected'
+    esearch = args and str(args[0]).upper() == 'RETURN'
+    if esearch:
+      args = args[2:]
+    found = [msg.uid if uid else i+1
+	     for i, msg in enumerate(self.mbox.messages)
+	     if self.matches(msg, list(args))]
+    if esearch and 'ESEARCH' in self.fake.caps:
+      self.send('* ESEARCH (TAG "%s")%s%s\r\n' % (tag, ' UID' if uid else '',
+	' ALL ' + imap.uidSet(found) if found else ''))
+    else:
+      self.send('* SEARCH%s\r\n' % ''.join(' %d' % n for n in found))
+    return 'OK SEARCH completed'
+
+  def do_UID_SEARCH(self, tag, args):
+    return self.do_SEARCH(tag, args, True)
+
+  def matches(self, msg, keys):
+    '''Return True if msg matches all the search keys.'''
+    while keys:
+      key = keys.pop(0)
+      if isinstance(key, list):
+	if not self.matches(msg, list(key)):
+	  return False
+	continue
+      key = key.upper()
+      if key in ('SINCE', 'BEFORE', 'SENTSINCE', 'SENTBEFORE'):
+	day = time.mktime(time.strptime(keys.pop(0), '%d-%b-%Y'))
+	if key.endswith('SINCE') and msg.date < day or \
+	    key.endswith('BEFORE') and msg.date >= day:
+	  return False
+      elif key == 'LARGER':
+	if len(msg.data) <= int(keys.pop(0)):
+	  return False
+      elif key == 'SMALLER':
+	if len(msg.data) >= int(keys.pop(0)):
+	  return False
+      elif key in ('SEEN', 'UNSEEN'):
+	if ('\\Seen' in msg.flags) != (key == 'SEEN'):
+	  return False
+      elif key == 'UID':
+	if not inSet(msg.uid, keys.pop(0), self.mbox.uidnext):
+	  return False
+      elif key in ('SUBJECT', 'FROM', 'TO', 'BODY', 'TEXT'):
+	if keys.pop(0).lower() not in msg.data.lower():
+	  return False
+      elif key == 'NOT':
+	if self.matches(msg, [keys.pop(0)]):
+	  return False
+      elif key != 'ALL':
+	raise ValueError('unknown search key %s' % key)
+    return True
+
+  def do_STORE(self, tag, args, uid=False):
+    if not self.mbox:
+      return 'BAD no mailbox selected'
+    action = args[1].upper()
+    flags = args[2] if isinstance(args[2], list) else [args[2]]
+    for msgno, msg in self.selected(args[0], uid):
+      if action.startswith('+'):
+	msg.flags = msg.flags + [flag for flag in flags if flag not in msg.flags]
+      elif action.startswith('-'):
+	msg.flags = [flag for flag in msg.flags if flag not in flags]
+      else:
+	msg.flags = list(flags)
+      self.mbox.modseq += 1
+      msg.modseq = self.mbox.modseq
+      if not action.endswith('.SILENT'):
+	self.send('* %d FETCH (FLAGS (%s))\r\n' % (msgno, ' '.join(msg.flags)))
+    return 'OK STORE completed'
+
+  def do_UID_STORE(self, tag, args):
+    return self.do_STORE(tag, args, True)
+
+
+def envelope(mime):
+  '''Return the ENVELOPE of a message.'''
+  header = {}
+  for line in headerLines(mime.header):
+    name, _, value = line.partition(':')
+    header[name.lower()] = value.strip()
+  def address(value):
+    if not value:
+      return 'NIL'
+    name, addr = email.utils.parseaddr(value)
+    mailbox, _, host = addr.partition('@')
+    return '((%s NIL %s %s))' % (quote(name or None), quote(mailbox),
+				 quote(host))
+  sender = address(header.get('from'))
+  return '(%s %s %s %s %s %s NIL NIL NIL %s)' % (quote(header.get('date')),
+    quote(header.get('subject')), sender, sender, sender,
+    address(header.get('to')), quote(header.get('message-id')))
+
+
+class FakeTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class FakeServer(object):
+  '''An IMAP4rev1 server on 127.0.0.1 that keeps its mailboxes in
+  memory and accepts any login. It has the extensions imap.py uses,
+  unless told otherwise, and can add latency to each round trip and
+  limit its bandwidth. It counts the round trips.'''
+  CAPABILITIES = ['IMAP4rev1', 'LITERAL+', 'MULTIAPPEND', 'UIDPLUS',
+    'CONDSTORE', 'ESEARCH', 'LIST-STATUS', 'STATUS=SIZE', 'COMPRESS=DEFLATE',
+    'ENABLE', 'ID', 'AUTH=PLAIN']
+
+  def __init__(self, port=0, caps=None, latency=0.0, bandwidth=0):
+    self.caps = caps or self.CAPABILITIES
+    if 'IMAP4REV1' not in [cap.upper() for cap in self.caps]:
+      self.caps = ['IMAP4rev1'] + self.caps
+    self.latency = latency
+    self.bandwidth = bandwidth
+    self.boxes = {}
+    self.uidvalidity = int(time.time())
+    self.roundTrips = 0
+    self.lock = threading.RLock()
+    self.tcpServer = FakeTCPServer(('127.0.0.1', port), FakeHandler)
+    self.tcpServer.fake = self
+    self.port = self.tcpServer.server_address[1]
+
+  def start(self):
+    '''Serve in a background thread.'''
+    thread = threading.Thread(target=self.tcpServer.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def close(self):
+    self.tcpServer.shutdown()
+    self.tcpServer.server_close()
+
+  def create(self, name):
+    # A mailbox that is created again must get a new UIDVALIDITY
+    self.uidvalidity += 1
+    self.boxes[name] = FakeMailbox(name, self.uidvalidity)
+    return self.boxes[name]
+
+  def clear(self):
+    '''Delete all the mailboxes but an empty INBOX.'''
+    with self.lock:
+      self.boxes = {}
+      self.create('INBOX')
+
+  def populate(self, nboxes, nmesg, size, nfolders=0):
+    '''Create INBOX and nboxes-1 more mailboxes with nmesg messages each,
+    every other one \\Seen, and nfolders empty folders.'''
+    for name in ['INBOX'] + ['Box%d' % i for i in xrange(1, nboxes)]:
+      mbox = self.create(name)
+      for i in xrange(nmesg):
+	mbox.add(makeMessage(mbox.uidnext, size, name, attachSize),
+		 ['\\Seen'] if i % 2 else [], 1500000000 + mbox.uidnext*60)
+    for i in xrange(nfolders):
+      self.create('Folder%05d' % i)
+
+  def messageBytes(self):
+    return sum(len(msg.data) for mbox in self.boxes.values()
+	       for msg in mbox.messages)
+
+
+# ---- The original parser ----
+
+def legacyParseFetch(resp):
+  '''The parseFetch() that imap.py used before iterFetch(), kept
+  here to measure against.'''
+  # Each message consists of a sequence of tuples and
+  # strings. The message is terminated by a string that
+  # ends with ')'
+  # resp ::= ['OK', [message…]]
+  # message ::= rstring|tuple… rstring')'
+  # tuple ::= (rstring, bodyString)
+  # rstring ::= rpart…
+  # rpart ::= key intvalue | key (listvalue) | key {size}
+  if not isinstance(resp, tuple):
+    print >>sys.stderr, resp, 'is not a tuple'
+    return None
+  if len(resp) < 1 or resp[0] != 'OK':
+    print >>sys.stderr, resp, 'is not a valid response'
+    return None
+  resp = resp[1]
+  if resp == [None]:
+    # Nothing matched
+    return []
+  messages = []
+  while resp:
+    idx = legacyMessageEnd(resp)
+    msg = legacyParseMessage(resp[:idx+1])
+    if msg:
+      messages.append(msg)
+    resp = resp[idx+1:]
+  return messages
+
+def legacyMessageEnd(l):
+  '''Search list for a string that ends with ')'; return the
+  index of that entry.'''
+  for i,x in enumerate(l):
+    if isinstance(x, (str,unicode)) and x.endswith(')'):
+      return i
+  return len(l)-1
+
+def legacyParseMessage(resp):
+  '''A message is a sequence of 2-tuples and strings. In
+  the case of a 2-tuple, the second half is the text content
+  of something, such as the message headers or body.'''
+  # The first element will start with the message number and '('
+  msg = {}
+  first = True
+  for item in resp:
+    if isinstance(item, (str, unicode)):
+      legacyParseMessageStr(msg, item, first)
+    else:
+      key = legacyParseMessageStr(msg, item[0], first)
+      msg[key] = item[1]
+    first = False
+  return msg
+
+def legacyParseMessageStr(msg, item, firstItem):
+  if firstItem:
+    item = item.split(' ', 1)
+    msg['msgno'] = int(item[0])
+    item = item[1]
+    if item.startswith('('):
+      item = item[1:]
+  # The closing paren belongs to the message, not to the last value
+  if item.endswith(')'):
+    item = item[:-1]
+  key = None
+  while item:
+    item = item.lstrip()
+    item = item.split(' ',1)
+    if len(item) < 2:
+      return None
+    key,item = item
+    if item[0].isdigit():
+      item = item.split(' ',1)
+      msg[key] = int(item[0])
+      if len(item) < 2:
+	return None
+      item = item[1]
+    elif item.startswith('('):
+      idx = item.find(')')
+      flags = item[1:idx]
+      msg[key] = flags.split()
+      item = item[idx+1:]
+    elif item.startswith('{'):
+      return key
+  return None
+
+
+if __name__ == '__main__':
+  sys.exit(main())